@@ -1,8 +1,17 @@
 import logging
 import copy
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 
+from requests.exceptions import RequestException
 from pyfcm import FCMNotification
 from pyfcm.errors import (
     InvalidDataError,
@@ -14,9 +23,64 @@ from pyfcm.errors import (
     RetryAfterException
 )
 
+from apps.notifications import fcm_resend, fcm_tokens, fcm_v1
+
 logger = logging.getLogger(__name__)
 
 
+class RetryAfterGate:
+    '''
+    Shared by the threads sending the chunks of one notification: once FCM asked to
+    retry after a delay, no chunk is sent before that delay elapsed.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def delay(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def wait(self):
+        remaining = self._resume_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+class LegacyFCMNotification(FCMNotification):
+    '''
+    pyfcm's legacy API client, without its own Retry-After handling: pyfcm 1.5.1 sleeps for the
+    delay and sends again, without limit, on the sender thread. Here a failed request with a
+    Retry-After header raises RetryAfterException so FCMNotifier applies its gate and limits,
+    and the delay of an accepted request (some results Unavailable) is returned as 'retry_after'.
+    '''
+
+    @classmethod
+    def get_retry_after(cls, response):
+        retry_after = response.headers.get('Retry-After', '')
+        return int(retry_after) if retry_after.isdigit() and int(retry_after) > 0 else None
+
+    def send_request(self, payloads=None, timeout=None):
+        self.retry_after = None
+        super().send_request(payloads, timeout)
+
+    def do_request(self, payload, timeout):
+        response = self.requests_session.post(self.FCM_END_POINT, data=payload, timeout=timeout)
+        retry_after = self.get_retry_after(response)
+        if retry_after is not None:
+            if response.status_code != 200:
+                raise RetryAfterException(retry_after)
+            # Sending again would duplicate the notifications of the tokens which succeeded.
+            self.retry_after = max(self.retry_after or 0, retry_after)
+        return response
+
+    def parse_responses(self):
+        response = super().parse_responses()
+        response['retry_after'] = getattr(self, 'retry_after', None)
+        return response
+
+
 class FCMNotifier:
     '''
     Firebase cloud messaging service.
@@ -50,11 +114,47 @@ class FCMNotifier:
         'android_channel_id',
         'timeout',
         'extra_notification_kwargs',
-        'extra_kwargs'
+        'extra_kwargs',
+        'topic_name'
+    )
+
+    # Topic names FCM accepts
+    TOPIC_NAME = re.compile(r'^[a-zA-Z0-9-_.~%]{1,900}$')
+
+    # Errors failing a single chunk, the other chunks are still sent
+    CHUNK_ERRORS = (
+        InvalidDataError,
+        FCMError,
+        AuthenticationError,
+        FCMNotRegisteredError,
+        FCMServerError,
+        InternalPackageError,
+        RequestException,
     )
 
     def __init__(self):
-        self.__push_service = FCMNotification(api_key=settings.FCM_SERVER_KEY)
+        # pyfcm keeps the responses of the last request on the FCMNotification instance,
+        # so each thread sending chunks gets its own push service.
+        self.__local = threading.local()
+        self.__local.push_service = self.__create_push_service()
+
+    @classmethod
+    def __create_push_service(cls):
+        if settings.FCM_TRANSPORT == 'v1':
+            # Process wide and thread safe, see apps/notifications/fcm_v1.py
+            return fcm_v1.get_transport()
+        push_service = LegacyFCMNotification(api_key=settings.FCM_SERVER_KEY)
+        if settings.FCM_ENDPOINT_URL:
+            # Local stand-in of the FCM legacy HTTP API (load tests).
+            push_service.FCM_END_POINT = settings.FCM_ENDPOINT_URL
+        return push_service
+
+    @property
+    def __push_service(self):
+        push_service = getattr(self.__local, 'push_service', None)
+        if push_service is None:
+            push_service = self.__local.push_service = self.__create_push_service()
+        return push_service
 
     @classmethod
     def chunks(cls, registration_ids_list, rate_limit):
@@ -70,46 +170,302 @@ class FCMNotifier:
         '''
         return list(cls.chunks(registration_ids, 900))  # keep rate_limit to 900
 
+    @classmethod
+    def new_summary(cls):
+        '''
+        Merged result of the chunks of one notification, in the format of pyfcm's responses
+        plus the error of each failed token.
+        '''
+        return {
+            'multicast_ids': [],
+            'success': 0,
+            'failure': 0,
+            'canonical_ids': 0,
+            'results': [],
+            'errors': {},  # registration id -> error
+            'failed_chunks': 0,
+            'retry_after': None,  # longest Retry-After delay of the failed chunks
+            'resend': 0,  # failed tokens queued for a resend, see fcm_resend.py
+        }
+
+    @classmethod
+    def merge_chunk_response(cls, summary, registration_ids, response, error=None):
+        '''
+        Adds the response of one chunk (or the error which failed it) to summary.
+        summary['results'] stays aligned with the registration ids sent.
+        '''
+        if error is not None:
+            name = type(error).__name__
+            summary['failure'] += len(registration_ids)
+            summary['failed_chunks'] += 1
+            result = {'error': name}
+            if isinstance(error, fcm_resend.RETRYABLE_CHUNK_ERRORS):
+                result['retryable'] = True
+            summary['results'].extend(dict(result) for _ in registration_ids)
+            summary['errors'].update((registration_id, name) for registration_id in registration_ids)
+            if isinstance(error, RetryAfterException):
+                summary['retry_after'] = max(summary['retry_after'] or 0, error.delay)
+            return summary
+
+        summary['multicast_ids'].extend(response.get('multicast_ids', []))
+        summary['success'] += response.get('success', 0)
+        summary['failure'] += response.get('failure', 0)
+        summary['canonical_ids'] += response.get('canonical_ids', 0)
+        summary['results'].extend(response.get('results', []))
+        if response.get('retry_after'):
+            # Some tokens of the chunk were throttled or FCM was unavailable for them
+            summary['retry_after'] = max(summary['retry_after'] or 0, response['retry_after'])
+        for registration_id, result in zip(registration_ids, response.get('results', [])):
+            if 'error' in result:
+                summary['errors'][registration_id] = result['error']
+        return summary
+
+    @classmethod
+    def get_extra_notification_kwargs(cls, kwargs):
+        '''
+        Create an object to collect extra data to be used by client
+        This object should not contain the fields used by the fcm library
+        '''
+        extra_notification_kwargs = copy.copy(kwargs)
+
+        for item in cls.FIREBASE_SERVER_ARGS:
+            extra_notification_kwargs.pop(item, None)
+        return extra_notification_kwargs
+
     def send(self, **kwargs):
         '''
-        This method is used for pushing messages to Firebase for single device
-        or multiple device depending on kwargs.
+        This method is used for pushing messages to Firebase for single device,
+        multiple device or the subscribers of a topic_name / condition depending on kwargs.
+        '''
+        return self.__send(kwargs)
+
+    def resend(self, attempt, registration_ids, notification):
         '''
+        Resend attempt of a notification to the tokens it failed to reach (apps.tasks.tasks.FCMResend).
+        '''
+        return self.__send(dict(notification, registration_ids=registration_ids), attempt)
+
+    def __send(self, kwargs, attempt=0):
         response = None
         try:
-            # Create an object to collect extra data to be used by client
-            # This object should not contain the fields used by the fcm library
-            extra_notification_kwargs = copy.copy(kwargs)
-
-            for item in FCMNotifier.FIREBASE_SERVER_ARGS:
-                extra_notification_kwargs.pop(item, None)
+            extra_notification_kwargs = self.get_extra_notification_kwargs(kwargs)
 
             if all(name in kwargs for name in ['registration_id', 'message_title', 'message_body']):
 
-                response = self.__notify_single_device(
+                # Same (response, error) merge as the chunks, so a failed token is pruned or resent alike.
+                response = self.__notify_concurrently([([kwargs['registration_id']], functools.partial(
+                    self.__notify_single_device,
                     kwargs['registration_id'],
                     kwargs['message_title'],
                     kwargs['message_body'],
                     kwargs.get('data_message', None),
                     extra_notification_kwargs,
-                )
+                ))])
             elif all(name in kwargs for name in ['registration_ids', 'message_title', 'message_body']):
 
                 # Throttle and send
-                for registration_ids in self.throttle_notifications(kwargs['registration_ids']):
-                    response = self.__notify_multiple_devices(
-                        registration_ids,
-                        kwargs['message_title'],
-                        kwargs['message_body'],
-                        kwargs.get('data_message', None),
-                        extra_notification_kwargs
-                    )
+                response = self.__notify_chunks(
+                    self.throttle_notifications(kwargs['registration_ids']),
+                    kwargs['message_title'],
+                    kwargs['message_body'],
+                    kwargs.get('data_message', None),
+                    extra_notification_kwargs
+                )
+            elif any(kwargs.get(name) for name in ['topic_name', 'condition']) and \
+                    all(name in kwargs for name in ['message_title', 'message_body']):
+
+                # Whole audience: a single request whatever the number of subscribers
+                response = self.__notify_topic_subscribers(
+                    kwargs.get('topic_name'),
+                    kwargs.get('condition'),
+                    kwargs['message_title'],
+                    kwargs['message_body'],
+                    kwargs.get('data_message', None),
+                    extra_notification_kwargs
+                )
         except (InvalidDataError, FCMError, AuthenticationError, FCMNotRegisteredError,
                 FCMServerError, InternalPackageError, RetryAfterException) as error:
             logger.error(error)
 
+        # Topic and condition sends have no per token results.
+        if 'registration_id' in kwargs:
+            registration_ids = [kwargs['registration_id']]
+        else:
+            registration_ids = kwargs.get('registration_ids', [])
+        if response and registration_ids and settings.FCM_PRUNE_TOKENS:
+            response['pruned'] = fcm_tokens.prune(registration_ids, response.get('results', []))
+        if response and registration_ids and settings.FCM_RESEND_ENABLED:
+            notification = {
+                key: value for key, value in kwargs.items() if key not in ('registration_id', 'registration_ids')
+            }
+            response['resend'] = fcm_resend.schedule_failed(registration_ids, response, notification, attempt + 1)
         return response
 
+    def subscribe(self, topic_name, registration_ids):
+        '''
+        Subscribes registration_ids to topic_name, FCM_TOPIC_BATCH_SIZE tokens per request.
+        '''
+        return self.__manage_topic('subscribe', topic_name, registration_ids)
+
+    def unsubscribe(self, topic_name, registration_ids):
+        '''
+        Unsubscribes registration_ids from topic_name, FCM_TOPIC_BATCH_SIZE tokens per request.
+        '''
+        return self.__manage_topic('unsubscribe', topic_name, registration_ids)
+
+    @classmethod
+    def sync_device_topics(cls, registration_id, topics, previous_topics=()):
+        '''
+        Keeps the subscriptions of a device in sync as it registers or changes audience segments:
+        queues its subscription to the topics it joined and its unsubscription from the ones it left.
+        '''
+        from apps.tasks.tasks import FCMTopicSync
+
+        for topic_name in set(topics) - set(previous_topics):
+            FCMTopicSync().queue('subscribe', topic_name, [registration_id])
+        for topic_name in set(previous_topics) - set(topics):
+            FCMTopicSync().queue('unsubscribe', topic_name, [registration_id])
+
+    def __manage_topic(self, action, topic_name, registration_ids):
+        if not self.TOPIC_NAME.match(topic_name or ''):
+            raise InvalidDataError("Invalid topic name '{}'".format(topic_name))
+
+        def run(batch):
+            push_service = self.__push_service
+            if action == 'subscribe':
+                manage = push_service.subscribe_registration_ids_to_topic
+            else:
+                manage = push_service.unsubscribe_registration_ids_from_topic
+            try:
+                manage(batch, topic_name)
+            except self.CHUNK_ERRORS as error:
+                logger.error("[ FCM ] {} of {} tokens to {} failed: {!r}".format(action, len(batch), topic_name, error))
+                return error
+            return None
+
+        batches = list(self.chunks(registration_ids, settings.FCM_TOPIC_BATCH_SIZE))
+        errors = self.__map(run, batches)
+        summary = {
+            'topic_name': topic_name,
+            'tokens': len(registration_ids),
+            'failed': sum(len(batch) for batch, error in zip(batches, errors) if error is not None),
+            'failed_batches': sum(1 for error in errors if error is not None),
+        }
+        logger.info("[ FCM ] {} {}: {}".format(action, topic_name, summary))
+        return summary
+
+    def send_bulk(self, messages, **kwargs):
+        '''
+        Sends personalized notifications, messages is an iterable of
+        (registration_id, message_title, message_body, data_message) and kwargs are shared by all of them.
+        Messages with identical payloads are grouped into multicast chunks, the unique ones are sent
+        as single device notifications, all on up to FCM_SEND_CONCURRENCY threads.
+        Returns the summary of send(), results aligned with messages.
+        '''
+        extra_notification_kwargs = self.get_extra_notification_kwargs(kwargs)
+
+        groups = {}  # payload hash -> (payload, registration ids, message indices)
+        registration_ids = []
+        for index, (registration_id, msg_title, msg_body, data_message) in enumerate(messages):
+            payload = (msg_title, msg_body, data_message)
+            key = hashlib.sha1(json.dumps(payload, sort_keys=True, cls=DjangoJSONEncoder).encode('utf-8')).digest()
+            group = groups.setdefault(key, (payload, [], []))
+            group[1].append(registration_id)
+            group[2].append(index)
+            registration_ids.append(registration_id)
+
+        jobs, order = [], []
+        for (msg_title, msg_body, data_message), reg_ids, indices in groups.values():
+            if len(reg_ids) == 1:
+                jobs.append((reg_ids, functools.partial(
+                    self.__notify_single_device,
+                    reg_ids[0], msg_title, msg_body, data_message, extra_notification_kwargs)))
+            else:
+                for chunk in self.throttle_notifications(reg_ids):
+                    jobs.append((chunk, functools.partial(
+                        self.__notify_multiple_devices,
+                        chunk, msg_title, msg_body, data_message, extra_notification_kwargs)))
+            order.extend(indices)
+
+        summary = self.__notify_concurrently(jobs)
+        summary['results'] = [result for _, result in sorted(zip(order, summary['results']), key=lambda item: item[0])]
+        logger.info("[ FCM ] bulk send of {} messages: {} payloads, {} requests".format(
+            len(registration_ids), len(groups), len(jobs)))
+
+        if settings.FCM_PRUNE_TOKENS:
+            summary['pruned'] = fcm_tokens.prune(registration_ids, summary['results'])
+        if settings.FCM_RESEND_ENABLED:
+            # Resent per payload, as plain send() of the failed tokens.
+            for (msg_title, msg_body, data_message), reg_ids, indices in groups.values():
+                notification = dict(kwargs, message_title=msg_title, message_body=msg_body, data_message=data_message)
+                summary['resend'] += fcm_resend.schedule_failed(
+                    reg_ids, dict(summary, results=[summary['results'][index] for index in indices]), notification, 1)
+        return summary
+
+    def __notify_chunks(
+        self,
+        chunks,
+        msg_title,
+        msg_body,
+        data_message,
+        extra_notification_kwargs={},
+    ):
+        '''
+        Sends the chunks of one notification, see __notify_concurrently().
+        '''
+        return self.__notify_concurrently([
+            (reg_ids, functools.partial(
+                self.__notify_multiple_devices, reg_ids, msg_title, msg_body, data_message, extra_notification_kwargs))
+            for reg_ids in chunks
+        ])
+
+    def __notify_concurrently(self, jobs):
+        '''
+        Runs the jobs, (registration ids, function sending to them), on up to FCM_SEND_CONCURRENCY
+        threads and merges the responses into one summary, see new_summary().
+        '''
+        gate = RetryAfterGate()
+        responses = self.__map(lambda job: self.__notify_with_retry(job[0], job[1], gate), jobs)
+
+        summary = self.new_summary()
+        for (reg_ids, _), (response, error) in zip(jobs, responses):
+            self.merge_chunk_response(summary, reg_ids, response, error)
+        logger.info("[ FCM ] {} requests: {} success, {} failure, {} failed chunks".format(
+            len(jobs), summary['success'], summary['failure'], summary['failed_chunks']))
+        return summary
+
+    @classmethod
+    def __map(cls, function, items):
+        '''
+        map() on up to FCM_SEND_CONCURRENCY threads.
+        '''
+        workers = min(settings.FCM_SEND_CONCURRENCY, len(items))
+        if workers <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fcm-send') as executor:
+            return list(executor.map(function, items))
+
+    def __notify_with_retry(self, reg_ids, notify, gate):
+        '''
+        Sends one chunk, returns (response, error).
+        A RetryAfterException pauses every chunk for the delay and the chunk is retried,
+        up to FCM_RETRY_AFTER_ATTEMPTS times and FCM_RETRY_AFTER_MAX_DELAY seconds.
+        '''
+        attempts = 0
+        while True:
+            gate.wait()
+            try:
+                return notify(), None
+            except RetryAfterException as error:
+                attempts += 1
+                if attempts > settings.FCM_RETRY_AFTER_ATTEMPTS or error.delay > settings.FCM_RETRY_AFTER_MAX_DELAY:
+                    logger.error("[ FCM ] chunk of {} failed, retry after {}s".format(len(reg_ids), error.delay))
+                    return None, error
+                gate.delay(error.delay)
+            except self.CHUNK_ERRORS as error:
+                logger.error("[ FCM ] chunk of {} failed: {!r}".format(len(reg_ids), error))
+                return None, error
+
     def __notify_single_device(
         self,
         reg_id,
@@ -129,6 +485,29 @@ class FCMNotifier:
             extra_notification_kwargs=extra_notification_kwargs
         )
 
+    def __notify_topic_subscribers(
+        self,
+        topic_name,
+        condition,
+        msg_title,
+        msg_body,
+        data_message,
+        extra_notification_kwargs={},
+    ):
+        '''
+        Sends push notification to the devices subscribed to topic_name, or to the topics matching condition.
+        '''
+        if topic_name and not self.TOPIC_NAME.match(topic_name):
+            raise InvalidDataError("Invalid topic name '{}'".format(topic_name))
+        return self.__push_service.notify_topic_subscribers(
+            topic_name=topic_name,
+            condition=condition,
+            message_title=msg_title,
+            message_body=msg_body,
+            data_message=data_message,
+            extra_notification_kwargs=extra_notification_kwargs
+        )
+
     def __notify_multiple_devices(
         self,
         reg_ids,
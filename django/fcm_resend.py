@@ -0,0 +1,90 @@
+import logging
+import math
+import random
+
+from django.conf import settings
+
+from requests.exceptions import RequestException
+from pyfcm.errors import FCMServerError, RetryAfterException
+
+logger = logging.getLogger(__name__)
+
+'''
+    Resending of FCM notifications which failed on a transient error (FCM unavailable, throttled,
+    server errors). Only the tokens that failed are queued again, as apps.tasks.tasks.FCMResend
+    tasks of up to FCM_RESEND_BATCH_SIZE tokens, after the Retry-After delay FCM returned or a
+    jittered exponential backoff, until FCM_RESEND_MAX_ATTEMPTS resends were made.
+    The Retry-After delay is summary['retry_after'] of the send, read from the response headers:
+        - legacy transport: fcm.LegacyFCMNotification, from a failed chunk (RetryAfterException
+          past the inline retries) or an accepted one with Unavailable results
+        - v1 transport: fcm_v1.FCMv1Transport.send_message, from the throttled tokens' responses
+'''
+
+# Result errors worth sending again later
+RETRYABLE_ERRORS = (
+    'Unavailable',
+    'InternalServerError',
+    'MessageRateExceeded',
+    'DeviceMessageRateExceeded',
+    'TopicsMessageRateExceeded',
+)
+
+# Errors failing a whole chunk worth sending again later, see FCMNotifier.merge_chunk_response()
+RETRYABLE_CHUNK_ERRORS = (FCMServerError, RetryAfterException, RequestException)
+
+
+def is_retryable(result) -> bool:
+    return result.get('retryable', False) or result.get('error') in RETRYABLE_ERRORS
+
+
+def resend_delay(attempt, retry_after=None) -> int:
+    '''
+        Seconds before resend attempt (1 for the first resend): the Retry-After delay if FCM gave one,
+        otherwise FCM_RESEND_BASE_DELAY doubled on each attempt, jittered so the resends of a
+        campaign do not all come back at once.
+    '''
+    if retry_after:
+        return int(math.ceil(retry_after))
+    backoff = min(settings.FCM_RESEND_MAX_DELAY, settings.FCM_RESEND_BASE_DELAY * 2 ** (attempt - 1))
+    return max(1, int(math.ceil(backoff / 2 + random.uniform(0, backoff / 2))))
+
+
+def schedule(registration_ids, notification, attempt, retry_after=None) -> int:
+    '''
+        Queues resend attempt of notification (FCMNotifier.send kwargs without the registration ids)
+        to registration_ids. Returns the number of tokens queued.
+    '''
+    from apps.tasks import metrics
+    from apps.tasks.tasks import FCMResend
+
+    if not registration_ids:
+        return 0
+    if attempt > settings.FCM_RESEND_MAX_ATTEMPTS:
+        logger.error("[ FCM ] giving up on {} tokens after {} resends".format(len(registration_ids), attempt - 1))
+        metrics.record_fcm_resend(attempt, 'exhausted', len(registration_ids))
+        return 0
+
+    delay = resend_delay(attempt, retry_after)
+    queued = 0
+    for index in range(0, len(registration_ids), settings.FCM_RESEND_BATCH_SIZE):
+        batch = registration_ids[index:index + settings.FCM_RESEND_BATCH_SIZE]
+        if FCMResend().queue_in(delay, batch, notification, attempt):
+            queued += len(batch)
+
+    logger.info("[ FCM ] resend {} of {} tokens queued in {}s".format(attempt, queued, delay))
+    metrics.record_fcm_resend(attempt, 'queued', queued)
+    if queued < len(registration_ids):
+        metrics.record_fcm_resend(attempt, 'failed', len(registration_ids) - queued)
+    return queued
+
+
+def schedule_failed(registration_ids, summary, notification, attempt) -> int:
+    '''
+        Queues the resend of the tokens of registration_ids which failed on a transient error,
+        summary being the result of sending them (results aligned with registration_ids).
+    '''
+    failed = [
+        registration_id for registration_id, result in zip(registration_ids, summary.get('results', []))
+        if is_retryable(result)
+    ]
+    return schedule(failed, notification, attempt, summary.get('retry_after'))
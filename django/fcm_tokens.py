@@ -0,0 +1,109 @@
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Case, CharField, F, Value, When
+
+logger = logging.getLogger(__name__)
+
+'''
+    Pruning of the registration tokens FCM reports as invalid, so broadcasts stop re-sending to them.
+    The device table belongs to the project: FCM_DEVICE_MODEL ("app_label.ModelName") with its
+    FCM_DEVICE_TOKEN_FIELD and FCM_DEVICE_ACTIVE_FIELD. Without it the invalid tokens are only counted.
+        - NotRegistered / InvalidRegistration: the devices are deactivated
+        - canonical ids (results carrying a "registration_id"): the tokens are rewritten
+    Both are applied with one UPDATE per FCM_PRUNE_BATCH_SIZE tokens.
+'''
+
+INVALID_TOKEN_ERRORS = ('NotRegistered', 'InvalidRegistration')
+
+
+def collect(registration_ids, results) -> tuple:
+    '''
+        Reads the results of a send (aligned with registration_ids),
+        returns (invalid tokens, {token: canonical token}).
+    '''
+    invalid, canonical = [], {}
+    for registration_id, result in zip(registration_ids, results):
+        if result.get('error') in INVALID_TOKEN_ERRORS:
+            invalid.append(registration_id)
+        elif result.get('registration_id') and result['registration_id'] != registration_id:
+            canonical[registration_id] = result['registration_id']
+    return invalid, canonical
+
+
+def get_device_model():
+    if not settings.FCM_DEVICE_MODEL:
+        return None
+    return apps.get_model(settings.FCM_DEVICE_MODEL)
+
+
+def batches(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def deactivate(model, tokens) -> int:
+    token_field = settings.FCM_DEVICE_TOKEN_FIELD
+    updated = 0
+    for batch in batches(list(tokens), settings.FCM_PRUNE_BATCH_SIZE):
+        updated += model.objects.filter(**{token_field + '__in': batch}).update(
+            **{settings.FCM_DEVICE_ACTIVE_FIELD: False})
+    return updated
+
+
+def replace(model, canonical) -> tuple:
+    '''
+        Rewrites tokens to their canonical ids with an UPDATE ... CASE per batch.
+        A device whose canonical id is already stored (or claimed by another token of the batch)
+        is registered twice, the stale row is deactivated instead.
+        Returns (replaced, deactivated).
+    '''
+    token_field = settings.FCM_DEVICE_TOKEN_FIELD
+    replaced = deactivated = 0
+    for batch in batches(list(canonical.items()), settings.FCM_PRUNE_BATCH_SIZE):
+        taken = set(model.objects.filter(
+            **{token_field + '__in': [new for _, new in batch]}).values_list(token_field, flat=True))
+        rewrites, duplicates = [], []
+        for old, new in batch:
+            if new in taken:
+                duplicates.append(old)
+            else:
+                taken.add(new)
+                rewrites.append((old, new))
+
+        if duplicates:
+            deactivated += deactivate(model, duplicates)
+        if rewrites:
+            replaced += model.objects.filter(**{token_field + '__in': [old for old, _ in rewrites]}).update(**{
+                token_field: Case(
+                    *[When(**{token_field: old}, then=Value(new)) for old, new in rewrites],
+                    default=F(token_field),
+                    output_field=CharField(),
+                ),
+            })
+    return replaced, deactivated
+
+
+def prune(registration_ids, results) -> dict:
+    '''
+        Applies the invalid and canonical tokens of a send to the device table, returns the counts.
+        Database errors are logged, they never fail the send.
+    '''
+    invalid, canonical = collect(registration_ids, results)
+    counts = {'invalid': len(invalid), 'canonical': len(canonical), 'deactivated': 0, 'replaced': 0}
+    if not invalid and not canonical:
+        return counts
+
+    model = get_device_model()
+    if model is not None:
+        try:
+            counts['deactivated'] = deactivate(model, invalid)
+            counts['replaced'], duplicates = replace(model, canonical)
+            counts['deactivated'] += duplicates
+        except DatabaseError as error:
+            logger.error("[ FCM ] pruning tokens failed: {!r}".format(error))
+
+    logger.info("[ FCM ] pruned tokens: {}".format(counts))
+    return counts
@@ -0,0 +1,299 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from pyfcm.errors import AuthenticationError, FCMServerError, InvalidDataError
+
+logger = logging.getLogger(__name__)
+
+'''
+    FCM HTTP v1 transport (FCM_TRANSPORT = 'v1'), used by FCMNotifier in place of pyfcm's legacy
+    server key API. It has the surface of pyfcm's FCMNotification FCMNotifier relies on
+    (notify_single_device / notify_multiple_devices returning pyfcm style responses), so send(),
+    send_bulk() and the token pruning work the same on both transports.
+        - one process wide keep-alive session (FCM_V1_MAX_CONNECTIONS pooled connections)
+        - the OAuth access token of the service account is cached until close to its expiry
+        - v1 has no multicast: like the Admin SDKs' sendMulticast, a batch is one request per
+          token, sent concurrently over the pooled connections, with per token results
+        - topic and condition sends, and topic subscriptions through the instance id API
+    FCM_V1_ENDPOINT_URL and the "token_uri" of the service account file can point at a local
+    stand-in, see loadtest/fake_services.py
+'''
+
+SCOPE = 'https://www.googleapis.com/auth/firebase.messaging'
+GOOGLE_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry an access token is renewed
+
+# v1 error codes -> legacy result errors, so both transports' results read the same
+ERROR_CODES = {
+    'UNREGISTERED': 'NotRegistered',
+    'SENDER_ID_MISMATCH': 'MismatchSenderId',
+    'QUOTA_EXCEEDED': 'MessageRateExceeded',
+    'UNAVAILABLE': 'Unavailable',
+    'INTERNAL': 'InternalServerError',
+    'THIRD_PARTY_AUTH_ERROR': 'ThirdPartyAuthError',
+}
+
+
+def _b64(data) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+class ServiceAccountCredentials:
+    '''
+        OAuth access tokens of a service account (JWT bearer grant), cached until close to expiry.
+    '''
+
+    def __init__(self, info):
+        self.client_email = info['client_email']
+        self.token_uri = info.get('token_uri') or GOOGLE_TOKEN_URI
+        self.project_id = info.get('project_id')
+        self._private_key = serialization.load_pem_private_key(
+            info['private_key'].encode('utf-8'), password=None, backend=default_backend())
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0.0
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as service_account_file:
+            return cls(json.load(service_account_file))
+
+    def _assertion(self) -> str:
+        now = int(time.time())
+        header = {'alg': 'RS256', 'typ': 'JWT'}
+        claims = {'iss': self.client_email, 'scope': SCOPE, 'aud': self.token_uri, 'iat': now, 'exp': now + 3600}
+        signing_input = b'.'.join(
+            _b64(json.dumps(part, separators=(',', ':')).encode('utf-8')) for part in (header, claims))
+        signature = self._private_key.sign(signing_input, padding.PKCS1v15(), hashes.SHA256())
+        return (signing_input + b'.' + _b64(signature)).decode('ascii')
+
+    def _is_fresh(self) -> bool:
+        return self._access_token is not None and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN
+
+    def get_token(self, session, timeout=None) -> str:
+        if self._is_fresh():
+            return self._access_token
+        with self._lock:
+            if not self._is_fresh():
+                response = session.post(self.token_uri, timeout=timeout, data={
+                    'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                    'assertion': self._assertion(),
+                })
+                if response.status_code != 200:
+                    raise AuthenticationError("OAuth token request failed ({}): {}".format(
+                        response.status_code, response.text))
+                token = response.json()
+                self._access_token = token['access_token']
+                self._expires_at = time.time() + int(token.get('expires_in', 3600))
+                logger.info("[ FCM v1 ] access token renewed, expires in {}s".format(token.get('expires_in')))
+            return self._access_token
+
+    def invalidate(self, access_token):
+        '''
+            Drops access_token (rejected by FCM), unless another thread already renewed it.
+        '''
+        with self._lock:
+            if self._access_token == access_token:
+                self._access_token = None
+
+
+class FCMv1Transport:
+
+    def __init__(self, credentials, project_id=None, endpoint_url='https://fcm.googleapis.com', max_connections=64,
+                 timeout=10, iid_endpoint_url='https://iid.googleapis.com'):
+        self.credentials = credentials
+        self.project_id = project_id or credentials.project_id
+        self.send_url = '{}/v1/projects/{}/messages:send'.format(endpoint_url.rstrip('/'), self.project_id)
+        self.iid_url = '{}/iid/v1'.format(iid_endpoint_url.rstrip('/'))
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='fcm-v1')
+
+    @classmethod
+    def build_message(cls, registration_id, message_title=None, message_body=None, data_message=None,
+                      extra_notification_kwargs=None) -> dict:
+        '''
+            v1 message of a legacy style notification. v1 notifications only accept known fields
+            and data values must be strings, so extra_notification_kwargs are sent as data.
+        '''
+        message = {'token': registration_id}
+        notification = {
+            key: value for key, value in (('title', message_title), ('body', message_body)) if value is not None
+        }
+        if notification:
+            message['notification'] = notification
+        data = dict(data_message or {}, **(extra_notification_kwargs or {}))
+        if data:
+            message['data'] = {
+                str(key): value if isinstance(value, str) else json.dumps(value, cls=DjangoJSONEncoder)
+                for key, value in data.items()
+            }
+        return message
+
+    @classmethod
+    def parse_error(cls, response) -> str:
+        try:
+            error = response.json()['error']
+        except (ValueError, KeyError, TypeError):
+            return 'Unavailable' if response.status_code >= 500 else 'InvalidArgument'
+        code = error.get('status')
+        for detail in error.get('details', []):
+            code = detail.get('errorCode', code)
+        if code == 'INVALID_ARGUMENT':
+            # Also returned for invalid payloads, only a rejected token makes the device invalid.
+            if 'registration token' in error.get('message', '').lower():
+                return 'InvalidRegistration'
+            return 'InvalidArgument'
+        return ERROR_CODES.get(code, code or 'Unavailable')
+
+    def send_message(self, message, retry_auth=True) -> tuple:
+        '''
+            Sends one message, returns (legacy style result, Retry-After seconds or None).
+        '''
+        access_token = self.credentials.get_token(self.session, self.timeout)
+        try:
+            response = self.session.post(
+                self.send_url,
+                json={'message': message},
+                headers={'Authorization': 'Bearer ' + access_token},
+                timeout=self.timeout,
+            )
+        except RequestException as error:
+            logger.warning("[ FCM v1 ] request failed: {!r}".format(error))
+            return {'error': 'Unavailable'}, None
+
+        if response.status_code == 200:
+            return {'message_id': response.json()['name']}, None
+        if response.status_code == 401:
+            self.credentials.invalidate(access_token)
+            if retry_auth:
+                return self.send_message(message, retry_auth=False)
+            raise AuthenticationError("There was an error authenticating the sender account")
+
+        retry_after = response.headers.get('Retry-After', '')
+        return {'error': self.parse_error(response)}, int(retry_after) if retry_after.isdigit() else None
+
+    @classmethod
+    def to_response(cls, outcomes) -> dict:
+        '''
+            pyfcm style response of the (result, retry after) of each message, plus the longest Retry-After.
+        '''
+        results = [result for result, _ in outcomes]
+        success = sum(1 for result in results if 'message_id' in result)
+        retry_after = [delay for _, delay in outcomes if delay]
+        return {
+            'multicast_ids': [],
+            'success': success,
+            'failure': len(results) - success,
+            'canonical_ids': 0,
+            'results': results,
+            'topic_message_id': None,
+            'retry_after': max(retry_after) if retry_after else None,
+        }
+
+    def notify_single_device(self, registration_id, message_title=None, message_body=None, data_message=None,
+                             extra_notification_kwargs=None, **kwargs) -> dict:
+        message = self.build_message(
+            registration_id, message_title, message_body, data_message, extra_notification_kwargs)
+        return self.to_response([self.send_message(message)])
+
+    def notify_multiple_devices(self, registration_ids, message_title=None, message_body=None, data_message=None,
+                                extra_notification_kwargs=None, **kwargs) -> dict:
+        messages = [
+            self.build_message(registration_id, message_title, message_body, data_message, extra_notification_kwargs)
+            for registration_id in registration_ids
+        ]
+        return self.to_response(list(self.executor.map(self.send_message, messages)))
+
+    def notify_topic_subscribers(self, topic_name=None, message_body=None, message_title=None, condition=None,
+                                 data_message=None, extra_notification_kwargs=None, **kwargs) -> dict:
+        message = self.build_message(None, message_title, message_body, data_message, extra_notification_kwargs)
+        del message['token']
+        if condition:
+            message['condition'] = condition
+        else:
+            message['topic'] = topic_name
+        result, retry_after = self.send_message(message)
+        response = self.to_response([(result, retry_after)])
+        # Like pyfcm, topic sends have no per token results.
+        response['results'] = []
+        response['topic_message_id'] = result.get('message_id')
+        return response
+
+    def _manage_topic(self, action, registration_ids, topic_name, retry_auth=True) -> bool:
+        access_token = self.credentials.get_token(self.session, self.timeout)
+        response = self.session.post(
+            '{}:{}'.format(self.iid_url, action),
+            json={'to': '/topics/' + topic_name, 'registration_tokens': registration_ids},
+            headers={'Authorization': 'Bearer ' + access_token, 'access_token_auth': 'true'},
+            timeout=self.timeout,
+        )
+        if response.status_code == 200:
+            return True
+        if response.status_code == 401:
+            self.credentials.invalidate(access_token)
+            if retry_auth:
+                return self._manage_topic(action, registration_ids, topic_name, retry_auth=False)
+            raise AuthenticationError("There was an error authenticating the sender account")
+        if response.status_code == 400:
+            raise InvalidDataError(response.text)
+        raise FCMServerError("FCM topic management is temporarily unavailable ({})".format(response.status_code))
+
+    def subscribe_registration_ids_to_topic(self, registration_ids, topic_name) -> bool:
+        return self._manage_topic('batchAdd', registration_ids, topic_name)
+
+    def unsubscribe_registration_ids_from_topic(self, registration_ids, topic_name) -> bool:
+        return self._manage_topic('batchRemove', registration_ids, topic_name)
+
+
+_lock = threading.Lock()
+_transport = None
+
+
+def _reset_after_fork():
+    # The session's sockets and the executor's threads do not survive a fork.
+    global _lock, _transport
+    _lock = threading.Lock()
+    _transport = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_transport() -> FCMv1Transport:
+    '''
+        Returns the process wide transport, created on first use.
+    '''
+    global _transport
+    if _transport is None:
+        with _lock:
+            if _transport is None:
+                if not settings.FCM_V1_SERVICE_ACCOUNT_FILE:
+                    raise AuthenticationError("FCM_V1_SERVICE_ACCOUNT_FILE is not set")
+                _transport = FCMv1Transport(
+                    ServiceAccountCredentials.from_file(settings.FCM_V1_SERVICE_ACCOUNT_FILE),
+                    project_id=settings.FCM_V1_PROJECT_ID,
+                    endpoint_url=settings.FCM_V1_ENDPOINT_URL,
+                    max_connections=settings.FCM_V1_MAX_CONNECTIONS,
+                    timeout=settings.FCM_V1_TIMEOUT,
+                    iid_endpoint_url=settings.FCM_V1_IID_ENDPOINT_URL,
+                )
+    return _transport
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SNSEndpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform_application_arn', models.CharField(max_length=255)),
+                ('device_token', models.CharField(max_length=1024)),
+                ('endpoint_arn', models.CharField(max_length=255)),
+                ('verified_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('platform_application_arn', 'device_token')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+
+
+class SNSEndpoint(models.Model):
+    '''
+        SNS platform endpoint of a device token (apps/notifications/sns_endpoints.py).
+        Lets SNS.registerWithSNS publish without CreatePlatformEndpoint / GetEndpointAttributes
+        until verified_at is older than SNS_ENDPOINT_VERIFY_AFTER or a publish fails on the endpoint.
+    '''
+    platform_application_arn = models.CharField(max_length=255)
+    device_token = models.CharField(max_length=1024)
+    endpoint_arn = models.CharField(max_length=255)
+    # When registerWithSNS last made sure the endpoint has the device token and is enabled, null once invalidated.
+    verified_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('platform_application_arn', 'device_token'),)
+
+    def __str__(self):
+        return self.endpoint_arn
@@ -1,5 +1,4 @@
 import logging
-import boto3
 
 from botocore.exceptions import (
     ClientError,
@@ -8,6 +7,8 @@ from botocore.exceptions import (
     EndpointConnectionError
 )
 
+from django.conf import settings
+
 from apps.notifications.utils import (
     EmailIdentityNotVerified,
     SESInvalidRegionName,
@@ -21,6 +22,7 @@ from apps.notifications.settings import (
     AWS_DEFAULT_REGION,
     AWS_SES_EMAIL_IDENTITY
 )
+from apps.tasks.aws import get_client
 
 logger = logging.getLogger(__name__)
 
@@ -67,11 +69,13 @@ class SES(object):
                 using AWS SES credentials taken from env variables.
         '''
         try:
-            return boto3.client(
+            # Shared pooled client, built once per process (see apps/tasks/aws.py)
+            return get_client(
                 'ses',
                 aws_access_key_id=AWS_ACCESS_KEY_ID,
                 aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                region_name=AWS_DEFAULT_REGION
+                region_name=AWS_DEFAULT_REGION,
+                endpoint_url=settings.AWS_SES_ENDPOINT_URL
             )
         except ValueError as error:
             log_msg = '[SES] region_name is Invalid while creating client. - Error-{}'.format(error)
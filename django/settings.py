@@ -74,6 +74,8 @@ THIRD_PARTY_APPS = [
 ]
 
 LOCAL_APPS = [
+    'apps.tasks',  # Queueable tasks (SQS/Celery)
+    'apps.notifications.apps.NotificationsConfig',  # Push / email notifications (SNS endpoints)
 ]
 
 
@@ -147,6 +149,9 @@ DATABASES = {
         'PASSWORD': env('DJANGO_DB_PASSWORD', default='postgres'),
         'HOST': env('DJANGO_DB_HOST', default='postgres'),
         'PORT': env('DJANGO_DB_PORT', default='5432'),
+        # Seconds a connection is reused. Keep 0 for the gevent web workers, whose greenlets would
+        # leave their connections open; set it for the SQS consumer, whose pool threads live long.
+        'CONN_MAX_AGE': env.int('DJANGO_DB_CONN_MAX_AGE', default=0),
     }
 }
 
@@ -371,6 +376,105 @@ QUEUE_TYPE = env('QUEUE_TYPE', default='celery')  # or 'sqs' for ElasticBeanstal
 CELERY_BROKER_URL = env('CELERY_BROKER_URL', default='redis://redis:6379')
 SQS_REGION = env('SQS_REGION', default='')
 SQS_QUEUE_NAME = env('SQS_QUEUE_NAME', default='')
+SQS_ENDPOINT_URL = env('SQS_ENDPOINT_URL', default=None)  # local stand-in, eg. ElasticMQ http://elasticmq:9324
+# Local stand-ins of SES / SNS, eg. the load test fakes http://fakes:9000
+AWS_SES_ENDPOINT_URL = env('AWS_SES_ENDPOINT_URL', default=None)
+AWS_SNS_ENDPOINT_URL = env('AWS_SNS_ENDPOINT_URL', default=None)
+# Endpoint ARNs of the SNS device tokens (apps/notifications/sns_endpoints.py), in postgres and SNS_ENDPOINT_CACHE
+SNS_ENDPOINT_CACHE_ENABLED = env.bool('SNS_ENDPOINT_CACHE_ENABLED', default=True)
+SNS_ENDPOINT_CACHE = env('SNS_ENDPOINT_CACHE', default='default')
+SNS_ENDPOINT_CACHE_TTL = env.int('SNS_ENDPOINT_CACHE_TTL', default=24 * 60 * 60)  # seconds
+# Seconds before the attributes of a cached endpoint are checked again (GetEndpointAttributes)
+SNS_ENDPOINT_VERIFY_AFTER = env.int('SNS_ENDPOINT_VERIFY_AFTER', default=7 * 24 * 60 * 60)
+
+# Priority lanes (QueueableTask.QUEUE), lanes share the default queues unless configured.
+TASK_QUEUES = {
+    'default': {'sqs': SQS_QUEUE_NAME, 'celery': 'celery', 'weight': 1},
+    'interactive': {
+        'sqs': env('SQS_INTERACTIVE_QUEUE_NAME', default=SQS_QUEUE_NAME),
+        'celery': env('CELERY_INTERACTIVE_QUEUE', default='celery'),
+        'weight': env.int('TASK_INTERACTIVE_LANE_WEIGHT', default=3),
+    },
+    'bulk': {
+        'sqs': env('SQS_BULK_QUEUE_NAME', default=SQS_QUEUE_NAME),
+        'celery': env('CELERY_BULK_QUEUE', default='celery'),
+        'weight': env.int('TASK_BULK_LANE_WEIGHT', default=1),
+    },
+}
+
+# Transactional outbox: queue() writes to the TaskOutbox table (sqs) or publishes on commit (celery)
+TASK_OUTBOX_ENABLED = env.bool('TASK_OUTBOX_ENABLED', default=False)
+TASK_OUTBOX_RELAY_BATCH_SIZE = env.int('TASK_OUTBOX_RELAY_BATCH_SIZE', default=500)
+TASK_OUTBOX_MAX_ATTEMPTS = env.int('TASK_OUTBOX_MAX_ATTEMPTS', default=10)
+# Seconds a relay owns the rows it claimed, longer than a batch send with its retries; then they are sent again
+TASK_OUTBOX_LEASE_SECONDS = env.int('TASK_OUTBOX_LEASE_SECONDS', default=300)
+
+# SQS circuit breaker and local spill journal (messages which could not be sent, replayed by replay_task_spill)
+TASK_SQS_BREAKER_FAILURES = env.int('TASK_SQS_BREAKER_FAILURES', default=5)  # consecutive failures opening the breaker
+TASK_SQS_BREAKER_RESET_TIMEOUT = env.int('TASK_SQS_BREAKER_RESET_TIMEOUT', default=30)  # seconds
+# Persistent volume shared by the producers and replay_task_spill, spilling is disabled when empty
+TASK_SPILL_DIR = env('TASK_SPILL_DIR', default='')
+TASK_SPILL_SEGMENT_BYTES = env.int('TASK_SPILL_SEGMENT_BYTES', default=16 * 1024 * 1024)
+TASK_SPILL_FSYNC_EVERY = env.int('TASK_SPILL_FSYNC_EVERY', default=100)  # records
+TASK_SPILL_FSYNC_INTERVAL = env.float('TASK_SPILL_FSYNC_INTERVAL', default=0.2)  # seconds
+TASK_SPILL_REPLAY_BATCH_SIZE = env.int('TASK_SPILL_REPLAY_BATCH_SIZE', default=500)
+
+# Delayed tasks (QueueableTask.queue_in / queue_at), longer delays are held in a redis sorted set
+TASK_SCHEDULER_CACHE = env('TASK_SCHEDULER_CACHE', default='default')
+# Capped at 900 seconds, the SQS DelaySeconds limit
+TASK_SCHEDULER_MAX_NATIVE_DELAY = min(env.int('TASK_SCHEDULER_MAX_NATIVE_DELAY', default=900), 900)
+TASK_SCHEDULER_BATCH_SIZE = env.int('TASK_SCHEDULER_BATCH_SIZE', default=500)
+# Seconds before a claimed task which was not queued is claimed again
+TASK_SCHEDULER_LEASE = env.int('TASK_SCHEDULER_LEASE', default=300)
+
+# Load test task and enqueue endpoint (loadtest/readme.md), never enable in production
+TASK_LOADTEST_ENABLED = env.bool('TASK_LOADTEST_ENABLED', default=False)
+
+# Admission control of eb_index: tasks in flight per process, and seconds a task may wait for a slot before a 429
+TASK_MAX_IN_FLIGHT = env.int('TASK_MAX_IN_FLIGHT', default=100)
+TASK_ADMISSION_QUEUE_BUDGET = env.float('TASK_ADMISSION_QUEUE_BUDGET', default=1.0)
+
+# Idempotent execution of SQS tasks: completed task ids / idempotency keys are remembered for TASK_IDEMPOTENCY_TTL
+TASK_IDEMPOTENCY_CACHE = env('TASK_IDEMPOTENCY_CACHE', default='default')
+TASK_IDEMPOTENCY_TTL = env.int('TASK_IDEMPOTENCY_TTL', default=24 * 60 * 60)  # seconds
+# Seconds the running marker outlives its worker, refreshed while the task runs
+TASK_IDEMPOTENCY_LOCK_TIMEOUT = env.int('TASK_IDEMPOTENCY_LOCK_TIMEOUT', default=15 * 60)
+
+# Cache holding the coalescing markers (QueueableTask.COALESCE_WINDOW)
+TASK_COALESCE_CACHE = env('TASK_COALESCE_CACHE', default='default')
+
+# Redis connection holding the task rate limit buckets (QueueableTask.RATE_LIMIT)
+TASK_RATE_LIMIT_CACHE = env('TASK_RATE_LIMIT_CACHE', default='default')
+TASK_RATE_LIMIT_DEFER_JITTER = env.int('TASK_RATE_LIMIT_DEFER_JITTER', default=5)  # seconds
+TASK_RATE_LIMIT_MAX_DEFER = env.int('TASK_RATE_LIMIT_MAX_DEFER', default=300)  # seconds
+
+# Redis connection holding the fleet wide task metrics (served at <tasks url>/metrics/)
+TASK_METRICS_CACHE = env('TASK_METRICS_CACHE', default='default')
+TASK_METRICS_GAUGE_TTL = env.int('TASK_METRICS_GAUGE_TTL', default=60)  # seconds a dead process' gauges are kept
+
+# Task payload codec (apps/tasks/codec.py): 'json' (orjson when installed) or 'msgpack'
+TASK_PAYLOAD_CODEC = env('TASK_PAYLOAD_CODEC', default='json')
+
+# Large task payloads are compressed, then offloaded to storage (apps/tasks/envelope.py)
+TASK_PAYLOAD_COMPRESS_THRESHOLD = env.int('TASK_PAYLOAD_COMPRESS_THRESHOLD', default=8 * 1024)
+TASK_PAYLOAD_MAX_BYTES = env.int('TASK_PAYLOAD_MAX_BYTES', default=240 * 1024)  # SQS message limit is 256 KB
+TASK_PAYLOAD_COMPRESSION = env('TASK_PAYLOAD_COMPRESSION', default='zlib')  # or 'zstd' (needs zstandard)
+TASK_PAYLOAD_STORAGE = env('TASK_PAYLOAD_STORAGE', default=None)  # storage class path, DEFAULT_FILE_STORAGE if unset
+
+# Bounded pool used by the batch endpoint (apps/tasks/eb_worker.py: eb_batch)
+TASK_BATCH_MAX_WORKERS = env.int('TASK_BATCH_MAX_WORKERS', default=8)
+TASK_BATCH_MAX_MESSAGES = env.int('TASK_BATCH_MAX_MESSAGES', default=100)
+
+# Long polling consumer (python manage.py sqs_consumer)
+SQS_CONSUMER_WORKERS = env.int('SQS_CONSUMER_WORKERS', default=10)
+SQS_CONSUMER_VISIBILITY_TIMEOUT = env.int('SQS_CONSUMER_VISIBILITY_TIMEOUT', default=60)
+SQS_CONSUMER_DEAD_LETTER_QUEUE = env('SQS_CONSUMER_DEAD_LETTER_QUEUE', default='')  # queue name of the poison messages
+
+# Pooled AWS clients shared by SQS, SES and SNS (apps/tasks/aws.py)
+AWS_CLIENT_MAX_POOL_CONNECTIONS = env.int('AWS_CLIENT_MAX_POOL_CONNECTIONS', default=50)
+AWS_CLIENT_CONNECT_TIMEOUT = env.int('AWS_CLIENT_CONNECT_TIMEOUT', default=5)
+AWS_CLIENT_READ_TIMEOUT = env.int('AWS_CLIENT_READ_TIMEOUT', default=30)
+AWS_CLIENT_MAX_ATTEMPTS = env.int('AWS_CLIENT_MAX_ATTEMPTS', default=3)
 
 
 # -------------------------------------------------------------------------------
@@ -430,6 +534,35 @@ SWAGGER_SETTINGS = {
 # Google Firebase Cloud Messaging Settings
 # -------------------------------------------------------------------------------
 FCM_SERVER_KEY = env('FCM_SERVER_KEY', default='')
+# Local stand-in of the legacy API, eg. the load test fakes http://fakes:9000/fcm/send
+FCM_ENDPOINT_URL = env('FCM_ENDPOINT_URL', default=None)
+# 'legacy' (pyfcm, FCM_SERVER_KEY) or 'v1' (HTTP v1 API with a service account, apps/notifications/fcm_v1.py)
+FCM_TRANSPORT = env('FCM_TRANSPORT', default='legacy')
+FCM_V1_SERVICE_ACCOUNT_FILE = env('FCM_V1_SERVICE_ACCOUNT_FILE', default='')
+FCM_V1_PROJECT_ID = env('FCM_V1_PROJECT_ID', default=None)  # defaults to the project_id of the service account
+FCM_V1_ENDPOINT_URL = env('FCM_V1_ENDPOINT_URL', default='https://fcm.googleapis.com')
+FCM_V1_MAX_CONNECTIONS = env.int('FCM_V1_MAX_CONNECTIONS', default=64)  # pooled connections and concurrent requests
+FCM_V1_TIMEOUT = env.float('FCM_V1_TIMEOUT', default=10)
+FCM_V1_IID_ENDPOINT_URL = env('FCM_V1_IID_ENDPOINT_URL', default='https://iid.googleapis.com')  # topic subscriptions
+FCM_SEND_CONCURRENCY = env.int('FCM_SEND_CONCURRENCY', default=8)  # chunks of one notification sent in parallel
+# Legacy API errors with a Retry-After header: chunks wait out the delay and retry,
+# unless it is longer than FCM_RETRY_AFTER_MAX_DELAY seconds
+FCM_RETRY_AFTER_ATTEMPTS = env.int('FCM_RETRY_AFTER_ATTEMPTS', default=3)
+FCM_RETRY_AFTER_MAX_DELAY = env.int('FCM_RETRY_AFTER_MAX_DELAY', default=30)
+# Invalid token pruning (apps/notifications/fcm_tokens.py), on the project's device model "app_label.ModelName"
+FCM_PRUNE_TOKENS = env.bool('FCM_PRUNE_TOKENS', default=True)
+FCM_DEVICE_MODEL = env('FCM_DEVICE_MODEL', default=None)
+FCM_DEVICE_TOKEN_FIELD = env('FCM_DEVICE_TOKEN_FIELD', default='registration_id')
+FCM_DEVICE_ACTIVE_FIELD = env('FCM_DEVICE_ACTIVE_FIELD', default='active')
+FCM_PRUNE_BATCH_SIZE = env.int('FCM_PRUNE_BATCH_SIZE', default=1000)
+# Resend of the tokens which failed on a transient error (apps/notifications/fcm_resend.py)
+FCM_RESEND_ENABLED = env.bool('FCM_RESEND_ENABLED', default=True)
+FCM_RESEND_MAX_ATTEMPTS = env.int('FCM_RESEND_MAX_ATTEMPTS', default=5)
+FCM_RESEND_BASE_DELAY = env.int('FCM_RESEND_BASE_DELAY', default=30)  # seconds, doubled on each attempt
+FCM_RESEND_MAX_DELAY = env.int('FCM_RESEND_MAX_DELAY', default=900)
+FCM_RESEND_BATCH_SIZE = env.int('FCM_RESEND_BATCH_SIZE', default=900)  # tokens per resend task
+# Topic subscriptions: tokens per subscribe/unsubscribe request, FCM accepts at most 1000
+FCM_TOPIC_BATCH_SIZE = min(env.int('FCM_TOPIC_BATCH_SIZE', default=1000), 1000)
 
 # -------------------------------------------------------------------------------
 # AWS Simple Email Service
@@ -511,7 +644,7 @@ EMAIL_HOST_USER = env('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD', default='')
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL', default='')
 DEFAULT_EMAIL_RECIEVERS = env.list('DEFAULT_EMAIL_RECIEVERS', default=[])
-EMAIL_USE_TLS = True
+EMAIL_USE_TLS = env.bool('EMAIL_USE_TLS', default=True)
 
 # ----------------------------------------------------------------------------------
 # Store links
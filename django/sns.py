@@ -1,5 +1,4 @@
 import logging
-import boto3
 import re
 from botocore.exceptions import (
     ClientError,
@@ -8,6 +7,8 @@ from botocore.exceptions import (
     NoCredentialsError
 )
 
+from django.conf import settings
+
 from apps.notifications.utils import (
     SNSInvalidRegionName,
     SNSPlatformApplicationArnNotEnabled,
@@ -26,6 +27,8 @@ from apps.notifications.settings import (
 )
 
 from loyalty_core_models.audit_core.models import Notification
+from apps.tasks.aws import get_client
+from apps.notifications import sns_endpoints
 
 logger = logging.getLogger(__name__)
 
@@ -81,11 +84,13 @@ class SNS(object):
                 using AWS SNS default region taken from env variable.
         '''
         try:
-            return boto3.client(
+            # Shared pooled client, built once per process (see apps/tasks/aws.py)
+            return get_client(
                 'sns',
                 aws_access_key_id=AWS_ACCESS_KEY_ID,
                 aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                region_name=AWS_DEFAULT_REGION
+                region_name=AWS_DEFAULT_REGION,
+                endpoint_url=settings.AWS_SNS_ENDPOINT_URL
             )
         except ValueError as error:
             log_msg = '[ SNS ] region_name is Invalid while creating client. Error - {}'.format(error)
@@ -152,6 +157,12 @@ class SNS(object):
                     return False
         return True
 
+    def get_platform_application_arn(self, device_type):
+        if device_type == Notification.ANDROID:
+            return self._platform_application_arn_android
+        elif device_type == Notification.IOS:
+            return self._platform_application_arn_ios
+
     def create_platform_endpoint_arn(self, device_type, device_token, custom_user_data):
         '''
             This method performs the first required call before publishing the message.
@@ -161,10 +172,7 @@ class SNS(object):
                     that endpoint's ARN is returned without creating a new endpoint.
             https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Client.create_platform_endpoint
         '''
-        if device_type == Notification.ANDROID:
-            platform_application_arn = self._platform_application_arn_android
-        elif device_type == Notification.IOS:
-            platform_application_arn = self._platform_application_arn_ios
+        platform_application_arn = self.get_platform_application_arn(device_type)
 
         endpointArn = None
         try:
@@ -215,7 +223,17 @@ class SNS(object):
             4. If PlatformEndpoint needed any updates for attributes then set the new attributes for new token.
 
             Refer : https://aws.amazon.com/blogs/mobile/mobile-token-management-with-amazon-sns
+
+        The endpoint ARN of device_token is cached (see sns_endpoints.py): a fresh entry is used
+        as is, the attributes are only verified when the entry is stale or was invalidated.
         '''
+        platform_application_arn = self.get_platform_application_arn(device_type)
+        cached = sns_endpoints.get(platform_application_arn, device_token)
+        if cached is not None:
+            self.endpoint_arn = cached['endpoint_arn']
+            if sns_endpoints.is_fresh(cached):
+                return
+
         endpointArn = self.endpoint_arn  # calling the getter method
         updateNeeded = False
         createNeeded = endpointArn is None
@@ -237,11 +255,20 @@ class SNS(object):
             createNeeded = True
 
         if createNeeded:
-            self.create_platform_endpoint_arn(device_type, device_token, custom_user_data)
+            endpointArn = self.create_platform_endpoint_arn(device_type, device_token, custom_user_data)
 
         if updateNeeded:
             self._set_endpoint_attributes(endpointArn, device_token)
 
+        sns_endpoints.store(platform_application_arn, device_token, endpointArn)
+
+    def _publish(self, message):
+        return self.client.publish(
+            TargetArn=self.endpoint_arn,  # This attribute is returned from getter method for _endpoint_arn
+            MessageStructure='json',
+            Message=message
+        )
+
     def publish(self, device_type, device_token, custom_user_data, message):
         '''
             This method publishes the message provided to the TargetArn or EndpointArn.
@@ -251,11 +278,14 @@ class SNS(object):
 
         logger.info("[ SNS ] publish - {} to customer - {}".format(message, custom_user_data))
 
-        response = self.client.publish(
-            TargetArn=self.endpoint_arn,  # This attribute is returned from getter method for _endpoint_arn
-            MessageStructure='json',
-            Message=message
-        )
+        try:
+            response = self._publish(message)
+        except (self.client.exceptions.EndpointDisabledException, self.client.exceptions.NotFoundException) as error:
+            # The cached endpoint was disabled or deleted since it was verified: verify it again and retry once.
+            logger.info("[ SNS ] endpoint {} failed, registering again. Error - {}".format(self.endpoint_arn, error))
+            sns_endpoints.invalidate(self.get_platform_application_arn(device_type), device_token)
+            self.registerWithSNS(device_type, device_token, custom_user_data)
+            response = self._publish(message)
 
         if response['MessageId']:
             logger.info("Push Notification Sent...")
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+'''
+    Endpoint ARNs of the SNS device tokens, so publishing to a known device skips
+    CreatePlatformEndpoint and GetEndpointAttributes (see SNS.registerWithSNS).
+    Entries are kept in Postgres (apps.notifications.models.SNSEndpoint) with a read-through layer
+    in SNS_ENDPOINT_CACHE for SNS_ENDPOINT_CACHE_TTL:
+        sns:endpoint:<sha1 of platform application arn and device token>
+            {'endpoint_arn', 'verified_at' (epoch seconds or None)}
+    An entry is stored once registerWithSNS made sure the endpoint has the device token and is
+    enabled, and is fresh while it was verified less than SNS_ENDPOINT_VERIFY_AFTER seconds ago.
+    A publish failing with EndpointDisabled / NotFound invalidates the entry, so the endpoint is
+    verified again.
+    Cache and database errors are logged, the endpoint is then registered as if not cached.
+'''
+
+CACHE_KEY = 'sns:endpoint:{}'
+
+
+def get_cache():
+    return caches[settings.SNS_ENDPOINT_CACHE]
+
+
+def cache_key(platform_application_arn, device_token) -> str:
+    digest = hashlib.sha1('{}\n{}'.format(platform_application_arn, device_token).encode('utf-8')).hexdigest()
+    return CACHE_KEY.format(digest)
+
+
+def to_entry(endpoint) -> dict:
+    return {
+        'endpoint_arn': endpoint.endpoint_arn,
+        'verified_at': endpoint.verified_at.timestamp() if endpoint.verified_at else None,
+    }
+
+
+def cache_set(key, entry):
+    try:
+        get_cache().set(key, entry, timeout=settings.SNS_ENDPOINT_CACHE_TTL)
+    except Exception as error:
+        logger.error("[ SNS ] endpoint cache unavailable: {!r}".format(error))
+
+
+def get(platform_application_arn, device_token):
+    '''
+        Returns the entry of device_token, or None if its endpoint is not known.
+    '''
+    if not settings.SNS_ENDPOINT_CACHE_ENABLED:
+        return None
+    from apps.notifications.models import SNSEndpoint
+
+    key = cache_key(platform_application_arn, device_token)
+    try:
+        entry = get_cache().get(key)
+        if entry is not None:
+            return entry
+    except Exception as error:
+        logger.error("[ SNS ] endpoint cache unavailable: {!r}".format(error))
+
+    try:
+        endpoint = SNSEndpoint.objects.filter(
+            platform_application_arn=platform_application_arn, device_token=device_token).first()
+    except DatabaseError as error:
+        logger.error("[ SNS ] reading the endpoint of a device failed: {!r}".format(error))
+        return None
+    if endpoint is None:
+        return None
+
+    entry = to_entry(endpoint)
+    cache_set(key, entry)
+    return entry
+
+
+def is_fresh(entry) -> bool:
+    return entry['verified_at'] is not None and time.time() - entry['verified_at'] < settings.SNS_ENDPOINT_VERIFY_AFTER
+
+
+def store(platform_application_arn, device_token, endpoint_arn):
+    '''
+        Records endpoint_arn as the verified endpoint of device_token, to be called once it was
+        created for the token or its Token and Enabled attributes were checked (and set when needed).
+    '''
+    if not settings.SNS_ENDPOINT_CACHE_ENABLED or not endpoint_arn:
+        return
+    from apps.notifications.models import SNSEndpoint
+
+    try:
+        endpoint, _ = SNSEndpoint.objects.update_or_create(
+            platform_application_arn=platform_application_arn,
+            device_token=device_token,
+            defaults={
+                'endpoint_arn': endpoint_arn,
+                'verified_at': datetime.now(timezone.utc),
+            },
+        )
+    except DatabaseError as error:
+        logger.error("[ SNS ] storing the endpoint of a device failed: {!r}".format(error))
+        return
+    cache_set(cache_key(platform_application_arn, device_token), to_entry(endpoint))
+
+
+def invalidate(platform_application_arn, device_token):
+    '''
+        Marks the endpoint of device_token as unverified, the ARN is kept for the next verification.
+    '''
+    if not settings.SNS_ENDPOINT_CACHE_ENABLED:
+        return
+    from apps.notifications.models import SNSEndpoint
+
+    try:
+        SNSEndpoint.objects.filter(
+            platform_application_arn=platform_application_arn, device_token=device_token).update(verified_at=None)
+    except DatabaseError as error:
+        logger.error("[ SNS ] invalidating the endpoint of a device failed: {!r}".format(error))
+    try:
+        get_cache().delete(cache_key(platform_application_arn, device_token))
+    except Exception as error:
+        logger.error("[ SNS ] endpoint cache unavailable: {!r}".format(error))
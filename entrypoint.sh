@@ -36,7 +36,13 @@ if [ -z $cmd ]; then
     python manage.py migrate --noinput
   # start server
   >&2 echo "Running Backend Server...(gunicorn)"
-    gunicorn config.wsgi -w 4 -b 0.0.0.0:8000 -t 12000 -k gevent --chdir=/app
+    # Tune with the load test harness (loadtest/readme.md)
+    gunicorn config.wsgi \
+      -w ${GUNICORN_WORKERS:-4} \
+      -k ${GUNICORN_WORKER_CLASS:-gevent} \
+      --worker-connections ${GUNICORN_WORKER_CONNECTIONS:-1000} \
+      -t ${GUNICORN_TIMEOUT:-12000} \
+      -b 0.0.0.0:8000 --chdir=/app
 else
   >&2 echo "Running command passed (by the compose file)"
   exec $cmd
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import re
+
+'''
+    Helpers shared by the load test driver and the fake services.
+'''
+
+# Stamped in every load test notification by apps.tasks.loadtest.LoadTestNotification
+SENT_AT_PATTERN = re.compile(r'loadtest-sent-at=([0-9]+(?:\.[0-9]+)?)')
+
+
+def percentiles(values, points=(50, 90, 95, 99)) -> dict:
+    '''
+        Nearest-rank percentiles of values (seconds) plus min/max/mean, in milliseconds.
+    '''
+    if not values:
+        return {}
+    ordered = sorted(values)
+    summary = {
+        'min_ms': ordered[0] * 1000,
+        'max_ms': ordered[-1] * 1000,
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+    }
+    for point in points:
+        rank = max(0, min(len(ordered) - 1, int(round(point / 100.0 * len(ordered))) - 1))
+        summary['p{}_ms'.format(point)] = ordered[rank] * 1000
+    return summary
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from loadtest.common import percentiles
+
+logger = logging.getLogger(__name__)
+
+'''
+    Load driver: POSTs {"channel": ...} to the load test endpoint (apps.tasks.loadtest) with a fixed
+    number of concurrent clients, for a number of requests or a duration, optionally capped to a
+    request rate. Reports the enqueue throughput, latency percentiles and error rate, then waits for
+    the fake services to receive the notifications and reports the end-to-end delivery figures.
+
+        python -m loadtest.driver --url http://localhost:8000/tasks/loadtest/ --fakes-url http://localhost:9000 \\
+            --channel fcm --concurrency 50 --duration 60 --label "gevent w4 c1000" --output results.json
+'''
+
+
+class LoadDriver:
+
+    def __init__(self, url, channel, concurrency, requests=None, duration=None, rate=None, timeout=30):
+        self.url = url
+        self.channel = channel
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.rate = rate
+        self.timeout = timeout
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.sent = 0
+
+    def _next_slot(self, started_at):
+        '''
+            Claims the next request, returns its scheduled start time or None once the run is over.
+        '''
+        now = time.monotonic()
+        if self.requests is not None and self.sent >= self.requests:
+            return None
+        if self.duration is not None and now - started_at >= self.duration:
+            return None
+        slot = started_at + self.sent / self.rate if self.rate else now
+        self.sent += 1
+        return slot
+
+    async def client(self, session, started_at):
+        body = json.dumps({'channel': self.channel})
+        headers = {'Content-Type': 'application/json'}
+        while True:
+            slot = self._next_slot(started_at)
+            if slot is None:
+                return
+            delay = slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            request_started_at = time.monotonic()
+            try:
+                async with session.post(self.url, data=body, headers=headers) as response:
+                    await response.read()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logger.debug("Request failed: {}".format(error))
+                self.errors += 1
+                continue
+            self.latencies.append(time.monotonic() - request_started_at)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    async def run(self) -> dict:
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            started_at = time.monotonic()
+            await asyncio.gather(*[self.client(session, started_at) for _ in range(self.concurrency)])
+            elapsed = time.monotonic() - started_at
+
+        accepted = self.statuses.get(202, 0)
+        return {
+            'requests': self.sent,
+            'accepted': accepted,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'connection_errors': self.errors,
+            'error_rate': (self.sent - accepted) / self.sent if self.sent else 0.0,
+            'elapsed_seconds': elapsed,
+            'throughput': accepted / elapsed if elapsed else 0.0,
+            'latency': percentiles(self.latencies),
+        }
+
+
+async def fakes_stats(fakes_url, reset=False) -> dict:
+    async with aiohttp.ClientSession() as session:
+        if reset:
+            async with session.post('{}/stats/reset'.format(fakes_url)) as response:
+                response.raise_for_status()
+            return {}
+        async with session.get('{}/stats'.format(fakes_url)) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+async def drain(fakes_url, channel, accepted, drain_timeout) -> dict:
+    '''
+        Polls the fake services until every accepted notification was delivered or drain_timeout passed.
+    '''
+    deadline = time.monotonic() + drain_timeout
+    while True:
+        stats = await fakes_stats(fakes_url)
+        service = stats['services'].get(channel, {})
+        if service.get('delivered', 0) >= accepted or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(1)
+
+    delivered = service.get('delivered', 0)
+    return {
+        'delivered': delivered,
+        'provider_requests': service.get('requests', 0),
+        'provider_errors': service.get('errors', 0),
+        'lost': max(0, accepted - delivered),
+        'elapsed_seconds': stats['elapsed_seconds'],
+        'throughput': delivered / stats['elapsed_seconds'] if stats['elapsed_seconds'] else 0.0,
+        'latency': service.get('end_to_end', {}),
+    }
+
+
+def print_report(report):
+    enqueue = report['enqueue']
+    print('\n[ {} ] channel={} concurrency={}'.format(
+        report['label'] or 'load test', report['channel'], report['concurrency']))
+    print('enqueue   {:>8} requests  {:>8} accepted  {:>9.1f} req/s  error rate {:.2%}  statuses {}'.format(
+        enqueue['requests'], enqueue['accepted'], enqueue['throughput'], enqueue['error_rate'], enqueue['statuses']))
+    print('          latency ms  {}'.format(_format_percentiles(enqueue['latency'])))
+    delivery = report.get('delivery')
+    if delivery:
+        print('delivery  {:>8} delivered {:>8} lost      {:>9.1f} msg/s  provider errors {}'.format(
+            delivery['delivered'], delivery['lost'], delivery['throughput'], delivery['provider_errors']))
+        print('          end to end ms {}'.format(_format_percentiles(delivery['latency'])))
+
+
+def _format_percentiles(values) -> str:
+    return '  '.join('{} {:.1f}'.format(key, value) for key, value in values.items() if key != 'count')
+
+
+async def main_async(options) -> dict:
+    if options.fakes_url:
+        await fakes_stats(options.fakes_url, reset=True)
+
+    driver = LoadDriver(
+        options.url, options.channel, options.concurrency,
+        requests=options.requests, duration=options.duration, rate=options.rate, timeout=options.timeout,
+    )
+    report = {
+        'label': options.label,
+        'url': options.url,
+        'channel': options.channel,
+        'concurrency': options.concurrency,
+        'rate': options.rate,
+        'enqueue': await driver.run(),
+    }
+    if options.fakes_url:
+        report['delivery'] = await drain(
+            options.fakes_url, options.channel, report['enqueue']['accepted'], options.drain_timeout)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drives the load test endpoint and reports throughput and latency.')
+    parser.add_argument('--url', default='http://localhost:8000/tasks/loadtest/')
+    parser.add_argument('--channel', default='fcm', choices=('fcm', 'sns', 'ses', 'smtp'))
+    parser.add_argument('--concurrency', type=int, default=20, help='Concurrent clients.')
+    parser.add_argument('--requests', type=int, help='Total requests, defaults to 1000 unless --duration is given.')
+    parser.add_argument('--duration', type=float, help='Seconds to run for.')
+    parser.add_argument('--rate', type=float, help='Requests per second cap across all clients (open loop).')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds before a request is counted as failed.')
+    parser.add_argument('--fakes-url', help='Fake services url, to measure deliveries, eg. http://localhost:9000')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='Seconds to wait for the deliveries.')
+    parser.add_argument('--label', help='Name of the configuration under test, eg. "gevent w4 c1000".')
+    parser.add_argument('--output', help='Json file the report is written to.')
+    options = parser.parse_args()
+    if options.requests is None and options.duration is None:
+        options.requests = 1000
+
+    logging.basicConfig(level=logging.INFO)
+    report = asyncio.get_event_loop().run_until_complete(main_async(options))
+    print_report(report)
+    if options.output:
+        with open(options.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
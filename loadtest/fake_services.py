@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+import uuid
+from collections import defaultdict
+
+from aiohttp import web
+
+from loadtest.common import SENT_AT_PATTERN, percentiles
+
+logger = logging.getLogger(__name__)
+
+'''
+    Local stand-ins for the notification providers, with configurable latency and failure rate:
+        POST /          SES and SNS query APIs (the calls made by apps.notifications.ses / sns)
+        POST /fcm/send  FCM legacy HTTP API (pyfcm)
+        POST /v1/projects/{project}/messages:send  FCM HTTP v1 API (apps.notifications.fcm_v1)
+        POST /token     OAuth token endpoint, the "token_uri" of a load test service account
+        POST /iid/v1:batchAdd, /iid/v1:batchRemove  FCM topic subscriptions (FCM_V1_IID_ENDPOINT_URL)
+        smtp port       minimal SMTP server (apps.notifications.django_email)
+        GET  /stats     requests, injected errors, deliveries and end-to-end latency per service
+        POST /stats/reset
+    Point the app at them with AWS_SES_ENDPOINT_URL / AWS_SNS_ENDPOINT_URL=http://fakes:9000,
+    FCM_ENDPOINT_URL=http://fakes:9000/fcm/send (or FCM_V1_ENDPOINT_URL=http://fakes:9000),
+    EMAIL_HOST=fakes EMAIL_PORT=1025 EMAIL_USE_TLS=false.
+    FCM tokens starting with "unregistered" are answered NotRegistered / UNREGISTERED.
+
+        python -m loadtest.fake_services --latency-ms 80 --jitter-ms 20 --error-rate 0.01 --service-latency fcm=40
+'''
+
+SES_XMLNS = 'http://ses.amazonaws.com/doc/2010-12-01/'
+SNS_XMLNS = 'http://sns.amazonaws.com/doc/2010-03-31/'
+
+SES_ACTIONS = {'ListIdentities', 'ListVerifiedEmailAddresses', 'SendEmail'}
+
+UNREGISTERED_PREFIX = 'unregistered'
+
+
+def _attributes(attributes) -> str:
+    return '<Attributes>{}</Attributes>'.format(''.join(
+        '<entry><key>{}</key><value>{}</value></entry>'.format(key, value) for key, value in attributes.items()))
+
+
+def _aws_response(xmlns, action, result='') -> web.Response:
+    body = (
+        '<{action}Response xmlns="{xmlns}"><{action}Result>{result}</{action}Result>'
+        '<ResponseMetadata><RequestId>{request_id}</RequestId></ResponseMetadata></{action}Response>'
+    ).format(action=action, xmlns=xmlns, result=result, request_id=uuid.uuid4())
+    return web.Response(text=body, content_type='text/xml')
+
+
+def _aws_error(code, message, status=500) -> web.Response:
+    body = (
+        '<ErrorResponse><Error><Type>{}</Type><Code>{}</Code><Message>{}</Message></Error>'
+        '<RequestId>{}</RequestId></ErrorResponse>'
+    ).format('Receiver' if status >= 500 else 'Sender', code, message, uuid.uuid4())
+    return web.Response(text=body, status=status, content_type='text/xml')
+
+
+class FakeServices:
+
+    def __init__(self, latency_ms=50, jitter_ms=10, error_rate=0.0, service_latency=None, ses_identity=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.service_latency = service_latency or {}
+        self.ses_identity = ses_identity
+        self.endpoints = {}  # SNS endpoint arn -> token
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.stats = defaultdict(lambda: {'requests': 0, 'errors': 0, 'delivered': 0, 'end_to_end': []})
+
+    async def latency(self, service):
+        mean = self.service_latency.get(service, self.latency_ms)
+        await asyncio.sleep(max(0.0, random.gauss(mean, self.jitter_ms)) / 1000.0)
+
+    def inject_error(self, service) -> bool:
+        if random.random() < self.error_rate:
+            self.stats[service]['errors'] += 1
+            return True
+        return False
+
+    def delivered(self, service, content, count=1):
+        stats = self.stats[service]
+        stats['delivered'] += count
+        match = SENT_AT_PATTERN.search(content)
+        if match:
+            stats['end_to_end'].extend([time.time() - float(match.group(1))] * count)
+
+    # -------------------------------------------------------------------------
+    # HTTP
+    # -------------------------------------------------------------------------
+    async def aws(self, request):
+        form = await request.post()
+        action = form.get('Action')
+        service = 'ses' if action in SES_ACTIONS else 'sns'
+        self.stats[service]['requests'] += 1
+        await self.latency(service)
+
+        member = '<member>{}</member>'.format(self.ses_identity)
+        if action == 'ListIdentities':
+            return _aws_response(SES_XMLNS, action, '<Identities>{}</Identities>'.format(member))
+        if action == 'ListVerifiedEmailAddresses':
+            return _aws_response(
+                SES_XMLNS, action, '<VerifiedEmailAddresses>{}</VerifiedEmailAddresses>'.format(member))
+        if action == 'SendEmail':
+            if self.inject_error(service):
+                return _aws_error('ServiceUnavailable', 'Injected failure', 503)
+            self.delivered(service, form.get('Message.Body.Text.Data', '') + form.get('Message.Body.Html.Data', ''))
+            return _aws_response(SES_XMLNS, action, '<MessageId>{}</MessageId>'.format(uuid.uuid4()))
+
+        if action == 'ListPlatformApplications':
+            return _aws_response(SNS_XMLNS, action, '<PlatformApplications/>')
+        if action == 'GetPlatformApplicationAttributes':
+            return _aws_response(SNS_XMLNS, action, _attributes({'Enabled': 'true'}))
+        if action == 'CreatePlatformEndpoint':
+            token = form['Token']
+            endpoint_arn = 'arn:aws:sns:us-east-1:000000000000:endpoint/GCM/loadtest/{}'.format(
+                hashlib.sha1(token.encode('utf-8')).hexdigest())
+            self.endpoints[endpoint_arn] = token
+            return _aws_response(SNS_XMLNS, action, '<EndpointArn>{}</EndpointArn>'.format(endpoint_arn))
+        if action == 'GetEndpointAttributes':
+            token = self.endpoints.get(form['EndpointArn'])
+            if token is None:
+                return _aws_error('NotFound', 'Endpoint does not exist', 404)
+            return _aws_response(SNS_XMLNS, action, _attributes({'Token': token, 'Enabled': 'true'}))
+        if action == 'SetEndpointAttributes':
+            entry = 1
+            while 'Attributes.entry.{}.key'.format(entry) in form:
+                if form['Attributes.entry.{}.key'.format(entry)] == 'Token':
+                    self.endpoints[form['EndpointArn']] = form['Attributes.entry.{}.value'.format(entry)]
+                entry += 1
+            return _aws_response(SNS_XMLNS, action)
+        if action == 'Publish':
+            if self.inject_error(service):
+                return _aws_error('InternalError', 'Injected failure', 500)
+            self.delivered(service, form.get('Message', ''))
+            return _aws_response(SNS_XMLNS, action, '<MessageId>{}</MessageId>'.format(uuid.uuid4()))
+
+        return _aws_error('InvalidAction', 'Action {} is not faked'.format(action), 400)
+
+    async def fcm_send(self, request):
+        raw = await request.text()
+        payload = json.loads(raw)
+        self.stats['fcm']['requests'] += 1
+        await self.latency('fcm')
+
+        if payload.get('condition') or str(payload.get('to')).startswith('/topics/'):
+            if self.inject_error('fcm'):
+                return web.json_response({'error': 'Unavailable'}, status=503)
+            self.delivered('fcm', raw)
+            return web.json_response({'message_id': random.getrandbits(48)})
+
+        tokens = payload.get('registration_ids') or [payload.get('to')]
+        results = []
+        for token in tokens:
+            if str(token).startswith(UNREGISTERED_PREFIX):
+                results.append({'error': 'NotRegistered'})
+            elif self.inject_error('fcm'):
+                results.append({'error': 'Unavailable'})
+            else:
+                results.append({'message_id': '0:{}'.format(uuid.uuid4().hex)})
+        succeeded = sum(1 for result in results if 'message_id' in result)
+        self.delivered('fcm', raw, succeeded)
+        return web.json_response({
+            'multicast_id': random.getrandbits(48),
+            'success': succeeded,
+            'failure': len(results) - succeeded,
+            'canonical_ids': 0,
+            'results': results,
+        })
+
+    async def fcm_v1_send(self, request):
+        raw = await request.text()
+        message = json.loads(raw)['message']
+        self.stats['fcm']['requests'] += 1
+        await self.latency('fcm')
+
+        if message.get('token', '').startswith(UNREGISTERED_PREFIX):
+            return self.fcm_v1_error(404, 'NOT_FOUND', 'UNREGISTERED', 'Requested entity was not found.')
+        if self.inject_error('fcm'):
+            return self.fcm_v1_error(503, 'UNAVAILABLE', 'UNAVAILABLE', 'Injected failure')
+        self.delivered('fcm', raw)
+        return web.json_response({
+            'name': 'projects/{}/messages/{}'.format(request.match_info['project'], uuid.uuid4().hex),
+        })
+
+    @classmethod
+    def fcm_v1_error(cls, status, code, error_code, message) -> web.Response:
+        return web.json_response({'error': {
+            'code': status,
+            'message': message,
+            'status': code,
+            'details': [{'@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError', 'errorCode': error_code}],
+        }}, status=status)
+
+    async def iid_batch(self, request):
+        payload = await request.json()
+        self.stats['iid']['requests'] += 1
+        await self.latency('iid')
+        tokens = payload.get('registration_tokens', [])
+        if len(tokens) > 1000:
+            return web.json_response({'error': 'Too many registration tokens'}, status=400)
+        self.stats['iid']['delivered'] += len(tokens)
+        return web.json_response({'results': [
+            {'error': 'NOT_FOUND'} if token.startswith(UNREGISTERED_PREFIX) else {} for token in tokens
+        ]})
+
+    async def oauth_token(self, request):
+        await request.post()
+        return web.json_response({
+            'access_token': 'loadtest-{}'.format(uuid.uuid4().hex), 'expires_in': 3600, 'token_type': 'Bearer',
+        })
+
+    async def get_stats(self, request):
+        elapsed = time.time() - self.started_at
+        return web.json_response({
+            'elapsed_seconds': elapsed,
+            'services': {
+                service: dict(
+                    {key: value for key, value in stats.items() if key != 'end_to_end'},
+                    end_to_end=percentiles(stats['end_to_end']),
+                ) for service, stats in self.stats.items()
+            },
+        })
+
+    async def reset_stats(self, request):
+        self.reset()
+        return web.json_response({})
+
+    # -------------------------------------------------------------------------
+    # SMTP
+    # -------------------------------------------------------------------------
+    async def smtp(self, reader, writer):
+        def reply(text):
+            writer.write(text.encode('ascii') + b'\r\n')
+
+        reply('220 fakes ESMTP')
+        data, in_data = [], False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if in_data:
+                    if line.rstrip(b'\r\n') == b'.':
+                        in_data = False
+                        self.stats['smtp']['requests'] += 1
+                        await self.latency('smtp')
+                        if self.inject_error('smtp'):
+                            reply('451 Injected failure')
+                        else:
+                            self.delivered('smtp', b''.join(data).decode('utf-8', 'replace'))
+                            reply('250 OK queued')
+                        data = []
+                    else:
+                        data.append(line)
+                    continue
+
+                command = line.split(b' ', 1)[0].strip().upper()
+                if command == b'EHLO':
+                    reply('250-fakes')
+                    reply('250-AUTH PLAIN')
+                    reply('250 OK')
+                elif command == b'AUTH':
+                    reply('235 Authentication successful')
+                elif command == b'DATA':
+                    in_data = True
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                elif command == b'QUIT':
+                    reply('221 Bye')
+                    break
+                elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                    reply('250 OK')
+                else:
+                    reply('502 Command not implemented')
+                await writer.drain()
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def parse_service_latency(value) -> dict:
+    '''
+        "ses=120,fcm=40" -> {'ses': 120.0, 'fcm': 40.0}
+    '''
+    latencies = {}
+    for item in filter(None, (value or '').split(',')):
+        service, _, latency = item.partition('=')
+        latencies[service.strip()] = float(latency)
+    return latencies
+
+
+async def serve(options):
+    fakes = FakeServices(
+        latency_ms=options.latency_ms,
+        jitter_ms=options.jitter_ms,
+        error_rate=options.error_rate,
+        service_latency=parse_service_latency(options.service_latency),
+        ses_identity=options.ses_identity,
+    )
+    app = web.Application()
+    app.router.add_post('/', fakes.aws)
+    app.router.add_post('/fcm/send', fakes.fcm_send)
+    app.router.add_post('/v1/projects/{project}/messages:send', fakes.fcm_v1_send)
+    app.router.add_post('/token', fakes.oauth_token)
+    app.router.add_post('/iid/v1:batchAdd', fakes.iid_batch)
+    app.router.add_post('/iid/v1:batchRemove', fakes.iid_batch)
+    app.router.add_get('/stats', fakes.get_stats)
+    app.router.add_post('/stats/reset', fakes.reset_stats)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, options.host, options.port).start()
+    smtp_server = await asyncio.start_server(fakes.smtp, options.host, options.smtp_port)
+    logger.info("Fake services on http://{}:{} and smtp://{}:{}".format(
+        options.host, options.port, options.host, options.smtp_port))
+    async with smtp_server:
+        await smtp_server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake SES, SNS, FCM and SMTP servers for load tests.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--smtp-port', type=int, default=1025)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Mean latency of every call.')
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help='Standard deviation of the latency.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of deliveries failing.')
+    parser.add_argument('--service-latency', help='Per service mean latency overrides, eg. ses=120,fcm=40')
+    parser.add_argument('--ses-identity', default='no-reply@example.com', help='AWS_SES_EMAIL_IDENTITY of the app.')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import boto3
+
+logger = logging.getLogger(__name__)
+
+'''
+    Stand-in for the ElasticBeanstalk worker daemon (sqsd) in front of a local SQS (ElasticMQ):
+    receives messages, POSTs each body to the worker url (apps.tasks.eb_worker.eb_index) with at
+    most --connections requests in flight, deletes the message on 200 and otherwise leaves it
+    to be redelivered after the visibility timeout, like the EB daemon does.
+
+        python -m loadtest.sqsd --queue-url http://elasticmq:9324/000000000000/tasks \\
+            --worker-url http://webserver:8000/tasks/ --connections 50
+'''
+
+
+class SQSDaemon:
+
+    def __init__(self, queue_url, worker_url, connections, endpoint_url=None, visibility_timeout=60, timeout=60):
+        self.queue_url = queue_url
+        self.worker_url = worker_url
+        self.connections = connections
+        self.visibility_timeout = visibility_timeout
+        self.timeout = timeout
+        self.client = boto3.client(
+            'sqs',
+            endpoint_url=endpoint_url,
+            region_name=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID', 'x'),
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY', 'x'),
+        )
+        # boto3 is blocking, receive and delete calls run on this pool.
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.stopping = False
+        self.counts = {'received': 0, 'ok': 0, 'rejected': 0, 'errors': 0}
+
+    async def _call(self, function, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, lambda: function(**kwargs))
+
+    async def run(self):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            pending = set()
+            while not self.stopping:
+                # Only receive what can be posted right away, like the daemon's connection limit.
+                free = self.connections - len(pending)
+                if free <= 0:
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                response = await self._call(
+                    self.client.receive_message,
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=min(10, free),
+                    WaitTimeSeconds=1,
+                    VisibilityTimeout=self.visibility_timeout,
+                )
+                for message in response.get('Messages', []):
+                    self.counts['received'] += 1
+                    pending.add(asyncio.ensure_future(self.post(session, message)))
+                pending = {task for task in pending if not task.done()}
+            if pending:
+                await asyncio.wait(pending)
+        logger.info("sqsd stopped: {}".format(self.counts))
+
+    async def post(self, session, message):
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'aws-sqsd/3.0.3',
+            'X-Aws-Sqsd-Msgid': message['MessageId'],
+            'X-Aws-Sqsd-Queue': self.queue_url.rsplit('/', 1)[-1],
+        }
+        try:
+            async with session.post(self.worker_url, data=message['Body'].encode('utf-8'), headers=headers) as response:
+                status = response.status
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logger.warning("POST of {} failed: {}".format(message['MessageId'], error))
+            self.counts['errors'] += 1
+            return
+
+        if status == 200:
+            self.counts['ok'] += 1
+            await self._call(
+                self.client.delete_message, QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+        else:
+            self.counts['rejected' if status == 429 else 'errors'] += 1
+
+    def stop(self, *args):
+        self.stopping = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the ElasticBeanstalk worker daemon.')
+    parser.add_argument('--queue-url', required=True)
+    parser.add_argument('--worker-url', required=True)
+    parser.add_argument('--endpoint-url', default=os.environ.get('SQS_ENDPOINT_URL'))
+    parser.add_argument('--connections', type=int, default=50,
+                        help='Concurrent POSTs, the EB "HTTP connections" setting.')
+    parser.add_argument('--visibility-timeout', type=int, default=60)
+    parser.add_argument('--timeout', type=int, default=60,
+                        help='Seconds before a POST is abandoned (inactivity timeout).')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    daemon = SQSDaemon(
+        options.queue_url, options.worker_url, options.connections,
+        endpoint_url=options.endpoint_url, visibility_timeout=options.visibility_timeout, timeout=options.timeout,
+    )
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, daemon.stop)
+    loop.run_until_complete(daemon.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
+import datetime
 import logging
-import json
+import math
+import time
+import uuid
 
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.tasks import coalesce, lanes, metrics, ratelimit
+from apps.tasks.codec import get_codec, get_headers, decode_payload
+from apps.tasks.envelope import pack_payload, unpack_payload, release_payload
+from apps.tasks.registry import task_registry
+
+default_app_config = 'apps.tasks.apps.TasksConfig'
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +25,22 @@ class QueueableTask:
     """
     celery_task_function = None
     ACTION_NAME = None
+    # Lane of settings.TASK_QUEUES the task is routed to, 'default' when None.
+    QUEUE = None
+    # Seconds during which duplicate enqueues (same coalesce_key) collapse into one execution.
+    COALESCE_WINDOW = None
+    # Fleet wide token bucket (tokens/second, burst size), tasks over the limit are deferred.
+    RATE_LIMIT = None
+    RATE_LIMIT_BURST = None
+    # Tasks of this action eb_index runs concurrently per process, over it they are rejected (see admission.py).
+    MAX_IN_FLIGHT = None
+
+    def __init_subclass__(cls, register=True, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Sub-classes without ACTION_NAME are treated as abstract and are not dispatchable.
+        # register=False keeps a named class out of the registry (eg. benchmark or test tasks).
+        if register and cls.ACTION_NAME is not None:
+            task_registry.register(cls)
 
     def __init__(self, immediate=False):
         # [Important] boolean variable for deciding the switching of tasks between workers.
@@ -28,15 +56,132 @@ class QueueableTask:
     def action_name(cls):
         return cls.ACTION_NAME
 
+    @classmethod
+    def coalesce_key(cls, *args, **kwargs):
+        """
+            Key identifying duplicate tasks when COALESCE_WINDOW is set, identical arguments by default.
+            Override to coalesce on a subset of the arguments, or return None to never coalesce a call.
+        """
+        return coalesce.default_coalesce_key(args, kwargs)
+
+    @classmethod
+    def claim_coalesce_key(cls, args, kwargs):
+        """
+            Returns (duplicate, key). duplicate is True when the same task is already pending
+            within COALESCE_WINDOW and must not be queued again.
+        """
+        if not cls.COALESCE_WINDOW:
+            return False, None
+        key = cls.coalesce_key(*args, **kwargs)
+        if key is None:
+            return False, None
+        if settings.TASK_OUTBOX_ENABLED:
+            # The task is only sent if the caller's transaction commits: the marker is set on commit,
+            # a rolled back enqueue must not swallow the next one.
+            if coalesce.is_pending(cls.ACTION_NAME, key):
+                return True, key
+            transaction.on_commit(lambda: coalesce.acquire(cls.ACTION_NAME, key, cls.COALESCE_WINDOW))
+            return False, key
+        return not coalesce.acquire(cls.ACTION_NAME, key, cls.COALESCE_WINDOW), key
+
+    @classmethod
+    def idempotency_key(cls, *args, **kwargs):
+        """
+            Key under which an execution is recorded as done (see idempotency.py), so a redelivered
+            or re-queued task with the same key is not run again within TASK_IDEMPOTENCY_TTL.
+            None by default: each queued task is only deduplicated against its own redeliveries.
+        """
+        return None
+
     def run(self, *args, **kwargs):
         raise NotImplementedError("Always override run method for any subclass of QueueableTask")
 
+    @staticmethod
+    def trace_headers(delay_seconds=0):
+        """
+            Trace id and enqueue time stamped on every queued task, used for queue wait metrics.
+            Delayed tasks count as enqueued when they are due, so the wait excludes the delay.
+        """
+        return {'trace_id': uuid.uuid4().hex, 'enqueued_at': time.time() + delay_seconds}
+
+    @classmethod
+    def celery_headers(cls, coalesce_key=None, delay_seconds=0):
+        """
+            Headers of a celery task: the trace headers and the coalesce key released when it starts.
+        """
+        headers = cls.trace_headers(delay_seconds)
+        if coalesce_key:
+            headers['coalesce_key'] = coalesce_key
+        return headers
+
+    @staticmethod
+    def celery_header(request, name):
+        # Custom headers are request attributes or in request.headers depending on the celery protocol.
+        return getattr(request, name, None) or (request.headers or {}).get(name)
+
+    @classmethod
+    def run_celery_task(cls, celery_task, *args, **kwargs):
+        """
+            Body of the bound celery_task_function. Applies RATE_LIMIT, re-scheduling the celery
+            task with a countdown when the action is over its limit, releases the coalesce marker
+            and records the task metrics.
+        """
+        request = celery_task.request
+        enqueued_at = cls.celery_header(request, 'enqueued_at')
+        wait_seconds = time.time() - enqueued_at if enqueued_at else None
+
+        try:
+            ratelimit.check(cls)
+        except ratelimit.TaskDeferred as deferred:
+            metrics.record_task(cls.ACTION_NAME, 'celery', 'deferred')
+            raise celery_task.retry(countdown=ratelimit.defer_delay(deferred.retry_after), max_retries=None)
+
+        coalesce_key = cls.celery_header(request, 'coalesce_key')
+        if coalesce_key:
+            # As on SQS, from now on a new enqueue must not be collapsed into this execution.
+            coalesce.release(cls.ACTION_NAME, coalesce_key)
+
+        status = 'failed'
+        start = time.perf_counter()
+        try:
+            cls().run(*args, **kwargs)
+            status = 'ok'
+        finally:
+            metrics.record_task(cls.ACTION_NAME, 'celery', status, time.perf_counter() - start, wait_seconds)
+
     def decode_args_and_run(self, payload):
         """
             Here This method decode the arguments coming from eb_worker.py
             and in return calls run method defined by child classes.
+            Compressed and claim-check envelopes (see envelope.py) are unpacked first,
+            then the payload is decoded with the codec named in its format header (see codec.py).
+        """
+        decoded = decode_payload(unpack_payload(payload))
+        if decoded.get('coalesce_key'):
+            # From now on a new enqueue must not be collapsed into this execution.
+            coalesce.release(self.ACTION_NAME, decoded['coalesce_key'])
+        self.run(*decoded['args'], **decoded['kwargs'])
+        release_payload(payload)
+
+    @classmethod
+    def build_payload(cls, args, kwargs, coalesce_key=None, delay_seconds=0):
+        """
+            Builds the json message body which is submitted to SQS and decoded by eb_worker.py
+            The payload is encoded with TASK_PAYLOAD_CODEC (see codec.py) and large payloads
+            get compressed or offloaded to storage (see envelope.py).
         """
-        self.run(*payload['args'], **payload['kwargs'])
+        payload = {
+            'action': cls.ACTION_NAME,  # mandatory, used to ID this task in eb_worker.py
+            'args': args,
+            'kwargs': kwargs
+        }
+        payload.update(cls.trace_headers(delay_seconds))
+        if coalesce_key:
+            payload['coalesce_key'] = coalesce_key
+        idempotency_key = cls.idempotency_key(*args, **kwargs)
+        if idempotency_key is not None:
+            payload['idempotency_key'] = str(idempotency_key)
+        return pack_payload(get_headers(payload), get_codec().encode(payload))
 
     def queue(self, *args, **kwargs):
         """
@@ -49,32 +194,161 @@ class QueueableTask:
             """.format(self.ACTION_NAME, args, kwargs)
         logger.debug(log_msg)
 
-        result = False
         if self.immediate:
             # Process gets called by the same worker.
             self.run(*args, **kwargs)
-            result = True
-        else:
-            # Process is passed to queue which will be handled by another worker.
-            if settings.QUEUE_TYPE == 'sqs':
-                payload = {
-                    'action': self.ACTION_NAME,  # mandatory, used to ID this task in eb_worker.py
-                    'args': args,
-                    'kwargs': kwargs
-                }
-                task = json.dumps(payload)
+            return True
+        return self._submit(args, kwargs)
 
-                from apps.tasks.sqs import submit_to_sqs
-                result = submit_to_sqs(task)
-                logger.debug("Submitted task to SQS: {}".format(task))
+    def queue_in(self, delay, *args, **kwargs):
+        """
+            Queues the task to run after delay (seconds or a timedelta).
+            Delays up to TASK_SCHEDULER_MAX_NATIVE_DELAY use SQS DelaySeconds / celery countdown,
+            longer ones are held by the redis scheduler (see scheduler.py) until they are due.
+        """
+        if isinstance(delay, datetime.timedelta):
+            delay = delay.total_seconds()
+        delay_seconds = int(math.ceil(delay))
+        if self.immediate or delay_seconds <= 0:
+            return self.queue(*args, **kwargs)
+
+        logger.debug("[ QueueableTask ] Task --> {}, delayed by {}s".format(self.ACTION_NAME, delay_seconds))
+        if delay_seconds <= settings.TASK_SCHEDULER_MAX_NATIVE_DELAY:
+            return self._submit(args, kwargs, delay_seconds)
+
+        from apps.tasks import scheduler
+        eta = time.time() + delay
+        if settings.TASK_OUTBOX_ENABLED:
+            # Like the outbox rows, nothing is scheduled for a rolled back transaction.
+            transaction.on_commit(lambda: scheduler.schedule(self.ACTION_NAME, args, kwargs, eta))
+            return True
+        return scheduler.schedule(self.ACTION_NAME, args, kwargs, eta)
+
+    def queue_at(self, eta, *args, **kwargs):
+        """
+            Queues the task to run at eta (a datetime, naive ones are in the current time zone). See queue_in.
+        """
+        if timezone.is_naive(eta):
+            eta = timezone.make_aware(eta)
+        return self.queue_in(eta.timestamp() - time.time(), *args, **kwargs)
 
-                if not result:
-                    logging.warn('Failed to submit SQS message: {}'.format(self.ACTION_NAME))
+    def _submit(self, args, kwargs, delay_seconds=0):
+        duplicate, coalesce_key = self.claim_coalesce_key(args, kwargs)
+        if duplicate:
+            coalesce.record_coalesced(self.ACTION_NAME)
+            return True
+
+        # Process is passed to queue which will be handled by another worker.
+        if settings.QUEUE_TYPE == 'sqs':
+            task = self.build_payload(args, kwargs, coalesce_key, delay_seconds)
+            queue_name = lanes.sqs_queue_name(self.QUEUE)
+
+            if settings.TASK_OUTBOX_ENABLED:
+                # Written in the caller's transaction, sent by the outbox relay.
+                from apps.tasks import outbox
+                result = outbox.enqueue(self.ACTION_NAME, queue_name, [task], delay_seconds) == 1
             else:
+                from apps.tasks.sqs import submit_to_sqs
+                result = submit_to_sqs(task, queue_name, delay_seconds)
+            logger.debug("Submitted task to SQS: {}".format(task))
+
+            if not result:
+                logging.warn('Failed to submit SQS message: {}'.format(self.ACTION_NAME))
+        else:
+            headers = self.celery_headers(coalesce_key, delay_seconds)
+            result = self.send_to_celery(lambda: self.celery_task_function.apply_async(
+                args, kwargs, queue=lanes.celery_queue_name(self.QUEUE), headers=headers,
+                countdown=delay_seconds or None))
+
+        if not result and coalesce_key:
+            # Nothing was queued, don't swallow the next enqueue of this key.
+            coalesce.release(self.ACTION_NAME, coalesce_key)
+        return result
+
+    @classmethod
+    def queue_many(cls, items, immediate=False):
+        """
+            Batched variant of queue() for fanning out many tasks of the same action.
+            items is an iterable of (args, kwargs) tuples. On sqs the messages are packed
+            into SendMessageBatch calls, on celery they are sent as a single group.
+            Returns a list of booleans, one per item, in the same order as items.
+            Items coalesced with a pending task (COALESCE_WINDOW) are reported as queued.
+        """
+        items = [(tuple(args), dict(kwargs)) for args, kwargs in items]
+        logger.debug("[ QueueableTask ] queue_many Task --> {}, count --> {}".format(cls.ACTION_NAME, len(items)))
+
+        if immediate:
+            task = cls(immediate=True)
+            results = []
+            for args, kwargs in items:
                 try:
-                    self.celery_task_function.delay(*args, **kwargs)
+                    task.run(*args, **kwargs)
                 except Exception as e:
-                    logger.error('Celery Error {}'.format(e))
+                    logger.error('Task {} failed: {}'.format(cls.ACTION_NAME, e))
+                    results.append(False)
                 else:
-                    result = True
-        return result
+                    results.append(True)
+            return results
+
+        # Only the items which are not duplicates of a pending task are sent.
+        pending = []
+        for index, (args, kwargs) in enumerate(items):
+            duplicate, coalesce_key = cls.claim_coalesce_key(args, kwargs)
+            if not duplicate:
+                pending.append((index, args, kwargs, coalesce_key))
+        if len(pending) < len(items):
+            coalesce.record_coalesced(cls.ACTION_NAME, len(items) - len(pending))
+
+        results = [True] * len(items)
+        if settings.QUEUE_TYPE == 'sqs':
+            queue_name = lanes.sqs_queue_name(cls.QUEUE)
+            tasks = [cls.build_payload(args, kwargs, coalesce_key) for _, args, kwargs, coalesce_key in pending]
+
+            if settings.TASK_OUTBOX_ENABLED:
+                from apps.tasks import outbox
+                outbox.enqueue(cls.ACTION_NAME, queue_name, tasks)
+                return results
+
+            from apps.tasks.sqs import submit_batch_to_sqs
+            submitted = submit_batch_to_sqs(tasks, queue_name)
+
+            failed = submitted.count(False)
+            if failed:
+                logger.warning('Failed to submit {} of {} SQS messages: {}'.format(
+                    failed, len(submitted), cls.ACTION_NAME))
+            for (index, _, _, coalesce_key), result in zip(pending, submitted):
+                results[index] = result
+                if not result and coalesce_key:
+                    coalesce.release(cls.ACTION_NAME, coalesce_key)
+            return results
+
+        from celery import group
+        tasks = group(
+            cls.celery_task_function.s(*args, **kwargs).set(headers=cls.celery_headers(coalesce_key))
+            for _, args, kwargs, coalesce_key in pending
+        )
+        if not cls.send_to_celery(lambda: tasks.apply_async(queue=lanes.celery_queue_name(cls.QUEUE))):
+            for index, _, _, coalesce_key in pending:
+                results[index] = False
+                if coalesce_key:
+                    coalesce.release(cls.ACTION_NAME, coalesce_key)
+        return results
+
+    @classmethod
+    def send_to_celery(cls, publish):
+        """
+            Calls publish (an apply_async call). With TASK_OUTBOX_ENABLED the publish is deferred
+            until the current transaction commits, so tasks of rolled back transactions are never sent.
+        """
+        def _publish():
+            try:
+                publish()
+            except Exception as e:
+                logger.error('Celery Error {}'.format(e))
+                return False
+            return True
+
+        if settings.TASK_OUTBOX_ENABLED:
+            transaction.on_commit(_publish)
+            return True
+        return _publish()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from apps.tasks import metrics
+
+logger = logging.getLogger(__name__)
+
+'''
+    Admission control of the tasks POSTed to eb_worker.eb_index by the EB daemon (and of the
+    messages of eb_worker.eb_batch, reported "overloaded" instead of a 429).
+    The daemon keeps POSTing whatever the worker load is, and a gevent worker accepts every
+    request, so without a limit concurrent tasks pile up until memory runs out or the gunicorn
+    timeout kills them. A task is admitted while the process runs fewer than TASK_MAX_IN_FLIGHT
+    tasks (and fewer than QueueableTask.MAX_IN_FLIGHT of its action). Otherwise it waits at most
+    TASK_ADMISSION_QUEUE_BUDGET seconds for a slot and is then rejected with a 429, leaving the
+    message on SQS to be redelivered after its visibility timeout.
+'''
+
+
+class Overloaded(Exception):
+    '''
+        Raised when a task could not be admitted within the queue time budget.
+    '''
+    def __init__(self, action, in_flight):
+        self.action = action
+        self.in_flight = in_flight
+        super().__init__("Task {} rejected, {} tasks in flight".format(action, in_flight))
+
+
+class AdmissionController:
+
+    def __init__(self):
+        # Under gunicorn's gevent worker the condition is monkey patched into a greenlet primitive.
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self._in_flight_by_action = defaultdict(int)
+
+    def _has_room(self, action, action_limit) -> bool:
+        if self.in_flight >= settings.TASK_MAX_IN_FLIGHT:
+            return False
+        return not action_limit or self._in_flight_by_action[action] < action_limit
+
+    def acquire(self, action, action_limit=None, budget=None) -> bool:
+        '''
+            Takes an in-flight slot for action, waiting up to budget seconds for one.
+            Returns False if no slot freed up in time.
+        '''
+        deadline = time.monotonic() + (settings.TASK_ADMISSION_QUEUE_BUDGET if budget is None else budget)
+        with self._condition:
+            while not self._has_room(action, action_limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            self._in_flight_by_action[action] += 1
+            count = self._in_flight_by_action[action]
+        metrics.set_in_flight(action, count)
+        return True
+
+    def release(self, action):
+        with self._condition:
+            self.in_flight -= 1
+            self._in_flight_by_action[action] -= 1
+            count = self._in_flight_by_action[action]
+            # Waiters may be blocked on the process or on an action limit.
+            self._condition.notify_all()
+        metrics.set_in_flight(action, count)
+
+    @contextmanager
+    def admit(self, action, action_limit=None):
+        '''
+            Runs the block holding an in-flight slot, raises Overloaded if none is available in time.
+        '''
+        if not self.acquire(action, action_limit):
+            logger.warning("[ admission ] rejecting {}, {} tasks in flight".format(action, self.in_flight))
+            raise Overloaded(action, self.in_flight)
+        try:
+            yield
+        finally:
+            self.release(action)
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+
+
+class TasksConfig(AppConfig):
+    name = 'apps.tasks'
+    label = 'tasks'
+
+    def ready(self):
+        from apps.tasks.lanes import check_task_lanes
+        from apps.tasks.registry import task_registry
+
+        # Warm the registry once per process so eb_worker.py dispatches with a dict lookup,
+        # then freeze it so late or duplicate registrations fail loudly.
+        task_registry.autodiscover()
+        task_registry.freeze()
+        check_task_lanes(task_registry.items())
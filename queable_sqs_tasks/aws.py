@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+import threading
+
+import boto3
+from botocore.config import Config
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+'''
+    Process wide registry of pooled AWS clients.
+    botocore clients are thread safe, expensive to build (tens of ms) and keep their own
+    urllib3 connection pool with keep-alive, so we build one per (service, region, credentials)
+    and share it across sqs.py, SES and SNS.
+    The registry is cleared in forked children (gunicorn/celery prefork) since sockets
+    of the parent connection pools must not be shared between processes.
+'''
+
+_lock = threading.Lock()
+_clients = {}
+_queue_urls = {}
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+    _queue_urls.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_client_config() -> Config:
+    return Config(
+        max_pool_connections=settings.AWS_CLIENT_MAX_POOL_CONNECTIONS,
+        connect_timeout=settings.AWS_CLIENT_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_CLIENT_READ_TIMEOUT,
+        retries={'max_attempts': settings.AWS_CLIENT_MAX_ATTEMPTS},
+    )
+
+
+def get_client(service_name, region_name=None, aws_access_key_id=None, aws_secret_access_key=None, endpoint_url=None):
+    '''
+        Returns the cached botocore client for (service, region, credentials), creating it on first use.
+        endpoint_url points the client at a local stand-in (ElasticMQ, moto server).
+        Raises ValueError (like boto3.client) if the region_name is invalid.
+    '''
+    key = (service_name, region_name, aws_access_key_id, aws_secret_access_key, endpoint_url)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            logger.info("[ AWS ] Creating pooled client for {} in {}".format(service_name, region_name))
+            session = boto3.session.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name
+            )
+            client = session.client(service_name, endpoint_url=endpoint_url, config=get_client_config())
+            _clients[key] = client
+    return client
+
+
+def get_queue_url(queue_name, region_name=None, endpoint_url=None) -> str:
+    '''
+        Returns the cached url of the SQS queue, looking it up with GetQueueUrl on first use.
+    '''
+    key = (queue_name, region_name, endpoint_url)
+    queue_url = _queue_urls.get(key)
+    if queue_url is None:
+        client = get_client('sqs', region_name=region_name, endpoint_url=endpoint_url)
+        response = client.get_queue_url(QueueName=queue_name)
+        queue_url = _queue_urls[key] = response['QueueUrl']
+    return queue_url
+
+
+def clear_clients():
+    '''
+        Drops every cached client and queue url (eg. after rotating credentials).
+    '''
+    with _lock:
+        _clients.clear()
+        _queue_urls.clear()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+    Per process circuit breaker around a remote service (used for SQS sends, see sqs.py).
+    After `failure_threshold` consecutive failures the breaker opens and callers skip the
+    service for `reset_timeout` seconds (the SQS sends go to the spill journal instead of
+    waiting on timeouts). Then a single trial call is let through (half open): it closes
+    the breaker on success or opens it again on failure.
+'''
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        '''
+            Returns True if the call may go to the service.
+        '''
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                logger.info("[ breaker ] {} half open, trying one call".format(self.name))
+                self._state = HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("[ breaker ] {} closed".format(self.name))
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning("[ breaker ] {} open after {} failure(s), retrying in {}s".format(
+                        self.name, self._failures, self.reset_timeout))
+                self._state = OPEN
+                self._opened_at = time.monotonic()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+
+from apps.tasks import metrics
+
+logger = logging.getLogger(__name__)
+
+'''
+    Coalescing of repeated tasks (see QueueableTask.COALESCE_WINDOW).
+    The first enqueue of a key sets a marker with SET NX (cache.add) for the window;
+    further enqueues of the same key are dropped while the marker exists. With TASK_OUTBOX_ENABLED
+    the marker is only checked at enqueue time and set when the caller's transaction commits.
+    The worker deletes the marker when the task starts (the coalesce_key of the SQS payload or of
+    the celery headers), so enqueues made while or after it runs are not lost.
+    Markers live in TASK_COALESCE_CACHE so they are shared by the fleet, the dropped enqueues
+    are counted in the task metrics (queueable_task_coalesced_total, see metrics.py).
+'''
+
+MARKER_KEY = 'tasks:coalesce:{action}:{key}'
+
+
+def get_cache():
+    return caches[settings.TASK_COALESCE_CACHE]
+
+
+def default_coalesce_key(args, kwargs) -> str:
+    '''
+        Key of identical calls: a digest of the canonical json of the arguments.
+    '''
+    canonical = json.dumps([args, kwargs], cls=DjangoJSONEncoder, sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def acquire(action, key, window) -> bool:
+    '''
+        Returns True if no task with this key is pending, ie. the task must be queued.
+        Fails open (returns True) if the cache is unavailable.
+    '''
+    try:
+        return get_cache().add(MARKER_KEY.format(action=action, key=key), 1, timeout=window)
+    except Exception as error:
+        logger.error("[ coalesce ] cache unavailable, not coalescing {}: {}".format(action, error))
+        return True
+
+
+def is_pending(action, key) -> bool:
+    '''
+        True if a task with this key is pending, without claiming the key.
+        Fails open (returns False) if the cache is unavailable.
+    '''
+    try:
+        return get_cache().get(MARKER_KEY.format(action=action, key=key)) is not None
+    except Exception as error:
+        logger.error("[ coalesce ] cache unavailable, not coalescing {}: {}".format(action, error))
+        return False
+
+
+def release(action, key):
+    try:
+        get_cache().delete(MARKER_KEY.format(action=action, key=key))
+    except Exception as error:
+        logger.error("[ coalesce ] failed to release {} {}: {}".format(action, key, error))
+
+
+def record_coalesced(action, count=1):
+    logger.debug("[ coalesce ] {} duplicate {} task(s) coalesced".format(count, action))
+    metrics.record_coalesced(action, count)
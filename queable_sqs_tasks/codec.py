@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import logging
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+'''
+    Versioned codecs for queued task payloads.
+    Every message carries a "format" header ("<codec>/<version>") next to the action,
+    so producers and consumers can roll forward independently:
+        json/1     {"action": ..., "format": "json/1", "args": [...], "kwargs": {...}}
+        msgpack/1  {"action": ..., "format": "msgpack/1", "data": "<base64 msgpack of the payload>"}
+    Messages without a header are legacy json/1.
+    The HEADER_KEYS (action, trace id, enqueue time, idempotency key) always stay readable at the top level.
+    datetimes, dates, UUIDs and Decimals are sent the way DjangoJSONEncoder renders them (strings).
+    orjson, msgpack and zstandard (envelope.py) are pinned in requirements/base.txt, the stdlib
+    fallbacks are only kept for environments installed without them.
+'''
+
+HEADER_KEYS = ('action', 'trace_id', 'enqueued_at', 'idempotency_key')
+
+_django_encoder = DjangoJSONEncoder()
+
+
+def _default(obj):
+    return _django_encoder.default(obj)
+
+
+def get_headers(payload: dict) -> dict:
+    return {key: payload[key] for key in HEADER_KEYS if key in payload}
+
+
+def loads(message):
+    '''
+        Parses a json message body (str or bytes), with orjson when it is installed.
+    '''
+    if orjson is not None:
+        return orjson.loads(message)
+    return json.loads(message)
+
+
+def dumps(obj) -> bytes:
+    '''
+        Compact UTF-8 json of obj, with orjson when it is installed, e.g. to measure the size of a
+        payload parsed out of a batch envelope.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class Codec:
+    name = None
+    version = 1
+
+    @property
+    def header(self):
+        return '{}/{}'.format(self.name, self.version)
+
+    def encode(self, payload: dict) -> str:
+        raise NotImplementedError("Always override encode method for any subclass of Codec")
+
+    def decode(self, message: dict) -> dict:
+        raise NotImplementedError("Always override decode method for any subclass of Codec")
+
+
+class JSONCodec(Codec):
+    '''
+        Plain json, encoded with orjson when it is installed (stdlib json otherwise).
+        orjson hands datetimes, dates and times to DjangoJSONEncoder (OPT_PASSTHROUGH_DATETIME)
+        instead of its own RFC 3339 rendering, so both encode them, UUIDs and Decimals alike.
+        They still differ on the edges: orjson rejects integers over 64 bits, writes NaN and
+        infinities as null and does not escape non-ASCII characters.
+    '''
+    name = 'json'
+
+    def encode(self, payload: dict) -> str:
+        message = dict(payload, format=self.header)
+        if orjson is not None:
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            return orjson.dumps(message, default=_default, option=option).decode('utf-8')
+        return json.dumps(message, cls=DjangoJSONEncoder)
+
+    def decode(self, message: dict) -> dict:
+        return message
+
+
+class MsgpackCodec(Codec):
+    '''
+        msgpack encoded payload, base64 wrapped since SQS message bodies must be text.
+    '''
+    name = 'msgpack'
+
+    def encode(self, payload: dict) -> str:
+        data = msgpack.packb(payload, default=_default, use_bin_type=True)
+        message = dict(get_headers(payload), format=self.header, data=base64.b64encode(data).decode('ascii'))
+        return json.dumps(message)
+
+    def decode(self, message: dict) -> dict:
+        if msgpack is None:
+            raise ImportError("msgpack is required to decode '{}' task payloads".format(message['format']))
+        return msgpack.unpackb(base64.b64decode(message['data']), raw=False)
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec(),
+    MsgpackCodec.name: MsgpackCodec(),
+}
+
+
+def get_codec(name=None) -> Codec:
+    '''
+        Returns the codec used by producers (TASK_PAYLOAD_CODEC), falling back to json
+        when the optional msgpack package is not installed.
+    '''
+    name = name or settings.TASK_PAYLOAD_CODEC
+    if name == MsgpackCodec.name and msgpack is None:
+        logger.warning("TASK_PAYLOAD_CODEC is '{}' but msgpack is not installed, using json".format(name))
+        name = JSONCodec.name
+    return CODECS[name]
+
+
+def decode_payload(message: dict) -> dict:
+    '''
+        Returns the {'action', 'args', 'kwargs'} payload of a decoded message body,
+        using the codec named by its "format" header.
+    '''
+    name, _, version = message.get('format', 'json/1').partition('/')
+    codec = CODECS.get(name)
+    if codec is None or int(version) > codec.version:
+        raise ValueError("Unsupported task payload format '{}'".format(message.get('format')))
+    return codec.decode(message)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import logging
+import signal
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+
+from apps.tasks import codec, lanes, ratelimit
+from apps.tasks.dispatcher import run_in_worker, STATUS_OK, STATUS_DEFERRED, STATUS_FAILED, STATUS_UNKNOWN_ACTION
+from apps.tasks.registry import task_registry
+from apps.tasks.sqs import get_sqs_client, get_sqs_queue_url
+
+logger = logging.getLogger(__name__)
+
+'''
+    Long polling SQS consumer, an alternative to the ElasticBeanstalk daemon POSTing into eb_worker.py.
+    Messages are received in batches of up to 10, dispatched through the QueueableTask registry
+    on a bounded pool, deleted with DeleteMessageBatch once they succeed and kept invisible
+    while they run. Rate limited messages are sent again with a jittered DelaySeconds and the
+    received copy deleted, so deferrals do not use up the redrive maxReceiveCount. Failed
+    messages are left on the queue so SQS redelivers them (or moves them to the dead letter queue).
+    Poison messages, whose body is not a json task payload or whose action is not registered,
+    would fail on every redelivery: they are moved to SQS_CONSUMER_DEAD_LETTER_QUEUE (only logged
+    when it is not set) and deleted.
+    A consumer can serve several lanes (see lanes.py), polled in weighted round robin.
+    Run it with DJANGO_DB_CONN_MAX_AGE set so its pool threads keep their db connection between
+    messages (see dispatcher.run_in_worker).
+'''
+
+SQS_MAX_MESSAGES = 10
+SQS_MAX_WAIT_TIME_SECONDS = 20
+SQS_MAX_DELAY_SECONDS = 900
+
+
+class SQSConsumer:
+
+    def __init__(self, lane_names=None, region_name=None, workers=None, visibility_timeout=None,
+                 wait_time_seconds=SQS_MAX_WAIT_TIME_SECONDS):
+        self.region_name = region_name or settings.SQS_REGION
+        self.workers = workers or settings.SQS_CONSUMER_WORKERS
+        self.visibility_timeout = visibility_timeout or settings.SQS_CONSUMER_VISIBILITY_TIMEOUT
+        self.wait_time_seconds = min(wait_time_seconds, SQS_MAX_WAIT_TIME_SECONDS)
+
+        self.client = get_sqs_client(self.region_name)
+        self.lane_names = list(lane_names or [lanes.DEFAULT_LANE])
+        self.queue_urls = {
+            lane: get_sqs_queue_url(lanes.sqs_queue_name(lane), self.region_name) for lane in self.lane_names
+        }
+        self._dead_letter_queue_url = None
+        self._schedule = lanes.weighted_schedule(self.lane_names)
+        self._turn = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sqs-consumer')
+        self._in_flight = {}  # future -> [message, visibility deadline, action, lane]
+        self._stopping = False
+
+    def stop(self, *args):
+        if not self._stopping:
+            logger.info("[ SQSConsumer ] stop requested, draining {} in-flight messages".format(len(self._in_flight)))
+        self._stopping = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self):
+        logger.info("[ SQSConsumer ] consuming {} with {} workers".format(self.lane_names, self.workers))
+        try:
+            while not self._stopping or self._in_flight:
+                if not self._stopping and len(self._in_flight) < self.workers:
+                    self.receive_next()
+
+                if self._in_flight:
+                    done, _ = wait(list(self._in_flight), timeout=1, return_when=FIRST_COMPLETED)
+                    self.complete(done)
+                    self.extend_visibility()
+        finally:
+            self._executor.shutdown(wait=True)
+        logger.info("[ SQSConsumer ] stopped")
+
+    def receive_next(self):
+        '''
+            Short polls the lanes in weighted round robin order until one has messages.
+            When idle and every lane is empty, long polls the next lane (the wait is split
+            between lanes so a busy low priority lane is not starved).
+        '''
+        for _ in range(len(self._schedule)):
+            lane = self._schedule[self._turn]
+            self._turn = (self._turn + 1) % len(self._schedule)
+            if self.receive(lane, wait_time_seconds=0):
+                return
+
+        if not self._in_flight:
+            lane = self._schedule[self._turn]
+            self.receive(lane, wait_time_seconds=max(1, self.wait_time_seconds // len(self.lane_names)))
+
+    def receive(self, lane, wait_time_seconds) -> int:
+        try:
+            response = self.client.receive_message(
+                QueueUrl=self.queue_urls[lane],
+                MaxNumberOfMessages=min(SQS_MAX_MESSAGES, self.workers - len(self._in_flight)),
+                WaitTimeSeconds=wait_time_seconds,
+                VisibilityTimeout=self.visibility_timeout,
+                AttributeNames=['SentTimestamp'],
+            )
+        except Exception as error:
+            logger.error("[ SQSConsumer ] receive_message failed on lane {}: {}".format(lane, error))
+            time.sleep(1)
+            return 0
+
+        messages = response.get('Messages', [])
+        deadline = time.monotonic() + self.visibility_timeout
+        for message in messages:
+            sent_timestamp = message.get('Attributes', {}).get('SentTimestamp')
+            if sent_timestamp:
+                lanes.record_wait(lane, max(0.0, time.time() - int(sent_timestamp) / 1000.0))
+            try:
+                payload = codec.loads(message['Body'])
+                if not isinstance(payload, dict):
+                    raise ValueError("the payload is not an object")
+            except ValueError as error:
+                self.reject(lane, message, error)
+                continue
+            future = self._executor.submit(
+                run_in_worker, payload, message['MessageId'], len(message['Body'].encode('utf-8')))
+            self._in_flight[future] = [message, deadline, payload.get('action'), lane]
+        return len(messages)
+
+    def complete(self, done):
+        succeeded = defaultdict(list)
+        for future in done:
+            message, _, action, lane = self._in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as error:
+                # Left on the queue for a redelivery, like a failed task.
+                logger.error("[ SQSConsumer ] message {} failed: {!r}".format(message['MessageId'], error))
+                result = STATUS_FAILED
+            if result == STATUS_OK:
+                succeeded[lane].append(message)
+            elif result == STATUS_DEFERRED:
+                self.defer(message, action, lane)
+            elif result == STATUS_UNKNOWN_ACTION:
+                self.reject(lane, message, "unknown action {}".format(action))
+        for lane, messages in succeeded.items():
+            self.delete(lane, messages)
+
+    def reject(self, lane, message, error):
+        logger.error("[ SQSConsumer ] invalid message {} on lane {}: {}, body: {!r}".format(
+            message['MessageId'], lane, error, message['Body'][:1000]))
+        if settings.SQS_CONSUMER_DEAD_LETTER_QUEUE:
+            try:
+                if self._dead_letter_queue_url is None:
+                    self._dead_letter_queue_url = get_sqs_queue_url(
+                        settings.SQS_CONSUMER_DEAD_LETTER_QUEUE, self.region_name)
+                self.client.send_message(QueueUrl=self._dead_letter_queue_url, MessageBody=message['Body'])
+            except Exception as send_error:
+                # Kept on the queue, it is dead lettered on a later receive.
+                logger.error("[ SQSConsumer ] dead lettering message {} failed: {}".format(
+                    message['MessageId'], send_error))
+                return
+        self.delete(lane, [message])
+
+    def defer(self, message, action, lane):
+        '''
+            Pushes a rate limited message back: a copy becomes visible after about one token interval.
+            If the copy cannot be sent, the message itself is made visible again after the delay.
+        '''
+        delay = min(ratelimit.defer_delay(1.0 / task_registry[action].RATE_LIMIT), SQS_MAX_DELAY_SECONDS)
+        try:
+            self.client.send_message(QueueUrl=self.queue_urls[lane], MessageBody=message['Body'], DelaySeconds=delay)
+        except Exception as error:
+            logger.error("[ SQSConsumer ] re-sending deferred message {} failed: {}".format(
+                message['MessageId'], error))
+            try:
+                self.client.change_message_visibility(
+                    QueueUrl=self.queue_urls[lane], ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=delay)
+            except Exception as error:
+                logger.error("[ SQSConsumer ] change_message_visibility failed: {}".format(error))
+            return
+        # Should the delete fail, both copies run: the idempotency marker skips the second one.
+        self.delete(lane, [message])
+
+    def delete(self, lane, messages):
+        for index in range(0, len(messages), SQS_MAX_MESSAGES):
+            entries = [
+                {'Id': str(position), 'ReceiptHandle': message['ReceiptHandle']}
+                for position, message in enumerate(messages[index:index + SQS_MAX_MESSAGES])
+            ]
+            try:
+                response = self.client.delete_message_batch(QueueUrl=self.queue_urls[lane], Entries=entries)
+            except Exception as error:
+                logger.error("[ SQSConsumer ] delete_message_batch failed: {}".format(error))
+                continue
+            for entry in response.get('Failed', []):
+                logger.error("[ SQSConsumer ] delete failed for entry {}: {}".format(entry['Id'], entry.get('Message')))
+
+    def extend_visibility(self):
+        '''
+            Keeps slow tasks invisible: once half of the visibility timeout is left,
+            push the deadline out by another visibility timeout.
+        '''
+        now = time.monotonic()
+        expiring = defaultdict(list)
+        for item in self._in_flight.values():
+            if item[1] - now < self.visibility_timeout / 2:
+                expiring[item[3]].append(item)
+
+        for lane, items in expiring.items():
+            for index in range(0, len(items), SQS_MAX_MESSAGES):
+                chunk = items[index:index + SQS_MAX_MESSAGES]
+                entries = [
+                    {
+                        'Id': str(position),
+                        'ReceiptHandle': item[0]['ReceiptHandle'],
+                        'VisibilityTimeout': self.visibility_timeout,
+                    }
+                    for position, item in enumerate(chunk)
+                ]
+                try:
+                    self.client.change_message_visibility_batch(QueueUrl=self.queue_urls[lane], Entries=entries)
+                except Exception as error:
+                    logger.error("[ SQSConsumer ] change_message_visibility_batch failed: {}".format(error))
+                    continue
+                for item in chunk:
+                    item[1] = now + self.visibility_timeout
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import logging
+import datetime
+import contextlib
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from apps.tasks import idempotency, metrics, ratelimit
+from apps.tasks.admission import admission_controller, Overloaded
+from apps.tasks.registry import task_registry
+
+logger = logging.getLogger(__name__)
+
+'''
+    Runs decoded task payloads ({'action': ..., 'args': ..., 'kwargs': ...}) through the
+    QueueableTask registry. Shared by the eb_worker.py endpoints and the SQS consumer.
+'''
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_UNKNOWN_ACTION = 'unknown_action'
+STATUS_DEFERRED = 'deferred'  # over the action's rate limit, retry later
+STATUS_IN_PROGRESS = 'in_progress'  # redelivery of a task another worker is running, retry later
+STATUS_DUPLICATE = 'duplicate'  # redelivery of a completed task, not run again
+STATUS_OVERLOADED = 'overloaded'  # no in-flight slot of the process (see admission.py), retry later
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    '''
+        Process wide bounded pool used to run batched tasks.
+        Under gunicorn's gevent worker the threads are monkey patched into greenlets.
+    '''
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.TASK_BATCH_MAX_WORKERS,
+                    thread_name_prefix='queueable-task'
+                )
+    return _executor
+
+
+def run_payload(payload, task_id=None, payload_bytes=None):
+    '''
+        Runs the QueueableTask identified by payload['action'] and records its metrics.
+        Raises KeyError for unknown actions, ratelimit.TaskDeferred when the action is over
+        its rate limit, idempotency.TaskInProgress when the same task is running elsewhere
+        and lets task errors propagate. Redeliveries of completed tasks return without running.
+    '''
+    task_id = payload.get('trace_id') or task_id or uuid.uuid4()
+    action = payload.get('action')
+    task_class = task_registry[action]
+
+    key = idempotency.get_key(payload)
+    if key:
+        claimed = idempotency.claim(action, key)
+        if claimed == idempotency.DONE:
+            metrics.record_idempotency(action, 'hit')
+            metrics.record_task(action, 'sqs', STATUS_DUPLICATE)
+            logger.info("[skip-task: {uuid}] {action}: already completed".format(uuid=task_id, action=action))
+            return
+        if claimed == idempotency.RUNNING:
+            metrics.record_idempotency(action, 'in_progress')
+            raise idempotency.TaskInProgress(action, key)
+        metrics.record_idempotency(action, 'miss')
+
+    try:
+        ratelimit.check(task_class)
+    except ratelimit.TaskDeferred:
+        if key:
+            idempotency.release(action, key)
+        metrics.record_task(action, 'sqs', STATUS_DEFERRED)
+        raise
+
+    enqueued_at = payload.get('enqueued_at')
+    wait_seconds = time.time() - enqueued_at if enqueued_at else None
+    logger.info("[begin-task: {uuid}, {now}] {action}: queue wait = {wait}, payload = {payload}".format(
+        uuid=task_id, now=datetime.datetime.now(), action=action, wait=wait_seconds, payload=payload))
+
+    status = STATUS_FAILED
+    start = time.perf_counter()
+    try:
+        with idempotency.keep_alive(action, key) if key else contextlib.nullcontext():
+            task_class().decode_args_and_run(payload)
+        status = STATUS_OK
+    finally:
+        duration = time.perf_counter() - start
+        metrics.record_task(action, 'sqs', status, duration, wait_seconds, payload_bytes)
+        if key:
+            # Failed runs must be retried by the redelivery.
+            (idempotency.complete if status == STATUS_OK else idempotency.release)(action, key)
+
+    logger.info("[end-task: {uuid}, {now}] {action}: duration = {duration:.3f}s".format(
+        uuid=task_id, now=datetime.datetime.now(), action=action, duration=duration))
+
+
+def run_payload_safely(payload, task_id=None, payload_bytes=None) -> str:
+    '''
+        Runs a payload and returns one of the STATUS_* values instead of raising.
+    '''
+    if not isinstance(payload, dict):
+        logger.error("{}: Invalid task payload {!r}".format(task_id, payload))
+        return STATUS_FAILED
+    if payload.get('action') not in task_registry:
+        logger.error("{}: Unknown task action {}".format(task_id, payload.get('action')))
+        return STATUS_UNKNOWN_ACTION
+
+    try:
+        run_payload(payload, task_id, payload_bytes)
+    except ratelimit.TaskDeferred:
+        return STATUS_DEFERRED
+    except idempotency.TaskInProgress:
+        return STATUS_IN_PROGRESS
+    except Exception:
+        logger.error("{}: Failed to handle task {}: {}".format(task_id, payload, traceback.format_exc()))
+        return STATUS_FAILED
+    return STATUS_OK
+
+
+def run_in_worker(payload, task_id=None, payload_bytes=None) -> str:
+    '''
+        run_payload_safely for pool threads, which outlive the request that submitted the payload.
+    '''
+    try:
+        return run_payload_safely(payload, task_id, payload_bytes)
+    finally:
+        # Pool threads are long lived: reuse their db connection (CONN_MAX_AGE) unless it is
+        # broken or too old, like Django does around a request.
+        close_old_connections()
+
+
+def run_admitted(payload, task_id=None, payload_bytes=None) -> str:
+    '''
+        run_in_worker holding an in-flight slot of the admission controller, like eb_index.
+        Returns STATUS_OVERLOADED, without running the task, if no slot freed up in time.
+    '''
+    action = payload.get('action') if isinstance(payload, dict) else None
+    task_class = task_registry.get(action)
+    try:
+        with admission_controller.admit(action, task_class.MAX_IN_FLIGHT if task_class else None):
+            return run_in_worker(payload, task_id, payload_bytes)
+    except Overloaded:
+        return STATUS_OVERLOADED
+
+
+def dispatch_batch(messages) -> dict:
+    '''
+        Runs many payloads concurrently on the bounded pool, within the process' TASK_MAX_IN_FLIGHT.
+        messages is an iterable of (message_id, payload, payload_bytes) triples, payload_bytes being
+        the UTF-8 size of the message, returns {message_id: STATUS_*}.
+    '''
+    executor = get_executor()
+    futures = [
+        (message_id, executor.submit(run_admitted, payload, message_id, payload_bytes))
+        for message_id, payload, payload_bytes in messages
+    ]
+    return {message_id: future.result() for message_id, future in futures}
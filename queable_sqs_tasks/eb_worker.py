@@ -6,22 +6,22 @@
 # you need to create and plug an SQS queue to the EB environment
 #
 import logging
-import inspect
-import apps
 import uuid
 import datetime
-import json
 import traceback
 
 from django.conf import settings
-from django.http import Http404
+from django.http import Http404, HttpResponse
 
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from drf_yasg.utils import swagger_auto_schema
 
-from apps.tasks import QueueableTask
+from apps.tasks import codec, idempotency, metrics, ratelimit
+from apps.tasks.admission import admission_controller, Overloaded
+from apps.tasks.dispatcher import run_payload, dispatch_batch, STATUS_OK
+from apps.tasks.registry import task_registry
 
 
 logger = logging.getLogger(__name__)
@@ -29,27 +29,13 @@ logger = logging.getLogger(__name__)
 '''
     Tasks must be located as a child of apps folder, in its own class.
     E.g. apps.campaigns.tasks
+    They are registered on import, see apps/tasks/registry.py
 '''
 
 
 def get_queueable_tasks() -> dict:
     logger.info("[trace] apps/tasks/eb_worker.py: get_queueable_tasks()")
-
-    tasks = {}
-    # inspect modules from the apps module
-    for name, obj in inspect.getmembers(apps):
-        if inspect.ismodule(obj):
-            # keep only the QueueableTask sub-classes
-            for class_name, class_ref in inspect.getmembers(obj):
-                # check if class is QueueableTask and subclass of QueueableTask
-                if inspect.isclass(class_ref) and issubclass(class_ref, QueueableTask):
-                    try:
-                        action = class_ref().action_name()
-                        tasks[action] = class_ref
-                    except AttributeError:
-                        # we ignore classes that don't have the action_name()
-                        pass
-    return tasks
+    return task_registry.as_dict()
 
 
 @swagger_auto_schema(method='post', auto_schema=None)
@@ -64,24 +50,79 @@ def eb_index(request):
 
     try:
         body = request.body.decode('utf-8')
-        payload = json.loads(body)
+        payload = codec.loads(body)
 
         action = payload.get('action')
-        tasks = get_queueable_tasks()
-
-        logger.info("[begin-task: {uuid}, {now}] {action}: payload = {payload}".format(
-            uuid=task_id, now=now, action=action, payload=body))
-
-        task = tasks[action]()
-        task.decode_args_and_run(payload)
-
-        now = datetime.datetime.now()
-        logger.info("[end-task: {uuid}, {now}] {action}: payload = {payload}".format(
-            uuid=task_id, now=now, action=action, payload=body))
-
+        task_class = task_registry.get(action)
+        with admission_controller.admit(action, task_class.MAX_IN_FLIGHT if task_class else None):
+            run_payload(payload, task_id, len(request.body))
+    except Overloaded:
+        # Shed load fast, the daemon redelivers the message once its visibility timeout expires.
+        response = Response("Worker overloaded.", status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = str(ratelimit.defer_delay(settings.TASK_ADMISSION_QUEUE_BUDGET))
+        return response
+    except ratelimit.TaskDeferred as deferred:
+        # Not an error: the daemon redelivers the message once its visibility timeout expires.
+        response = Response("Task rate limited.", status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = str(ratelimit.defer_delay(deferred.retry_after))
+        return response
+    except idempotency.TaskInProgress:
+        # A redelivery of a task still running on another worker, redelivered again later.
+        return Response("Task already running.", status.HTTP_409_CONFLICT)
     except Exception as error:
         logger.error("{}: Failed to handle sqs task. Error {}, {}".format(now, error, body))
         logger.error("{}: {}".format(now, traceback.format_exc()))
         return Response("Task could not be processed.", status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     return Response(data={}, status=status.HTTP_200_OK)
+
+
+@swagger_auto_schema(method='post', auto_schema=None)
+@api_view(['POST'])
+def eb_batch(request):
+    """
+        Batch variant of eb_index. Accepts an envelope of many task payloads:
+            {"messages": [{"id": "<message id>", "payload": {"action": ..., "args": ..., "kwargs": ...}}, ...]}
+        runs them on the bounded dispatcher pool and answers with a per message status map:
+            {"results": {"<message id>": "ok" | "failed" | "unknown_action" | "deferred" | "in_progress"
+                                         | "overloaded"}}
+        so the producer only retries the failed ids.
+    """
+    batch_id = uuid.uuid4()
+    now = datetime.datetime.now()
+    logger.info("[SQS-pull-batch: {}, {}] apps/tasks/eb_worker.py: eb_batch(request)".format(batch_id, now))
+
+    if settings.QUEUE_TYPE != 'sqs':
+        raise Http404("Host configuration does not authorize this endpoint.")
+
+    try:
+        envelope = codec.loads(request.body)
+        messages = [(str(message['id']), message['payload']) for message in envelope['messages']]
+        if not all(isinstance(payload, dict) for _, payload in messages):
+            raise TypeError("task payloads must be objects")
+        messages = [(message_id, payload, len(codec.dumps(payload))) for message_id, payload in messages]
+    except (ValueError, KeyError, TypeError) as error:
+        logger.error("{}: Invalid batch envelope. Error {}".format(now, error))
+        return Response("Invalid batch envelope.", status.HTTP_400_BAD_REQUEST)
+
+    if len(messages) > settings.TASK_BATCH_MAX_MESSAGES:
+        return Response(
+            "Batch exceeds {} messages.".format(settings.TASK_BATCH_MAX_MESSAGES), status.HTTP_400_BAD_REQUEST)
+    if len({message_id for message_id, _, _ in messages}) != len(messages):
+        return Response("Batch message ids must be unique.", status.HTTP_400_BAD_REQUEST)
+
+    results = dispatch_batch(messages)
+
+    failed = [message_id for message_id, result in results.items() if result != STATUS_OK]
+    logger.info("[end-batch: {}, {}] {} messages, {} failed".format(
+        batch_id, datetime.datetime.now(), len(results), len(failed)))
+
+    return Response(data={'results': results}, status=status.HTTP_200_OK)
+
+
+def task_metrics(request):
+    """
+        Task latency, throughput, payload size and failure metrics (SQS and celery)
+        in the Prometheus text format.
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
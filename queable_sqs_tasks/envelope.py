@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import logging
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, get_storage_class
+
+from apps.tasks import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+'''
+    Transparent envelope for large task payloads.
+    Payloads above TASK_PAYLOAD_COMPRESS_THRESHOLD bytes are compressed and base64 encoded:
+        {"action": ..., "envelope": "zlib", "data": "<base64>"}
+    If the message is still larger than TASK_PAYLOAD_MAX_BYTES (SQS accepts 256 KB) the
+    compressed bytes are stored in TASK_PAYLOAD_STORAGE (S3 or the local filesystem) and only
+    a reference is enqueued (claim-check):
+        {"action": ..., "envelope": "zlib", "claim_check": "task-payloads/<uuid>.zlib"}
+    The headers (action, trace id, ...) stay at the top level so eb_worker.py can dispatch without unpacking.
+    Raw and encoded sizes and the envelope of every packed payload are counted in the task
+    metrics (queueable_task_payload_*_total, see metrics.py).
+'''
+
+ENVELOPE_ZLIB = 'zlib'
+ENVELOPE_ZSTD = 'zstd'
+
+CLAIM_CHECK_PREFIX = 'task-payloads'
+
+ENVELOPE_PLAIN = 'plain'
+ENVELOPE_COMPRESSED = 'compressed'
+ENVELOPE_CLAIM_CHECK = 'claim_check'
+
+
+def get_payload_storage():
+    if settings.TASK_PAYLOAD_STORAGE:
+        return get_storage_class(settings.TASK_PAYLOAD_STORAGE)()
+    return default_storage
+
+
+def get_compression() -> str:
+    '''
+        Envelope codec of TASK_PAYLOAD_COMPRESSION, zlib when zstandard is not installed.
+        Raises ImproperlyConfigured for an unknown codec, which no consumer could decompress.
+    '''
+    codec = settings.TASK_PAYLOAD_COMPRESSION
+    if codec not in (ENVELOPE_ZLIB, ENVELOPE_ZSTD):
+        raise ImproperlyConfigured("TASK_PAYLOAD_COMPRESSION must be '{}' or '{}', not '{}'".format(
+            ENVELOPE_ZLIB, ENVELOPE_ZSTD, codec))
+    if codec == ENVELOPE_ZSTD and zstandard is None:
+        return ENVELOPE_ZLIB
+    return codec
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == ENVELOPE_ZSTD:
+        if zstandard is None:
+            raise ImportError("zstandard is required for the '{}' task payload envelope".format(codec))
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == ENVELOPE_ZLIB:
+        return zlib.compress(data)
+    raise ValueError("Unknown task payload envelope '{}'".format(codec))
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == ENVELOPE_ZSTD:
+        if zstandard is None:
+            raise ImportError("zstandard is required for the '{}' task payload envelope".format(codec))
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == ENVELOPE_ZLIB:
+        return zlib.decompress(data)
+    raise ValueError("Unknown task payload envelope '{}'".format(codec))
+
+
+def pack_payload(headers: dict, json_payload: str) -> str:
+    '''
+        Wraps json_payload in a compressed or claim-check envelope when it is too large
+        to be sent as is. Small payloads are returned unchanged.
+    '''
+    action = headers['action']
+    # Checked on every enqueue, not only the large ones, so a bad setting fails fast.
+    codec = get_compression()
+    raw = json_payload.encode('utf-8')
+    message = json_payload
+    compressed = claim_check = None
+
+    if len(raw) > settings.TASK_PAYLOAD_COMPRESS_THRESHOLD:
+        compressed = compress(raw, codec)
+
+        envelope = dict(headers, envelope=codec)
+        message = json.dumps(dict(envelope, data=base64.b64encode(compressed).decode('ascii')))
+
+        if len(message) > settings.TASK_PAYLOAD_MAX_BYTES:
+            claim_check = '{}/{}.{}'.format(CLAIM_CHECK_PREFIX, uuid.uuid4(), codec)
+            claim_check = get_payload_storage().save(claim_check, ContentFile(compressed))
+            message = json.dumps(dict(envelope, claim_check=claim_check))
+
+    _record(action, len(raw), len(message.encode('utf-8')), compressed is not None, claim_check is not None)
+    return message
+
+
+def unpack_payload(payload: dict) -> dict:
+    '''
+        Returns the original {'action', 'args', 'kwargs'} payload of an envelope.
+        Payloads which were sent as is are returned unchanged.
+    '''
+    codec = payload.get('envelope')
+    if not codec:
+        return payload
+
+    if 'claim_check' in payload:
+        with get_payload_storage().open(payload['claim_check'], 'rb') as claim_check:
+            compressed = claim_check.read()
+    else:
+        compressed = base64.b64decode(payload['data'])
+    return json.loads(decompress(compressed, codec).decode('utf-8'))
+
+
+def release_payload(payload: dict):
+    '''
+        Deletes the stored claim-check of an envelope once its task succeeded.
+        (Failed tasks keep it so SQS redeliveries can still be unpacked.)
+    '''
+    if 'claim_check' not in payload:
+        return
+    try:
+        get_payload_storage().delete(payload['claim_check'])
+    except Exception as error:
+        logger.error("Failed to delete task payload claim-check {}: {}".format(payload['claim_check'], error))
+
+
+def _record(action, raw_bytes, encoded_bytes, compressed, claim_check):
+    if claim_check:
+        envelope = ENVELOPE_CLAIM_CHECK
+    elif compressed:
+        envelope = ENVELOPE_COMPRESSED
+    else:
+        envelope = ENVELOPE_PLAIN
+    metrics.record_payload(action, envelope, raw_bytes, encoded_bytes)
+
+    if compressed:
+        logger.debug("[ envelope ] {}: {} bytes --> {} bytes (ratio {:.2f}, claim-check {})".format(
+            action, raw_bytes, encoded_bytes, encoded_bytes / raw_bytes, claim_check))
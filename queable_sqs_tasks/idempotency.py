@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+'''
+    Idempotent execution of SQS tasks, which are delivered at least once (eg. the EB daemon
+    redelivers a message when eb_index times out, even though the task kept running).
+    Every message carries its task id (the trace_id header) and optionally an idempotency key
+    (QueueableTask.idempotency_key). Before running a message the dispatcher claims its key:
+        tasks:idempotency:<action>:<key>  'running' (TASK_IDEMPOTENCY_LOCK_TIMEOUT) then 'done' (TASK_IDEMPOTENCY_TTL)
+    Messages whose key is done are acknowledged without running, messages whose key is still
+    running are left on the queue to be redelivered later. Failed runs release the key.
+    While the task runs its marker is refreshed every TASK_IDEMPOTENCY_LOCK_TIMEOUT / 3 seconds
+    (keep_alive, one refresher thread per process for all the running markers), so tasks may run
+    longer than the lock timeout, which only bounds how long the marker of a killed worker blocks
+    the redeliveries.
+    Markers live in TASK_IDEMPOTENCY_CACHE so they are shared by the fleet.
+'''
+
+MARKER_KEY = 'tasks:idempotency:{action}:{key}'
+
+RUNNING = 'running'
+DONE = 'done'
+
+CLAIMED = 'claimed'
+
+
+class TaskInProgress(Exception):
+    '''
+        Raised by the dispatcher when another worker is running the same task.
+    '''
+    def __init__(self, action, key):
+        self.action = action
+        self.key = key
+        super().__init__("Task {} {} is already running".format(action, key))
+
+
+def get_cache():
+    return caches[settings.TASK_IDEMPOTENCY_CACHE]
+
+
+def get_key(payload):
+    return payload.get('idempotency_key') or payload.get('trace_id')
+
+
+def claim(action, key) -> str:
+    '''
+        Returns CLAIMED if the task must run, DONE if it already completed or RUNNING if another
+        worker is running it. Fails open (CLAIMED) if the cache is unavailable.
+    '''
+    marker = MARKER_KEY.format(action=action, key=key)
+    try:
+        cache = get_cache()
+        if cache.add(marker, RUNNING, timeout=settings.TASK_IDEMPOTENCY_LOCK_TIMEOUT):
+            return CLAIMED
+        # The marker may have expired in between, treat it as a new run.
+        return cache.get(marker) or CLAIMED
+    except Exception as error:
+        logger.error("[ idempotency ] cache unavailable, not deduplicating {}: {}".format(action, error))
+        return CLAIMED
+
+
+_running_lock = threading.Lock()
+_running = set()  # markers of the tasks this process runs
+_refresher = None
+
+
+def _reset_after_fork():
+    # The parent's tasks and refresher thread are the parent's.
+    global _running_lock, _running, _refresher
+    _running_lock = threading.Lock()
+    _running = set()
+    _refresher = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(settings.TASK_IDEMPOTENCY_LOCK_TIMEOUT / 3)
+        # Touched under the lock, so no task marks its key done between the lookup and the touch.
+        with _running_lock:
+            for marker in _running:
+                try:
+                    get_cache().touch(marker, timeout=settings.TASK_IDEMPOTENCY_LOCK_TIMEOUT)
+                except Exception as error:
+                    logger.error("[ idempotency ] failed to refresh {}: {}".format(marker, error))
+
+
+@contextmanager
+def keep_alive(action, key):
+    '''
+        Refreshes the running marker of a claimed task until the block exits, after which
+        it is never touched again (so the refresh cannot shorten the done marker).
+    '''
+    global _refresher
+    marker = MARKER_KEY.format(action=action, key=key)
+    with _running_lock:
+        _running.add(marker)
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_loop, name='idempotency-keep-alive', daemon=True)
+            _refresher.start()
+    try:
+        yield
+    finally:
+        with _running_lock:
+            _running.discard(marker)
+
+
+def complete(action, key):
+    try:
+        get_cache().set(MARKER_KEY.format(action=action, key=key), DONE, timeout=settings.TASK_IDEMPOTENCY_TTL)
+    except Exception as error:
+        logger.error("[ idempotency ] failed to mark {} {} done: {}".format(action, key, error))
+
+
+def release(action, key):
+    try:
+        get_cache().delete(MARKER_KEY.format(action=action, key=key))
+    except Exception as error:
+        logger.error("[ idempotency ] failed to release {} {}: {}".format(action, key, error))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from apps.tasks import metrics
+
+logger = logging.getLogger(__name__)
+
+'''
+    Priority lanes. QueueableTask.QUEUE names a lane of settings.TASK_QUEUES, which maps it to
+    an SQS queue, a celery queue and a consumer weight:
+        TASK_QUEUES = {
+            'default': {'sqs': 'tasks', 'celery': 'celery', 'weight': 1},
+            'interactive': {'sqs': 'tasks-interactive', 'celery': 'interactive', 'weight': 3},
+            'bulk': {'sqs': 'tasks-bulk', 'celery': 'bulk', 'weight': 1},
+        }
+    so latency sensitive tasks don't wait behind bulk backfills.
+    The SQS consumers record the queue wait of every lane in the metrics histogram
+    queueable_task_lane_wait_seconds, shared by the fleet (see metrics.py, task_lanes command).
+'''
+
+DEFAULT_LANE = 'default'
+
+
+def get_lane(lane=None) -> dict:
+    lane = lane or DEFAULT_LANE
+    try:
+        return settings.TASK_QUEUES[lane]
+    except KeyError:
+        raise ImproperlyConfigured("Task lane '{}' is not defined in TASK_QUEUES".format(lane))
+
+
+def sqs_queue_name(lane=None) -> str:
+    return get_lane(lane)['sqs']
+
+
+def celery_queue_name(lane=None) -> str:
+    return get_lane(lane)['celery']
+
+
+def check_task_lanes(tasks):
+    '''
+        Fails fast at startup if a task routes to a lane missing from TASK_QUEUES.
+    '''
+    for action, task_class in tasks:
+        get_lane(task_class.QUEUE)
+
+
+def weighted_schedule(lanes) -> list:
+    '''
+        Round robin order of lanes where each lane appears `weight` times, interleaved.
+        E.g. {'interactive': 3, 'bulk': 1} -> ['interactive', 'bulk', 'interactive', 'interactive']
+    '''
+    weights = {lane: max(1, int(get_lane(lane).get('weight', 1))) for lane in lanes}
+    schedule = []
+    for turn in range(max(weights.values())):
+        schedule.extend(lane for lane in lanes if weights[lane] > turn)
+    return schedule
+
+
+def record_wait(lane, seconds):
+    metrics.record_lane_wait(lane, seconds)
+
+
+def get_wait_stats() -> dict:
+    '''
+        Queue wait (enqueue to receive) per lane, as recorded by every SQS consumer:
+            {lane: {'messages', 'avg_seconds', 'p95_seconds'}}
+        p95_seconds is the upper bound of the histogram bucket holding the 95th percentile, None
+        above the last bucket. Lanes without any message or whose metrics are unavailable are left out.
+    '''
+    buckets = metrics.HISTOGRAMS[metrics.LANE_WAIT][1]
+    stats = {}
+    for lane in settings.TASK_QUEUES:
+        try:
+            series = metrics.get_histogram(metrics.LANE_WAIT, lane=lane)
+        except Exception as error:
+            logger.error("[ lanes ] failed to read wait of lane {}: {}".format(lane, error))
+            continue
+        messages = int(series.get('count', 0))
+        if not messages:
+            continue
+        stats[lane] = {
+            'messages': messages,
+            'avg_seconds': float(series.get('sum', 0)) / messages,
+            'p95_seconds': next((le for le in buckets if int(series.get(str(le), 0)) >= 0.95 * messages), None),
+        }
+    return stats
+
+
+def get_lane_depths() -> dict:
+    '''
+        Number of messages waiting in each lane, from SQS queue attributes or the celery broker.
+    '''
+    depths = {}
+    for lane in settings.TASK_QUEUES:
+        try:
+            if settings.QUEUE_TYPE == 'sqs':
+                from apps.tasks.sqs import get_sqs_client, get_sqs_queue_url
+                response = get_sqs_client().get_queue_attributes(
+                    QueueUrl=get_sqs_queue_url(sqs_queue_name(lane)),
+                    AttributeNames=['ApproximateNumberOfMessages']
+                )
+                depths[lane] = int(response['Attributes']['ApproximateNumberOfMessages'])
+            else:
+                from apps.tasks.celery import app as celery_app
+                with celery_app.connection_or_acquire() as connection:
+                    depths[lane] = connection.default_channel.queue_declare(
+                        queue=celery_queue_name(lane), passive=True).message_count
+        except Exception as error:
+            logger.error("[ lanes ] failed to read depth of lane {}: {}".format(lane, error))
+            depths[lane] = None
+    return depths
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework import status
+from drf_yasg.utils import swagger_auto_schema
+
+from apps.tasks import QueueableTask
+
+logger = logging.getLogger(__name__)
+
+'''
+    Load test entry points (TASK_LOADTEST_ENABLED only, see loadtest/readme.md).
+    POST /tasks/loadtest/ {"channel": "fcm" | "sns" | "ses" | "smtp"} queues a LoadTestNotification,
+    which the worker runs through the real notification senders. The notification carries
+    "loadtest-sent-at=<enqueue time>" so the fake services measure the end-to-end latency.
+'''
+
+LOADTEST_ACTION = 'loadtest_notification'
+LOADTEST_TOKEN = 'loadtest-device-token'
+LOADTEST_EMAIL = 'loadtest@example.com'
+CHANNELS = ('fcm', 'sns', 'ses', 'smtp')
+
+
+class LoadTestNotification(QueueableTask):
+
+    ACTION_NAME = LOADTEST_ACTION
+
+    def run(self, channel, sent_at):
+        marker = 'loadtest-sent-at={}'.format(sent_at)
+
+        if channel == 'fcm':
+            from apps.notifications.fcm import FCMNotifier
+            FCMNotifier().send(registration_id=LOADTEST_TOKEN, message_title='Load test', message_body=marker)
+        elif channel == 'sns':
+            from apps.notifications.sns import SNS, Notification
+            message = json.dumps({'default': marker})
+            if not SNS().publish(Notification.ANDROID, LOADTEST_TOKEN, 'loadtest', message):
+                raise RuntimeError('SNS publish failed')
+        elif channel == 'ses':
+            from apps.notifications.ses import SES
+            message = {'Subject': {'Data': 'Load test'}, 'Body': {'Text': {'Data': marker}}}
+            if not SES().send({'ToAddresses': [LOADTEST_EMAIL]}, message):
+                raise RuntimeError('SES send failed')
+        elif channel == 'smtp':
+            from apps.notifications.django_email import EmailSender
+            _, error = EmailSender().send({
+                'to': [LOADTEST_EMAIL],
+                'subject': 'Load test',
+                'body': marker,
+                'alternatives': [('<p>{}</p>'.format(marker), 'text/html')],
+            })
+            if error:
+                raise RuntimeError(error)
+        else:
+            raise ValueError("Unknown load test channel '{}'".format(channel))
+
+
+@swagger_auto_schema(method='post', auto_schema=None)
+@api_view(['POST'])
+def loadtest_enqueue(request):
+    channel = request.data.get('channel', 'fcm')
+    if channel not in CHANNELS:
+        return Response("Unknown channel.", status.HTTP_400_BAD_REQUEST)
+
+    if not LoadTestNotification().queue(channel=channel, sent_at=time.time()):
+        return Response("Task could not be queued.", status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response(data={}, status=status.HTTP_202_ACCEPTED)
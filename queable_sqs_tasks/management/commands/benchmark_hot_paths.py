@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import timeit
+import uuid
+from contextlib import ExitStack
+from unittest import mock
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from apps.tasks import QueueableTask
+from apps.tasks.registry import TaskRegistry
+from apps.tasks.management.commands.benchmark_task_codecs import user_update_payload
+
+'''
+    Microbenchmarks of the queue, dispatch and notification hot paths, run against in-process
+    stubs of SQS, celery, redis, FCM, SNS and SES so they measure our code and not the network.
+    Results are written as json (one file per commit by default) and can be compared with a
+    previous run to spot regressions:
+        python manage.py benchmark_hot_paths --output before.json
+        python manage.py benchmark_hot_paths --compare before.json
+'''
+
+FCM_SIZES = (10000, 100000, 1000000)
+
+
+class BenchmarkTask(QueueableTask, register=False):
+    ACTION_NAME = 'benchmark_noop'
+
+    def run(self, *args, **kwargs):
+        pass
+
+
+class StubCeleryTask:
+
+    def apply_async(self, *args, **kwargs):
+        return None
+
+
+class StubSQSClient:
+
+    def send_message(self, **kwargs):
+        return {'MessageId': uuid.uuid4().hex}
+
+
+class StubRedis:
+    '''
+        Accepts the metrics writes (pipeline, hincrby, hset ...) and drops them.
+    '''
+
+    def pipeline(self, *args, **kwargs):
+        return self
+
+    def execute(self):
+        return []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class StubPushService:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def notify_single_device(self, **kwargs):
+        return {'success': 1, 'failure': 0, 'results': [{'message_id': '0:1'}]}
+
+    def notify_multiple_devices(self, registration_ids, **kwargs):
+        return {
+            'success': len(registration_ids),
+            'failure': 0,
+            'results': [{'message_id': '0:1'}] * len(registration_ids),
+        }
+
+
+class StubAWSClient:
+    '''
+        Minimal SNS/SES client: every call succeeds.
+    '''
+
+    class exceptions:
+        class NotFoundException(Exception):
+            pass
+
+        class InvalidParameterException(Exception):
+            pass
+
+    def __init__(self, device_token=None):
+        self.device_token = device_token
+
+    def _ok(self, **response):
+        return dict(response, ResponseMetadata={'HTTPStatusCode': 200})
+
+    def list_platform_applications(self):
+        return self._ok(PlatformApplications=[])
+
+    def get_platform_application_attributes(self, **kwargs):
+        return self._ok(Attributes={'Enabled': 'true'})
+
+    def create_platform_endpoint(self, **kwargs):
+        return self._ok(EndpointArn='arn:aws:sns:ca-central-1:000000000000:endpoint/GCM/app/{}'.format(kwargs['Token']))
+
+    def get_endpoint_attributes(self, **kwargs):
+        return self._ok(Attributes={'Token': self.device_token, 'Enabled': 'true'})
+
+    def set_endpoint_attributes(self, **kwargs):
+        return self._ok()
+
+    def list_identities(self):
+        return self._ok(Identities=[])
+
+    def list_verified_email_addresses(self):
+        from apps.notifications.settings import AWS_SES_EMAIL_IDENTITY
+        return self._ok(VerifiedEmailAddresses=[AWS_SES_EMAIL_IDENTITY])
+
+    def send_email(self, **kwargs):
+        return self._ok(MessageId=uuid.uuid4().hex)
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return revision.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks QueueableTask.queue, eb_index dispatch, FCM chunking and SNS/SES sends against local stubs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Timing runs per benchmark, the best one is kept.')
+        parser.add_argument('--number', type=int, default=1000, help='Calls per timing run of the per-task benchmarks.')
+        parser.add_argument('--only', help='Run only the benchmarks whose name contains this string.')
+        parser.add_argument('--output', help='Json results file, defaults to benchmark-results/<git revision>.json')
+        parser.add_argument('--compare', help='Previous json results to compare with.')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Slowdown (percent) reported as a regression.')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        self.number = options['number']
+        self.results = {}
+
+        benchmarks = [
+            ('queue.sqs', self.bench_queue_sqs),
+            ('queue.celery', self.bench_queue_celery),
+            ('eb_index.dispatch', self.bench_eb_index),
+        ]
+        benchmarks += [('fcm.send.{}'.format(size), lambda size=size: self.bench_fcm_send(size)) for size in FCM_SIZES]
+        benchmarks += [
+            ('fcm.send_bulk.100000', self.bench_fcm_send_bulk),
+            ('sns.register', self.bench_sns_register),
+            ('sns.register.cached', self.bench_sns_register_cached),
+            ('ses.send', self.bench_ses_send),
+        ]
+
+        self.stdout.write('{:<24} {:>14} {:>14} {:>8}'.format('BENCHMARK', 'ops/s', 'best (ms)', 'CALLS'))
+        for name, benchmark in benchmarks:
+            if options['only'] and options['only'] not in name:
+                continue
+            with ExitStack() as stack:
+                benchmark_function, number, patches = benchmark()
+                for patch in patches:
+                    stack.enter_context(patch)
+                timings = timeit.repeat(benchmark_function, number=number, repeat=self.repeat)
+            best = min(timings) / number
+            self.results[name] = {
+                'number': number,
+                'repeat': self.repeat,
+                'best_seconds': best,
+                'mean_seconds': sum(timings) / len(timings) / number,
+                'ops_per_second': 1 / best if best else None,
+            }
+            self.stdout.write('{:<24} {:>14,.0f} {:>14.4f} {:>8}'.format(
+                name, 1 / best if best else 0, best * 1000, number))
+
+        revision = git_revision()
+        output = options['output'] or os.path.join('benchmark-results', '{}.json'.format(revision))
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as results_file:
+            json.dump({
+                'revision': revision,
+                'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': self.results,
+            }, results_file, indent=2, sort_keys=True)
+        self.stdout.write('Results written to {}'.format(output))
+
+        if options['compare']:
+            self.compare(options['compare'], options['threshold'])
+
+    def compare(self, path, threshold):
+        with open(path) as results_file:
+            previous = json.load(results_file)
+
+        self.stdout.write('\nCompared with {} ({}):'.format(path, previous.get('revision')))
+        for name, result in self.results.items():
+            before = previous['results'].get(name)
+            if before is None:
+                continue
+            change = (result['best_seconds'] - before['best_seconds']) / before['best_seconds'] * 100
+            line = '{:<24} {:>+8.1f}%'.format(name, change)
+            self.stdout.write(self.style.ERROR(line + '  regression') if change > threshold else line)
+
+    # -------------------------------------------------------------------------
+    # Benchmarks, each returns (function to time, calls per timing run, patches active while timing)
+    # -------------------------------------------------------------------------
+    def _settings(self, **overrides):
+        return override_settings(TASK_OUTBOX_ENABLED=False, **overrides)
+
+    def bench_queue_sqs(self):
+        payload = user_update_payload()
+        task = BenchmarkTask()
+        patches = [
+            self._settings(QUEUE_TYPE='sqs'),
+            mock.patch('apps.tasks.sqs.get_sqs_client', return_value=StubSQSClient()),
+            mock.patch('apps.tasks.sqs.get_sqs_queue_url', return_value='https://sqs.local/queue'),
+        ]
+        return lambda: task.queue(*payload['args'], **payload['kwargs']), self.number, patches
+
+    def bench_queue_celery(self):
+        payload = user_update_payload()
+        task = BenchmarkTask()
+        patches = [
+            self._settings(QUEUE_TYPE='celery'),
+            mock.patch.object(BenchmarkTask, 'celery_task_function', StubCeleryTask()),
+        ]
+        return lambda: task.queue(*payload['args'], **payload['kwargs']), self.number, patches
+
+    def bench_eb_index(self):
+        from apps.tasks.eb_worker import eb_index
+
+        registry = TaskRegistry()
+        registry.register(BenchmarkTask)
+        factory = RequestFactory()
+        # A fresh task id per request, so the idempotency store does not skip them as redeliveries.
+        requests = iter([
+            factory.post(
+                '/', data=BenchmarkTask.build_payload([1], {'source': 'benchmark'}), content_type='application/json')
+            for _ in range(self.number * self.repeat)
+        ])
+        patches = [
+            self._settings(QUEUE_TYPE='sqs'),
+            mock.patch('apps.tasks.dispatcher.task_registry', registry),
+            mock.patch('apps.tasks.eb_worker.task_registry', registry),
+            mock.patch('apps.tasks.metrics.get_redis_connection', return_value=StubRedis()),
+            mock.patch('apps.tasks.idempotency.get_cache', return_value=LocMemCache('benchmark', {})),
+        ]
+        return lambda: eb_index(next(requests)), self.number, patches
+
+    def bench_fcm_send(self, size):
+        from apps.notifications import fcm
+
+        registration_ids = ['token-{:07d}'.format(index) for index in range(size)]
+        stub = mock.patch.object(fcm, 'LegacyFCMNotification', StubPushService)
+        with stub:
+            notifier = fcm.FCMNotifier()
+
+        def run():
+            notifier.send(registration_ids=registration_ids, message_title='Title', message_body='Body')
+        # The chunk sender threads create their own push service while timing.
+        return run, 1, [stub]
+
+    def bench_fcm_send_bulk(self):
+        from apps.notifications import fcm
+
+        # A templated campaign: 10 distinct payloads and 1% of unique ones.
+        messages = [
+            ('token-{:07d}'.format(index), 'Title', 'Body {}'.format(index % 10 if index % 100 else index), None)
+            for index in range(100000)
+        ]
+        stub = mock.patch.object(fcm, 'LegacyFCMNotification', StubPushService)
+        with stub:
+            notifier = fcm.FCMNotifier()
+
+        def run():
+            notifier.send_bulk(messages)
+        return run, 1, [stub]
+
+    def bench_sns_register(self):
+        from apps.notifications import sns
+
+        device_token = 'device-token'
+        with mock.patch.object(sns, 'get_client', return_value=StubAWSClient(device_token)):
+            client = sns.SNS()
+
+        def run():
+            # A new user each time: create the endpoint then verify its attributes.
+            client.endpoint_arn = None
+            client.registerWithSNS(sns.Notification.ANDROID, device_token, 'user-1')
+        return run, self.number, [self._settings(SNS_ENDPOINT_CACHE_ENABLED=False)]
+
+    def bench_sns_register_cached(self):
+        from apps.notifications import sns, sns_endpoints
+
+        device_token = 'device-token'
+        with mock.patch.object(sns, 'get_client', return_value=StubAWSClient(device_token)):
+            client = sns.SNS()
+        platform_application_arn = client.get_platform_application_arn(sns.Notification.ANDROID)
+        cache = LocMemCache('benchmark', {})
+        cache.set(sns_endpoints.cache_key(platform_application_arn, device_token), {
+            'endpoint_arn': 'arn:aws:sns:ca-central-1:000000000000:endpoint/GCM/app/{}'.format(device_token),
+            'verified_at': time.time(),
+        })
+
+        def run():
+            # A known device with a fresh cache entry: no SNS call.
+            client.endpoint_arn = None
+            client.registerWithSNS(sns.Notification.ANDROID, device_token, 'user-1')
+        return run, self.number, [
+            self._settings(SNS_ENDPOINT_CACHE_ENABLED=True),
+            mock.patch.object(sns_endpoints, 'get_cache', return_value=cache),
+        ]
+
+    def bench_ses_send(self):
+        from apps.notifications import ses
+
+        with mock.patch.object(ses, 'get_client', return_value=StubAWSClient()):
+            client = ses.SES()
+        destination = {'ToAddresses': ['jane.doe@example.com']}
+        message = {
+            'Subject': {'Data': 'Your weekly summary'},
+            'Body': {'Html': {'Data': '<p>Hello</p>'}},
+        }
+
+        def run():
+            client.send(destination, message)
+        return run, self.number, []
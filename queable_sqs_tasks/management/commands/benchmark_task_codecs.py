@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+import timeit
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from apps.tasks import codec
+
+
+def user_update_payload(members=1):
+    '''
+        A payload shaped like the UserUpdate task arguments (user profile sync with Unionware).
+    '''
+    profile = {
+        'user_id': 48213,
+        'uuid': uuid.uuid4(),
+        'first_name': 'Jane',
+        'last_name': 'Doe',
+        'email': 'jane.doe@example.com',
+        'phone_number': '+1-416-555-0142',
+        'date_of_birth': datetime.date(1984, 3, 17),
+        'updated_at': datetime.datetime.now(datetime.timezone.utc),
+        'address': {
+            'street': '25 Cecil St', 'city': 'Toronto', 'province': 'ON', 'postal_code': 'M5T 1N1',
+        },
+        'employers': [
+            {
+                'employer_id': 1200 + index, 'local': 'Local 1', 'unit': 'Unit {}'.format(index),
+                'hourly_rate': decimal.Decimal('27.45'),
+            }
+            for index in range(3)
+        ],
+        'preferences': {'language': 'en', 'push': True, 'email': False},
+    }
+    return {
+        'action': 'user_update',
+        'args': [profile['user_id']],
+        'kwargs': {'profiles': [profile] * members, 'source': 'profile_update'},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares encode/decode throughput and payload size of the task payload codecs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10000)
+        parser.add_argument('--members', type=int, default=1,
+                            help='Profiles per payload, to benchmark large argument lists.')
+
+    def handle(self, *args, **options):
+        payload = user_update_payload(options['members'])
+        iterations = options['iterations']
+
+        implementations = [('json (stdlib)', codec.JSONCodec(), False)]
+        if codec.orjson is not None:
+            implementations.append(('json (orjson)', codec.JSONCodec(), True))
+        if codec.msgpack is not None:
+            implementations.append(('msgpack', codec.MsgpackCodec(), True))
+
+        self.stdout.write('{:<16} {:>14} {:>14} {:>10}'.format('CODEC', 'ENCODE ops/s', 'DECODE ops/s', 'BYTES'))
+        for name, implementation, use_orjson in implementations:
+            orjson = codec.orjson
+            if not use_orjson:
+                # Benchmark the stdlib fallback even when orjson is installed.
+                codec.orjson = None
+            try:
+                message = implementation.encode(payload)
+                encode_seconds = timeit.timeit(lambda: implementation.encode(payload), number=iterations)
+                decode_seconds = timeit.timeit(
+                    lambda: codec.decode_payload(codec.loads(message)), number=iterations)
+            finally:
+                codec.orjson = orjson
+
+            self.stdout.write('{:<16} {:>14,.0f} {:>14,.0f} {:>10}'.format(
+                name, iterations / encode_seconds, iterations / decode_seconds, len(message.encode('utf-8'))))
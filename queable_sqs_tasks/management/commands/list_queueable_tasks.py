@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from apps.tasks.registry import task_registry
+
+
+class Command(BaseCommand):
+    help = 'Lists the registered QueueableTask actions with the import cost of their tasks module.'
+
+    def handle(self, *args, **options):
+        if not len(task_registry):
+            self.stdout.write(self.style.WARNING('No QueueableTask actions registered.'))
+            return
+
+        self.stdout.write('{:<40} {:<60} {:>12}'.format('ACTION', 'CLASS', 'IMPORT (ms)'))
+        for action, task_class in sorted(task_registry.items()):
+            cost = task_registry.import_cost(task_class)
+            self.stdout.write('{:<40} {:<60} {:>12}'.format(
+                action,
+                '{}.{}'.format(task_class.__module__, task_class.__qualname__),
+                '{:.2f}'.format(cost * 1000) if cost is not None else 'preloaded',
+            ))
+        self.stdout.write('{} actions, registry frozen: {}'.format(len(task_registry), task_registry.frozen))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.tasks import outbox
+
+
+class Command(BaseCommand):
+    help = 'Drains the TaskOutbox table into SQS with batched sends (TASK_OUTBOX_ENABLED).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the outbox is empty.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Rows leased per relay batch, defaults to TASK_OUTBOX_RELAY_BATCH_SIZE.')
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit.')
+
+    def handle(self, *args, **options):
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self._stopping:
+            sent = outbox.relay(options['batch_size'])
+            if sent:
+                self.stdout.write('Relayed {} task(s)'.format(sent))
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+    def stop(self, *args):
+        self._stopping = True
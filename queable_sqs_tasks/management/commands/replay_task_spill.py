@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.tasks import spill
+
+
+class Command(BaseCommand):
+    help = 'Sends the SQS messages spilled to the local journal (TASK_SPILL_DIR) once SQS is reachable again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to sleep when nothing could be replayed.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Messages per batch, defaults to TASK_SPILL_REPLAY_BATCH_SIZE.')
+        parser.add_argument('--once', action='store_true', help='Replay the sealed segments once and exit.')
+
+    def handle(self, *args, **options):
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self._stopping:
+            sent = spill.replay(options['batch_size'])
+            if sent:
+                self.stdout.write('Replayed {} spilled message(s)'.format(sent))
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+    def stop(self, *args):
+        self._stopping = True
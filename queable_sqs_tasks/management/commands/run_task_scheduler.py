@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.tasks import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Queues the delayed tasks held by the redis scheduler once they are due (QueueableTask.queue_in / queue_at).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when no task is due.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Tasks claimed per tick, defaults to TASK_SCHEDULER_BATCH_SIZE.')
+        parser.add_argument('--once', action='store_true', help='Queue the due tasks once and exit.')
+
+    def handle(self, *args, **options):
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self._stopping:
+            queued = scheduler.promote_due(options['batch_size'])
+            if queued:
+                self.stdout.write('Queued {} scheduled task(s)'.format(queued))
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+    def stop(self, *args):
+        self._stopping = True
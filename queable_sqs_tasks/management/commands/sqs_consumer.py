@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from apps.tasks.consumer import SQSConsumer, SQS_MAX_WAIT_TIME_SECONDS
+
+
+class Command(BaseCommand):
+    help = 'Consumes QueueableTask messages from SQS with long polling (alternative to the EB worker daemon).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lanes', default='default',
+                            help='Comma separated TASK_QUEUES lanes to consume, polled by their weight.')
+        parser.add_argument('--workers', type=int, help='Concurrent tasks, defaults to SQS_CONSUMER_WORKERS.')
+        parser.add_argument('--visibility-timeout', type=int,
+                            help='Seconds a received message stays invisible, '
+                                 'defaults to SQS_CONSUMER_VISIBILITY_TIMEOUT.')
+        parser.add_argument('--wait-time', type=int, default=SQS_MAX_WAIT_TIME_SECONDS,
+                            help='Long polling wait time in seconds (max 20).')
+
+    def handle(self, *args, **options):
+        consumer = SQSConsumer(
+            lane_names=options['lanes'].split(','),
+            workers=options['workers'],
+            visibility_timeout=options['visibility_timeout'],
+            wait_time_seconds=options['wait_time'],
+        )
+        # SIGTERM stops receiving and waits for in-flight tasks before exiting.
+        consumer.install_signal_handlers()
+        consumer.run()
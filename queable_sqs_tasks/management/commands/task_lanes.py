@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.tasks import lanes, metrics
+from apps.tasks.registry import task_registry
+
+
+def format_p95(wait) -> str:
+    if wait['p95_seconds'] is None:
+        return '>{}s'.format(metrics.HISTOGRAMS[metrics.LANE_WAIT][1][-1])
+    return '<={}s'.format(wait['p95_seconds'])
+
+
+class Command(BaseCommand):
+    help = ('Lists the task lanes with their queues, weight, current depth, '
+            'queue wait (average and 95th percentile, SQS consumers) and routed actions.')
+
+    def handle(self, *args, **options):
+        depths = lanes.get_lane_depths()
+        waits = lanes.get_wait_stats()
+        backend = 'sqs' if settings.QUEUE_TYPE == 'sqs' else 'celery'
+
+        self.stdout.write('{:<14} {:<40} {:>6} {:>8} {:>9} {:>9}  {}'.format(
+            'LANE', 'QUEUE', 'WEIGHT', 'DEPTH', 'WAIT AVG', 'WAIT P95', 'ACTIONS'))
+        for lane, config in settings.TASK_QUEUES.items():
+            actions = sorted(
+                action for action, task_class in task_registry.items()
+                if (task_class.QUEUE or lanes.DEFAULT_LANE) == lane
+            )
+            wait = waits.get(lane)
+            self.stdout.write('{:<14} {:<40} {:>6} {:>8} {:>9} {:>9}  {}'.format(
+                lane,
+                config[backend],
+                config.get('weight', 1),
+                depths[lane] if depths[lane] is not None else '?',
+                '{:.2f}s'.format(wait['avg_seconds']) if wait else '-',
+                format_p95(wait) if wait else '-',
+                ', '.join(actions),
+            ))
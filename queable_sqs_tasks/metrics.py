@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+'''
+    Task metrics shared by the whole worker fleet.
+    Histograms and counters are kept in redis hashes (one pipeline per executed task) so the
+    Prometheus endpoint (eb_worker.task_metrics) reports the same numbers whichever gunicorn
+    worker or instance serves the scrape.
+        tasks:metrics:<name>  field '<labels>|<le>' (bucket), '<labels>|sum', '<labels>|count'
+    Gauges are kept per worker process (instance label), in a hash of their own which expires:
+        tasks:metrics:<name>:<hostname:pid>  field '<labels>'
+    Gauges are set in memory, a heartbeat thread of the process publishes them at most every
+    GAUGE_PUBLISH_INTERVAL seconds when they change and every TASK_METRICS_GAUGE_TTL / 3 seconds
+    anyway, so setting a gauge never waits on redis and the series of recycled or killed
+    workers disappear after TASK_METRICS_GAUGE_TTL.
+'''
+
+KEY = 'tasks:metrics:{name}'
+GAUGE_KEY = 'tasks:metrics:{name}:{instance}'
+GAUGE_PUBLISH_INTERVAL = 1  # seconds
+
+QUEUE_WAIT = 'queueable_task_queue_wait_seconds'
+LANE_WAIT = 'queueable_task_lane_wait_seconds'
+RUN_DURATION = 'queueable_task_run_seconds'
+PAYLOAD_SIZE = 'queueable_task_payload_bytes'
+TASKS_TOTAL = 'queueable_task_total'
+IDEMPOTENCY_TOTAL = 'queueable_task_idempotency_total'
+IN_FLIGHT = 'queueable_task_in_flight'
+FCM_RESEND_TOTAL = 'fcm_resend_tokens_total'
+COALESCED_TOTAL = 'queueable_task_coalesced_total'
+PAYLOAD_RAW_BYTES_TOTAL = 'queueable_task_payload_raw_bytes_total'
+PAYLOAD_ENCODED_BYTES_TOTAL = 'queueable_task_payload_encoded_bytes_total'
+PAYLOAD_ENVELOPE_TOTAL = 'queueable_task_payload_envelope_total'
+
+HISTOGRAMS = {
+    QUEUE_WAIT: (
+        'Seconds between QueueableTask.queue and the start of the task.',
+        (0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+    ),
+    LANE_WAIT: (
+        'Seconds between the SQS send of a message and its receive by an SQS consumer, per lane.',
+        (0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+    ),
+    RUN_DURATION: (
+        'Seconds spent running the task.',
+        (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+    ),
+    PAYLOAD_SIZE: (
+        'Size in bytes of the queued task message.',
+        (256, 1024, 4096, 16384, 65536, 262144),
+    ),
+}
+
+COUNTERS = {
+    TASKS_TOTAL: 'Executed tasks by status.',
+    IDEMPOTENCY_TOTAL: 'Idempotency checks of delivered tasks: hit (already done), in_progress or miss (run).',
+    FCM_RESEND_TOTAL: 'FCM tokens by resend attempt: queued, failed (not queued) or exhausted (given up).',
+    COALESCED_TOTAL: 'Enqueues dropped by coalescing (see QueueableTask.COALESCE_WINDOW), ie. task runs saved.',
+    PAYLOAD_RAW_BYTES_TOTAL: 'Bytes of the enqueued SQS task payloads before the envelope (see envelope.py).',
+    PAYLOAD_ENCODED_BYTES_TOTAL: 'Bytes of the enqueued SQS task messages, over the raw bytes: the compression ratio.',
+    PAYLOAD_ENVELOPE_TOTAL: 'Enqueued SQS task messages by envelope: plain, compressed or claim_check.',
+}
+
+GAUGES = {
+    IN_FLIGHT: 'Tasks admitted by eb_index / eb_batch and still running, per worker process.',
+}
+
+
+def _instance() -> str:
+    # Resolved on each call, the pid changes in forked workers.
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def _labels(**labels) -> str:
+    return ','.join('{}="{}"'.format(name, value) for name, value in sorted(labels.items()))
+
+
+def _observe(pipeline, name, value, labels):
+    key = KEY.format(name=name)
+    for le in HISTOGRAMS[name][1]:
+        if value <= le:
+            pipeline.hincrby(key, '{}|{}'.format(labels, le), 1)
+    pipeline.hincrby(key, '{}|+Inf'.format(labels), 1)
+    pipeline.hincrbyfloat(key, '{}|sum'.format(labels), value)
+    pipeline.hincrby(key, '{}|count'.format(labels), 1)
+
+
+def record_task(action, backend, status, run_seconds=None, wait_seconds=None, payload_bytes=None):
+    '''
+        Records one dispatched task (run_seconds is None if it did not run, eg. deferred).
+        Never raises, metrics must not fail tasks.
+    '''
+    labels = _labels(action=action, backend=backend)
+    try:
+        pipeline = get_redis_connection(settings.TASK_METRICS_CACHE).pipeline(transaction=False)
+        pipeline.hincrby(KEY.format(name=TASKS_TOTAL), _labels(action=action, backend=backend, status=status), 1)
+        if run_seconds is not None:
+            _observe(pipeline, RUN_DURATION, run_seconds, labels)
+        if wait_seconds is not None:
+            _observe(pipeline, QUEUE_WAIT, max(0.0, wait_seconds), labels)
+        if payload_bytes is not None:
+            _observe(pipeline, PAYLOAD_SIZE, payload_bytes, labels)
+        pipeline.execute()
+    except Exception as error:
+        logger.error("[ metrics ] failed to record {} task metrics: {}".format(action, error))
+
+
+def record_lane_wait(lane, seconds):
+    '''
+        Records the queue wait of one message received by an SQS consumer (see lanes.py). Never raises.
+    '''
+    try:
+        pipeline = get_redis_connection(settings.TASK_METRICS_CACHE).pipeline(transaction=False)
+        _observe(pipeline, LANE_WAIT, seconds, _labels(lane=lane))
+        pipeline.execute()
+    except Exception as error:
+        logger.error("[ metrics ] failed to record {} lane wait: {}".format(lane, error))
+
+
+def record_payload(action, envelope, raw_bytes, encoded_bytes):
+    '''
+        Counts one packed task payload (see envelope.py). Never raises.
+    '''
+    labels = _labels(action=action)
+    try:
+        pipeline = get_redis_connection(settings.TASK_METRICS_CACHE).pipeline(transaction=False)
+        pipeline.hincrby(KEY.format(name=PAYLOAD_RAW_BYTES_TOTAL), labels, raw_bytes)
+        pipeline.hincrby(KEY.format(name=PAYLOAD_ENCODED_BYTES_TOTAL), labels, encoded_bytes)
+        pipeline.hincrby(KEY.format(name=PAYLOAD_ENVELOPE_TOTAL), _labels(action=action, envelope=envelope), 1)
+        pipeline.execute()
+    except Exception as error:
+        logger.error("[ metrics ] failed to record {} payload metrics: {}".format(action, error))
+
+
+def record_coalesced(action, count=1):
+    '''
+        Counts enqueues of action dropped by coalescing (see coalesce.py). Never raises.
+    '''
+    try:
+        get_redis_connection(settings.TASK_METRICS_CACHE).hincrby(
+            KEY.format(name=COALESCED_TOTAL), _labels(action=action), count)
+    except Exception as error:
+        logger.error("[ metrics ] failed to record {} coalesce metrics: {}".format(action, error))
+
+
+def record_idempotency(action, result):
+    '''
+        Counts one idempotency check (see idempotency.py). Never raises.
+    '''
+    try:
+        get_redis_connection(settings.TASK_METRICS_CACHE).hincrby(
+            KEY.format(name=IDEMPOTENCY_TOTAL), _labels(action=action, result=result), 1)
+    except Exception as error:
+        logger.error("[ metrics ] failed to record {} idempotency metrics: {}".format(action, error))
+
+
+def record_fcm_resend(attempt, result, count):
+    '''
+        Counts the FCM tokens of a resend attempt (see apps/notifications/fcm_resend.py). Never raises.
+    '''
+    try:
+        get_redis_connection(settings.TASK_METRICS_CACHE).hincrby(
+            KEY.format(name=FCM_RESEND_TOTAL), _labels(attempt=attempt, result=result), count)
+    except Exception as error:
+        logger.error("[ metrics ] failed to record FCM resend metrics: {}".format(error))
+
+
+_gauge_lock = threading.Lock()
+_gauges = {}  # name -> {labels: value} of this process
+_gauges_changed = threading.Event()
+_heartbeat = None
+
+
+def _reset_after_fork():
+    # The parent's gauges and heartbeat thread are the parent's.
+    global _gauge_lock, _gauges, _gauges_changed, _heartbeat
+    _gauge_lock = threading.Lock()
+    _gauges = {}
+    _gauges_changed = threading.Event()
+    _heartbeat = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _publish_gauges():
+    with _gauge_lock:
+        gauges = {name: dict(values) for name, values in _gauges.items()}
+    instance = _instance()
+    pipeline = get_redis_connection(settings.TASK_METRICS_CACHE).pipeline(transaction=False)
+    for name, values in gauges.items():
+        key = GAUGE_KEY.format(name=name, instance=instance)
+        fields = {'{},instance="{}"'.format(labels, instance): value for labels, value in values.items()}
+        pipeline.hset(key, mapping=fields)
+        pipeline.expire(key, settings.TASK_METRICS_GAUGE_TTL)
+    pipeline.execute()
+
+
+def _heartbeat_loop():
+    while True:
+        _gauges_changed.wait(settings.TASK_METRICS_GAUGE_TTL / 3)
+        _gauges_changed.clear()
+        try:
+            _publish_gauges()
+        except Exception as error:
+            logger.error("[ metrics ] failed to refresh gauges: {}".format(error))
+        # Changes in between are published together on the next turn.
+        time.sleep(GAUGE_PUBLISH_INTERVAL)
+
+
+def _set_gauge(name, labels, value):
+    global _heartbeat
+    with _gauge_lock:
+        _gauges.setdefault(name, {})[labels] = value
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_heartbeat_loop, name='metrics-heartbeat', daemon=True)
+            _heartbeat.start()
+    _gauges_changed.set()
+
+
+def set_in_flight(action, value):
+    '''
+        Sets the in-flight gauge of action for this process (see admission.py). Never raises.
+    '''
+    try:
+        _set_gauge(IN_FLIGHT, _labels(action=action), value)
+    except Exception as error:
+        logger.error("[ metrics ] failed to record {} in-flight gauge: {}".format(action, error))
+
+
+def _read_histogram(connection, name) -> dict:
+    # {'<labels>': {'<le>' | 'sum' | 'count': '<value>'}}
+    series = {}
+    for field, value in connection.hgetall(KEY.format(name=name)).items():
+        labels, _, suffix = field.decode('utf-8').rpartition('|')
+        series.setdefault(labels, {})[suffix] = value.decode('utf-8')
+    return series
+
+
+def get_histogram(name, **labels) -> dict:
+    '''
+        Fleet wide series of the histogram name with these labels: {'<le>' | 'sum' | 'count': '<value>'},
+        empty if it was never observed.
+    '''
+    return _read_histogram(get_redis_connection(settings.TASK_METRICS_CACHE), name).get(_labels(**labels), {})
+
+
+def render() -> str:
+    '''
+        All task metrics in the Prometheus text exposition format.
+    '''
+    connection = get_redis_connection(settings.TASK_METRICS_CACHE)
+    lines = []
+
+    for name, help_text in COUNTERS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for labels, value in sorted(connection.hgetall(KEY.format(name=name)).items()):
+            lines.append('{}{{{}}} {}'.format(name, labels.decode('utf-8'), value.decode('utf-8')))
+
+    for name, help_text in GAUGES.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        values = {}
+        for key in connection.scan_iter(match=GAUGE_KEY.format(name=name, instance='*')):
+            values.update(connection.hgetall(key))
+        for labels, value in sorted(values.items()):
+            lines.append('{}{{{}}} {}'.format(name, labels.decode('utf-8'), value.decode('utf-8')))
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels, values in sorted(_read_histogram(connection, name).items()):
+            for le in [str(le) for le in buckets] + ['+Inf']:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, values.get(le, '0')))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, values.get('sum', '0')))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, values.get('count', '0')))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+
+
+class TaskOutbox(models.Model):
+    '''
+        Transactional outbox of SQS messages (TASK_OUTBOX_ENABLED).
+        QueueableTask.queue inserts a row in the caller's transaction, so tasks of rolled back
+        transactions are never sent, and the relay (python manage.py relay_task_outbox)
+        leases the rows, submits them in batches then deletes them.
+    '''
+    action = models.CharField(max_length=255)
+    queue_name = models.CharField(max_length=255)
+    body = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # SQS DelaySeconds requested by queue_in, counted from created_at.
+    delay_seconds = models.PositiveIntegerField(default=0)
+    # Claimed by a relay until then, see apps/tasks/outbox.py
+    leased_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return '{} --> {}'.format(self.action, self.queue_name)
+
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from apps.tasks.models import TaskOutbox
+from apps.tasks.sqs import submit_batch_to_sqs
+
+logger = logging.getLogger(__name__)
+
+'''
+    Transactional outbox (TASK_OUTBOX_ENABLED): web requests write SQS messages to the
+    TaskOutbox table in their own transaction instead of calling SQS, and the relay drains
+    the table in bulk with SendMessageBatch.
+    The relay claims rows in a short transaction, leasing them for TASK_OUTBOX_LEASE_SECONDS,
+    then sends them outside of it, so no row lock is held across the SQS calls.
+    Handoff is at-least-once: rows of a relay crashing after the send are sent again once
+    their lease expired.
+'''
+
+
+def enqueue(action, queue_name, bodies, delay_seconds=0) -> int:
+    '''
+        Writes the messages in the current transaction (or autocommits them).
+    '''
+    rows = TaskOutbox.objects.bulk_create(
+        TaskOutbox(action=action, queue_name=queue_name, body=body, delay_seconds=delay_seconds) for body in bodies
+    )
+    return len(rows)
+
+
+def claim(batch_size) -> list:
+    '''
+        Leases up to batch_size rows which are not leased by another relay.
+        Rows are locked with SKIP LOCKED only while they are claimed, so several relays can drain concurrently.
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            TaskOutbox.objects.select_for_update(skip_locked=True)
+            .filter(attempts__lt=settings.TASK_OUTBOX_MAX_ATTEMPTS)
+            .filter(Q(leased_until__isnull=True) | Q(leased_until__lt=now))
+            .order_by('id')
+            .values_list('id', 'queue_name', 'body', 'created_at', 'delay_seconds')[:batch_size]
+        )
+        if rows:
+            TaskOutbox.objects.filter(id__in=[row[0] for row in rows]).update(
+                leased_until=now + datetime.timedelta(seconds=settings.TASK_OUTBOX_LEASE_SECONDS))
+    return rows
+
+
+def relay(batch_size=None) -> int:
+    '''
+        Submits up to batch_size outbox rows and deletes the ones SQS accepted.
+        Rows which failed TASK_OUTBOX_MAX_ATTEMPTS times are left in the table for inspection.
+        Delayed rows are sent with what is left of their delay.
+        Returns the number of rows sent.
+    '''
+    rows = claim(batch_size or settings.TASK_OUTBOX_RELAY_BATCH_SIZE)
+    if not rows:
+        return 0
+
+    now = timezone.now()
+    by_queue = defaultdict(list)
+    for row_id, queue_name, body, created_at, delay_seconds in rows:
+        remaining = max(0, delay_seconds - int((now - created_at).total_seconds()))
+        by_queue[queue_name].append((row_id, body, remaining))
+
+    sent = failed = 0
+    for queue_name, messages in by_queue.items():
+        # Unsent rows stay in the outbox, which is already durable.
+        results = submit_batch_to_sqs(
+            [body for _, body, _ in messages], queue_name, [remaining for _, _, remaining in messages],
+            spill_unsent=False)
+        if len(results) != len(messages):
+            # Rows cannot be matched with their results, they are sent again when the lease expires.
+            raise RuntimeError("{} results for {} outbox messages to {}".format(
+                len(results), len(messages), queue_name))
+
+        sent_ids = [row_id for (row_id, _, _), result in zip(messages, results) if result]
+        failed_ids = [row_id for (row_id, _, _), result in zip(messages, results) if not result]
+        TaskOutbox.objects.filter(id__in=sent_ids).delete()
+        if failed_ids:
+            TaskOutbox.objects.filter(id__in=failed_ids).update(attempts=F('attempts') + 1, leased_until=None)
+        sent += len(sent_ids)
+        failed += len(failed_ids)
+
+    if failed:
+        logger.warning("[ outbox ] {} of {} messages could not be sent, will retry".format(failed, len(rows)))
+    return sent
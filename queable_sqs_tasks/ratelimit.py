@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import random
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+'''
+    Distributed token bucket per action (see QueueableTask.RATE_LIMIT / RATE_LIMIT_BURST).
+    The bucket lives in redis and is updated atomically by a lua script, so the limit holds
+    across every worker process. The script reads the clock of redis (TIME), so skewed worker
+    clocks cannot refill a bucket early. Tasks over the limit raise TaskDeferred and are pushed
+    back on the queue instead of being run and failing:
+        SQS consumer    the message is sent again with DelaySeconds and the received copy deleted,
+                        so deferrals do not count toward the maxReceiveCount of the redrive policy
+        EB daemon       eb_index answers 429 and the daemon redelivers the same message, every
+                        deferral counts as a receive: keep maxReceiveCount above the deferrals a
+                        rate limited action may take or its messages end up in the dead letter queue
+        celery          retried with a countdown, max_retries=None
+'''
+
+BUCKET_KEY = 'tasks:ratelimit:{action}'
+
+# KEYS[1] bucket, ARGV: rate (tokens/s), burst. Returns {allowed, seconds until a token is available}.
+# TIME is non deterministic, replicate_commands (a no-op from redis 5) replicates the writes instead.
+TOKEN_BUCKET_SCRIPT = '''
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after)}
+'''
+
+_script = None
+
+
+class TaskDeferred(Exception):
+    '''
+        Raised by the dispatcher when the action is over its rate limit.
+    '''
+    def __init__(self, action, retry_after):
+        self.action = action
+        self.retry_after = retry_after
+        super().__init__("Task {} is rate limited, retry after {:.2f}s".format(action, retry_after))
+
+
+def _get_script():
+    global _script
+    if _script is None:
+        _script = get_redis_connection(settings.TASK_RATE_LIMIT_CACHE).register_script(TOKEN_BUCKET_SCRIPT)
+    return _script
+
+
+def acquire(action, rate, burst=None):
+    '''
+        Takes a token from the bucket of action. Returns (allowed, retry_after seconds).
+        Fails open (allowed) if redis is unavailable.
+    '''
+    burst = burst or max(1, rate)
+    try:
+        allowed, retry_after = _get_script()(keys=[BUCKET_KEY.format(action=action)], args=[rate, burst])
+    except Exception as error:
+        logger.error("[ ratelimit ] redis unavailable, not limiting {}: {}".format(action, error))
+        return True, 0.0
+    return bool(int(allowed)), float(retry_after)
+
+
+def check(task_class):
+    '''
+        Raises TaskDeferred if task_class declares a RATE_LIMIT and its bucket is empty.
+    '''
+    if not task_class.RATE_LIMIT:
+        return
+    allowed, retry_after = acquire(task_class.ACTION_NAME, task_class.RATE_LIMIT, task_class.RATE_LIMIT_BURST)
+    if not allowed:
+        logger.info("[ ratelimit ] {} deferred, retry after {:.2f}s".format(task_class.ACTION_NAME, retry_after))
+        raise TaskDeferred(task_class.ACTION_NAME, retry_after)
+
+
+def defer_delay(retry_after) -> int:
+    '''
+        Whole seconds to push a deferred task back by. Jittered so a drained backlog
+        does not come back all at once.
+    '''
+    delay = retry_after + random.uniform(0, settings.TASK_RATE_LIMIT_DEFER_JITTER)
+    return max(1, min(int(math.ceil(delay)), settings.TASK_RATE_LIMIT_MAX_DEFER))
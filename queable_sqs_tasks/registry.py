@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from importlib import import_module
+
+from django.apps import apps as django_apps
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import module_has_submodule
+
+logger = logging.getLogger(__name__)
+
+'''
+    Registry of QueueableTask sub-classes keyed by ACTION_NAME.
+    Sub-classes register themselves when they are defined (QueueableTask.__init_subclass__),
+    so eb_worker.py can dispatch an action with a dict lookup instead of scanning modules.
+    Tasks must be located in a `tasks` module of an installed app. E.g. apps.campaigns.tasks
+'''
+
+TASKS_MODULE_NAME = 'tasks'
+
+
+class TaskRegistry:
+
+    def __init__(self):
+        self._tasks = {}
+        self._import_costs = {}  # module name -> seconds spent importing it during autodiscover
+        self._frozen = False
+
+    def __contains__(self, action):
+        return action in self._tasks
+
+    def __getitem__(self, action):
+        return self._tasks[action]
+
+    def __len__(self):
+        return len(self._tasks)
+
+    @property
+    def frozen(self):
+        return self._frozen
+
+    def get(self, action):
+        return self._tasks.get(action)
+
+    def items(self):
+        return self._tasks.items()
+
+    def as_dict(self) -> dict:
+        return dict(self._tasks)
+
+    def register(self, task_class):
+        '''
+            Registers task_class under its ACTION_NAME.
+            Raises ImproperlyConfigured if another class already uses the same ACTION_NAME
+            or if the registry was frozen at worker startup.
+        '''
+        action = task_class.ACTION_NAME
+        existing = self._tasks.get(action)
+        if existing is not None and _class_path(existing) != _class_path(task_class):
+            raise ImproperlyConfigured("Duplicate QueueableTask ACTION_NAME '{}': {} and {}".format(
+                action, _class_path(existing), _class_path(task_class)))
+        if self._frozen and existing is None:
+            raise ImproperlyConfigured("QueueableTask registry is frozen, cannot register '{}' ({})".format(
+                action, _class_path(task_class)))
+
+        self._tasks[action] = task_class
+        logger.debug("[ TaskRegistry ] registered {} --> {}".format(action, _class_path(task_class)))
+
+    def autodiscover(self):
+        '''
+            Imports the tasks module of every installed app so all QueueableTask sub-classes
+            get registered, recording how long each import took.
+        '''
+        for app_config in django_apps.get_app_configs():
+            if not module_has_submodule(app_config.module, TASKS_MODULE_NAME):
+                continue
+            module_name = '{}.{}'.format(app_config.name, TASKS_MODULE_NAME)
+            start = time.perf_counter()
+            import_module(module_name)
+            self._import_costs.setdefault(module_name, time.perf_counter() - start)
+
+    def freeze(self):
+        self._frozen = True
+        logger.info("[ TaskRegistry ] frozen with {} actions: {}".format(len(self._tasks), sorted(self._tasks)))
+
+    def import_cost(self, task_class):
+        '''
+            Returns the seconds spent importing the module of task_class during autodiscover,
+            or None if the module was already imported before autodiscover ran.
+        '''
+        return self._import_costs.get(task_class.__module__)
+
+
+def _class_path(task_class):
+    return '{}.{}'.format(task_class.__module__, task_class.__qualname__)
+
+
+task_registry = TaskRegistry()
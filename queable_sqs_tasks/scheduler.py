@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django_redis import get_redis_connection
+
+from apps.tasks.registry import task_registry
+
+logger = logging.getLogger(__name__)
+
+'''
+    Scheduler for tasks due later than the queue can delay natively (SQS DelaySeconds is capped
+    at 15 minutes, see QueueableTask.queue_in / queue_at).
+    Scheduled tasks are members of a redis sorted set scored by their due timestamp:
+        tasks:scheduled  member '{"id": ..., "action": ..., "args": [...], "kwargs": {...}}'  score eta
+    The ticker (python manage.py run_task_scheduler) claims due members in batches and queues them
+    with QueueableTask.queue_many. Claimed members are re-scored TASK_SCHEDULER_LEASE seconds ahead
+    instead of being removed, and removed once queued, so a ticker dying mid batch only delays them.
+'''
+
+SCHEDULE_KEY = 'tasks:scheduled'
+
+# KEYS[1] schedule, ARGV: now, batch size, lease (s). Returns the claimed members.
+CLAIM_DUE_SCRIPT = '''
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local lease_until = tonumber(ARGV[1]) + tonumber(ARGV[3])
+for _, member in ipairs(members) do
+    redis.call('ZADD', KEYS[1], lease_until, member)
+end
+return members
+'''
+
+_script = None
+
+
+def _get_connection():
+    return get_redis_connection(settings.TASK_SCHEDULER_CACHE)
+
+
+def _get_script():
+    global _script
+    if _script is None:
+        _script = _get_connection().register_script(CLAIM_DUE_SCRIPT)
+    return _script
+
+
+def schedule(action, args, kwargs, eta) -> bool:
+    '''
+        Adds a task due at eta (unix timestamp). Returns False if redis is unavailable.
+    '''
+    member = json.dumps(
+        {'id': uuid.uuid4().hex, 'action': action, 'args': list(args), 'kwargs': kwargs}, cls=DjangoJSONEncoder)
+    try:
+        _get_connection().zadd(SCHEDULE_KEY, {member: eta})
+    except Exception as error:
+        logger.error("[ scheduler ] failed to schedule {}: {}".format(action, error))
+        return False
+    return True
+
+
+def promote_due(batch_size=None) -> int:
+    '''
+        Queues up to batch_size due tasks and returns the number queued.
+        Tasks which could not be queued stay claimed and are retried once their lease expires.
+    '''
+    batch_size = batch_size or settings.TASK_SCHEDULER_BATCH_SIZE
+    members = _get_script()(keys=[SCHEDULE_KEY], args=[time.time(), batch_size, settings.TASK_SCHEDULER_LEASE])
+    if not members:
+        return 0
+
+    by_action = defaultdict(list)
+    done = []
+    for member in members:
+        task = json.loads(member)
+        if task['action'] not in task_registry:
+            logger.error("[ scheduler ] dropping scheduled task of unknown action {}".format(task['action']))
+            done.append(member)
+            continue
+        by_action[task['action']].append((member, task))
+
+    queued = 0
+    for action, tasks in by_action.items():
+        results = task_registry[action].queue_many((task['args'], task['kwargs']) for _, task in tasks)
+        for (member, _), result in zip(tasks, results):
+            if result:
+                done.append(member)
+                queued += 1
+        failed = results.count(False)
+        if failed:
+            logger.warning("[ scheduler ] {} of {} {} tasks could not be queued, will retry".format(
+                failed, len(results), action))
+
+    if done:
+        _get_connection().zrem(SCHEDULE_KEY, *done)
+    return queued
+
+
+def get_schedule_stats() -> dict:
+    '''
+        Number of scheduled tasks and how many of them are already due.
+    '''
+    connection = _get_connection()
+    return {
+        'scheduled': connection.zcard(SCHEDULE_KEY),
+        'due': connection.zcount(SCHEDULE_KEY, '-inf', time.time()),
+    }
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+'''
+    Local disk spill journal for SQS messages which could not be sent (SQS errors or the SQS
+    circuit breaker open, see sqs.py), so producers stay fast during AWS brownouts and no task is lost.
+    Each process appends json lines to its own segment file in TASK_SPILL_DIR:
+        <pid>-<uuid>.new      segment being created, ignored
+        <pid>-<uuid>.open     segment being written, exclusively flock()ed by its writer
+        <pid>-<uuid>.log      sealed segment, ready to be replayed
+        {"queue": ..., "eta": <unix time the message may be delivered>, "body": ...}
+    The writer holds its lock until it seals the segment, and the kernel drops it when the process
+    dies, so the replayer only seals .open segments it can lock: pids are meaningless across the
+    PID namespaces of containers sharing the directory, locks are not. The replayer also locks the
+    sealed segment it replays, so concurrent replayers skip it.
+    TASK_SPILL_DIR must be a persistent volume (container file systems do not survive a
+    redeploy), shared with the replayer; spilling is disabled when it is not set.
+    Writes are flushed on every append and fsynced in batches (every TASK_SPILL_FSYNC_EVERY
+    records or TASK_SPILL_FSYNC_INTERVAL seconds), so a process crash loses nothing and a host
+    crash at most the last unsynced batch. Segments are sealed once they reach
+    TASK_SPILL_SEGMENT_BYTES or as soon as SQS accepts a message again, and the replayer
+    (python manage.py replay_task_spill, on every host) sends sealed segments in batches.
+    Replay is at-least-once: a replayer crashing mid segment resends it.
+'''
+
+NEW_SUFFIX = '.new'
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.log'
+
+
+class SpillJournal:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._unsynced = 0
+        self._synced_at = 0.0
+
+    def append(self, queue_name, json_payload, delay_seconds=0) -> bool:
+        '''
+            Journals a message. Returns False if it could not be written.
+        '''
+        line = json.dumps({'queue': queue_name, 'eta': time.time() + delay_seconds, 'body': json_payload}) + '\n'
+        data = line.encode('utf-8')
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._open()
+                self._file.write(data)
+                self._file.flush()
+                self._size += len(data)
+                self._unsynced += 1
+                if (self._unsynced >= settings.TASK_SPILL_FSYNC_EVERY
+                        or time.monotonic() - self._synced_at >= settings.TASK_SPILL_FSYNC_INTERVAL):
+                    self._sync()
+                if self._size >= settings.TASK_SPILL_SEGMENT_BYTES:
+                    self._seal()
+        except OSError as error:
+            logger.error("[ spill ] failed to journal message for {}: {}".format(queue_name, error))
+            return False
+        return True
+
+    def seal(self):
+        '''
+            Seals the current segment so the replayer picks it up. No-op when nothing was spilled.
+        '''
+        if self._file is None:
+            return
+        try:
+            with self._lock:
+                if self._file is not None:
+                    self._seal()
+        except OSError as error:
+            logger.error("[ spill ] failed to seal {}: {}".format(self._path, error))
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.join(self.directory, '{}-{}'.format(os.getpid(), uuid.uuid4().hex))
+        # Locked before it is visible as .open, so a replayer never seals it under the writer.
+        segment = open(name + NEW_SUFFIX, 'ab')
+        try:
+            fcntl.flock(segment.fileno(), fcntl.LOCK_EX)
+            os.rename(name + NEW_SUFFIX, name + OPEN_SUFFIX)
+        except OSError:
+            segment.close()
+            raise
+        self._path = name + OPEN_SUFFIX
+        self._file = segment
+        self._size = 0
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        logger.warning("[ spill ] journaling SQS messages to {}".format(self._path))
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _seal(self):
+        self._sync()
+        # Renamed while still locked, closing the file releases the lock.
+        os.rename(self._path, self._path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self._file.close()
+        logger.info("[ spill ] sealed {} ({} bytes)".format(self._path, self._size))
+        self._file = None
+        self._path = None
+
+    def _reset_after_fork(self):
+        # The parent's segment stays the parent's, the child opens its own. The inherited
+        # descriptor shares the parent's lock, it must not keep it after the parent died.
+        self._lock = threading.Lock()
+        if self._file is not None:
+            try:
+                os.close(self._file.fileno())
+            except OSError:
+                pass
+        self._file = None
+        self._path = None
+
+
+_journal = None
+
+
+def get_journal():
+    global _journal
+    if _journal is None and settings.TASK_SPILL_DIR:
+        _journal = SpillJournal(settings.TASK_SPILL_DIR)
+        os.register_at_fork(after_in_child=_journal._reset_after_fork)
+    return _journal
+
+
+def append(queue_name, json_payload, delay_seconds=0) -> bool:
+    journal = get_journal()
+    if journal is None:
+        return False
+    return journal.append(queue_name, json_payload, delay_seconds)
+
+
+def seal():
+    if _journal is not None:
+        _journal.seal()
+
+
+def try_lock(segment) -> bool:
+    '''
+        Takes the exclusive lock of an open segment file without waiting. False if another
+        process (a live writer or another replayer) holds it.
+    '''
+    try:
+        fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def seal_abandoned(path):
+    '''
+        Seals the .open segment at path if its writer is gone, ie. nobody holds its lock.
+        Returns the sealed path or None.
+    '''
+    try:
+        with open(path, 'rb') as segment:
+            if not try_lock(segment):
+                return None
+            sealed = path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX
+            os.rename(path, sealed)
+            return sealed
+    except FileNotFoundError:
+        # Sealed by its writer in between.
+        return None
+
+
+def sealed_segments(directory=None) -> list:
+    '''
+        Sealed segments, oldest first. Open segments whose writer is gone are sealed first.
+    '''
+    directory = directory or settings.TASK_SPILL_DIR
+    if not directory or not os.path.isdir(directory):
+        return []
+
+    segments = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(OPEN_SUFFIX):
+            sealed = seal_abandoned(path)
+            if sealed:
+                segments.append(sealed)
+        elif name.endswith(SEALED_SUFFIX):
+            segments.append(path)
+    return sorted(segments, key=os.path.getmtime)
+
+
+def replay_segment(path, batch_size=None) -> tuple:
+    '''
+        Sends the messages of a sealed segment in batches. Returns (sent, failed).
+        The segment is deleted once every message was sent, messages which failed are
+        journaled again (in a new segment) unless nothing could be sent, then the segment
+        is kept as is for the next replay. Messages SQS rejects as invalid (sender fault) can
+        never be sent: they are logged and dropped. Segments locked by another replayer are skipped.
+    '''
+    batch_size = batch_size or settings.TASK_SPILL_REPLAY_BATCH_SIZE
+    try:
+        segment = open(path, 'rb')
+    except FileNotFoundError:
+        # Replayed by another replayer in between.
+        return 0, 0
+    with segment:
+        if not try_lock(segment) or not _is_current(path, segment):
+            return 0, 0
+        return _replay_locked(path, segment, batch_size)
+
+
+def _is_current(path, segment) -> bool:
+    # A replayer which finished the segment before we got the lock has deleted it.
+    try:
+        return os.stat(path).st_ino == os.fstat(segment.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _replay_locked(path, segment, batch_size) -> tuple:
+    from apps.tasks.sqs import submit_batch
+
+    records = []
+    for line in segment:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # Torn last line of a crashed writer.
+            logger.error("[ spill ] skipping corrupt record in {}".format(path))
+    if not records:
+        os.remove(path)
+        return 0, 0
+
+    sent, failed, rejected = 0, [], 0
+    for index in range(0, len(records), batch_size):
+        by_queue = {}
+        for record in records[index:index + batch_size]:
+            by_queue.setdefault(record['queue'], []).append(record)
+        now = time.time()
+        for queue_name, queue_records in by_queue.items():
+            delays = [
+                min(settings.TASK_SCHEDULER_MAX_NATIVE_DELAY, max(0, int(record['eta'] - now)))
+                for record in queue_records
+            ]
+            bodies = [record['body'] for record in queue_records]
+            submitter = submit_batch(bodies, queue_name, delays, spill_unsent=False)
+            for position, (record, result) in enumerate(zip(queue_records, submitter.results)):
+                if result:
+                    sent += 1
+                elif position in submitter.rejected:
+                    rejected += 1
+                    logger.error("[ spill ] dropping message rejected by SQS for {}: {}".format(
+                        queue_name, record['body']))
+                else:
+                    failed.append(record)
+        if not sent and not rejected:
+            # SQS is still down, keep the segment untouched.
+            return 0, len(records)
+
+    journal = get_journal()
+    for record in failed:
+        journal.append(record['queue'], record['body'], max(0, record['eta'] - time.time()))
+    journal.seal()
+    os.remove(path)
+    return sent, len(failed)
+
+
+def replay(batch_size=None) -> int:
+    '''
+        Replays every sealed segment, stops at the first segment nothing could be sent from.
+        Returns the number of messages sent.
+    '''
+    total = 0
+    for path in sealed_segments():
+        sent, failed = replay_segment(path, batch_size)
+        total += sent
+        logger.info("[ spill ] replayed {}: {} sent, {} failed".format(path, sent, failed))
+        if failed and not sent:
+            break
+    return total
@@ -1,34 +1,243 @@
 # -*- coding: utf-8 -*-
 import logging
 import datetime
-import boto3
+import itertools
+import random
+import time
 
+from botocore.exceptions import ClientError
 from django.conf import settings
 
+from apps.tasks import breaker, spill
+from apps.tasks.aws import get_client, get_queue_url
+
 logger = logging.getLogger(__name__)
 
+# Shared by every SQS send of the process. While it is open messages go straight to the spill journal.
+sqs_breaker = breaker.CircuitBreaker('sqs', settings.TASK_SQS_BREAKER_FAILURES, settings.TASK_SQS_BREAKER_RESET_TIMEOUT)
+
+
+def get_sqs_client(region_name=None):
+    '''
+    Pooled SQS client, pointed at SQS_ENDPOINT_URL when a local stand-in is configured.
+    '''
+    return get_client('sqs', region_name=region_name or settings.SQS_REGION, endpoint_url=settings.SQS_ENDPOINT_URL)
+
+
+def get_sqs_queue_url(queue_name=None, region_name=None) -> str:
+    return get_queue_url(
+        queue_name or settings.SQS_QUEUE_NAME,
+        region_name=region_name or settings.SQS_REGION,
+        endpoint_url=settings.SQS_ENDPOINT_URL
+    )
+
+
+# Errors of SendMessage / SendMessageBatch caused by the message itself (eg. too large, invalid
+# characters): resending it can never succeed and says nothing about the health of SQS.
+MESSAGE_FAULT_CODES = {
+    'InvalidMessageContents',
+    'InvalidParameterValue',
+    'MessageTooLong',
+    'AWS.SimpleQueueService.BatchRequestTooLong',
+    'AWS.SimpleQueueService.TooManyEntriesInBatchRequest',
+    'AWS.SimpleQueueService.BatchEntryIdsNotDistinct',
+}
+
+
+def is_message_fault(error) -> bool:
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in MESSAGE_FAULT_CODES
+
 
-def submit_to_sqs(json_payload: str) -> bool:
+def submit_to_sqs(json_payload: str, queue_name=None, delay_seconds=0) -> bool:
     now = datetime.datetime.now()
     logger.debug("[SQS-push, {}] apps/tasks/utils.py: submit_to_sqs({})\n".format(json_payload, now))
 
     '''
     Submit a message into the SQS queue.
+    Messages which cannot be sent (or while the SQS breaker is open) are journaled
+    to local disk and replayed later, see apps/tasks/spill.py
+    Messages SQS rejects as invalid (MESSAGE_FAULT_CODES) are neither journaled nor counted
+    as a breaker failure, False is returned.
     '''
-    sqs_queue_name = settings.SQS_QUEUE_NAME
+    sqs_queue_name = queue_name or settings.SQS_QUEUE_NAME
     sqs_region = settings.SQS_REGION
-    # Get the service resource
-    sqs = boto3.resource('sqs', region_name=sqs_region)
+    if not sqs_breaker.allow():
+        return spill.append(sqs_queue_name, json_payload, delay_seconds)
+
     try:
-        # Get the queue
-        queue = sqs.get_queue_by_name(QueueName=sqs_queue_name)
+        # Pooled client and cached queue url, see apps/tasks/aws.py
+        queue_url = get_sqs_queue_url(sqs_queue_name, sqs_region)
         # Create a new message
-        response = queue.send_message(MessageBody=json_payload)
+        response = get_sqs_client(sqs_region).send_message(
+            QueueUrl=queue_url, MessageBody=json_payload, DelaySeconds=delay_seconds)
         if response.get('MessageId'):
             logger.debug("SQS {}: Message ID: {}".format(sqs_queue_name, response.get('MessageId')))
+            sqs_breaker.record_success()
+            # SQS is back, hand what was spilled so far to the replayer.
+            spill.seal()
             return True
     except Exception as error:
         logger.error(error)
+        if is_message_fault(error):
+            return False
+        sqs_breaker.record_failure()
 
     logger.debug("Error sending message to queue: {}, {}, {}".format(sqs_queue_name, sqs_region, json_payload))
-    return False
+    return spill.append(sqs_queue_name, json_payload, delay_seconds)
+
+
+# SendMessageBatch limits, see
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_SendMessageBatch.html
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+SQS_BATCH_MAX_ATTEMPTS = 3
+# Full jitter exponential backoff between attempts: up to 0.05s, 0.1s, ... so throttled retries spread out.
+SQS_BATCH_RETRY_BASE_DELAY = 0.05
+
+
+class SQSBatchSubmitter:
+    '''
+    Buffers json payloads and submits them to the SQS queue using SendMessageBatch.
+    A batch is flushed once it holds 10 messages or adding a message would exceed 256 KB.
+    Only the entries reported as failed (and not caused by the sender) are retried.
+    With spill_unsent entries which still failed (or all of them while the SQS breaker is open)
+    are journaled to local disk and reported as submitted, see apps/tasks/spill.py
+    Entries SQS rejected as invalid (sender fault) are never journaled, their indexes are
+    collected in rejected.
+
+    Usage:
+        with SQSBatchSubmitter() as submitter:
+            for payload in payloads:
+                submitter.add(payload)
+        submitter.results  # one boolean per added payload
+    '''
+
+    def __init__(self, queue_name=None, region_name=None, spill_unsent=True):
+        self.queue_name = queue_name or settings.SQS_QUEUE_NAME
+        self.region_name = region_name or settings.SQS_REGION
+        self.spill_unsent = spill_unsent
+        self.results = []
+        self.rejected = set()
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, json_payload: str, delay_seconds=0) -> int:
+        '''
+        Adds a payload to the current batch and returns its index in results.
+        '''
+        size = len(json_payload.encode('utf-8'))
+        full = len(self._buffer) >= SQS_BATCH_MAX_ENTRIES or self._buffer_bytes + size > SQS_BATCH_MAX_BYTES
+        if self._buffer and full:
+            self.flush()
+
+        index = len(self.results)
+        self.results.append(False)
+        self._buffer.append((index, json_payload, delay_seconds))
+        self._buffer_bytes += size
+        return index
+
+    def flush(self):
+        '''
+        Submits the buffered batch, retrying only the entries which failed.
+        '''
+        if not self._buffer:
+            return
+
+        pending = {str(index): (json_payload, delay_seconds) for index, json_payload, delay_seconds in self._buffer}
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        if self.spill_unsent and not sqs_breaker.allow():
+            self._spill(pending)
+            return
+
+        try:
+            client = get_sqs_client(self.region_name)
+            queue_url = get_sqs_queue_url(self.queue_name, self.region_name)
+        except Exception:
+            sqs_breaker.record_failure()
+            if not self.spill_unsent:
+                raise
+            self._spill(pending)
+            return
+
+        for attempt in range(1, SQS_BATCH_MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                time.sleep(random.uniform(0, SQS_BATCH_RETRY_BASE_DELAY * 2 ** (attempt - 2)))
+            try:
+                response = client.send_message_batch(QueueUrl=queue_url, Entries=[
+                    {'Id': entry_id, 'MessageBody': json_payload, 'DelaySeconds': delay_seconds}
+                    for entry_id, (json_payload, delay_seconds) in pending.items()
+                ])
+            except Exception as error:
+                logger.error("SQS {}: batch attempt {} failed: {}".format(self.queue_name, attempt, error))
+                if is_message_fault(error):
+                    self.rejected.update(int(entry_id) for entry_id in pending)
+                    pending = {}
+                    break
+                sqs_breaker.record_failure()
+                if sqs_breaker.state != breaker.CLOSED:
+                    break
+                continue
+            sqs_breaker.record_success()
+            spill.seal()
+
+            for entry in response.get('Successful', []):
+                self.results[int(entry['Id'])] = True
+                pending.pop(entry['Id'], None)
+
+            for entry in response.get('Failed', []):
+                logger.error("SQS {}: batch entry {} failed: {} {}".format(
+                    self.queue_name, entry['Id'], entry.get('Code'), entry.get('Message')))
+                if entry.get('SenderFault'):
+                    # The message itself is invalid (eg. too large), retrying will not help.
+                    self.rejected.add(int(entry['Id']))
+                    pending.pop(entry['Id'], None)
+
+            if not pending:
+                break
+
+        for json_payload, _ in pending.values():
+            logger.debug("Error sending message to queue: {}, {}, {}".format(
+                self.queue_name, self.region_name, json_payload))
+        if self.spill_unsent:
+            self._spill(pending)
+
+    def _spill(self, pending):
+        for entry_id, (json_payload, delay_seconds) in pending.items():
+            self.results[int(entry_id)] = spill.append(self.queue_name, json_payload, delay_seconds)
+
+
+def submit_batch(json_payloads, queue_name=None, delays=None, spill_unsent=True) -> SQSBatchSubmitter:
+    '''
+    submit_batch_to_sqs returning the flushed submitter, whose rejected tells the payloads
+    SQS refused as invalid apart from the ones which could not be sent (spill replay).
+    '''
+    json_payloads = list(json_payloads)
+    submitter = SQSBatchSubmitter(queue_name, spill_unsent=spill_unsent)
+    try:
+        with submitter:
+            for json_payload, delay_seconds in zip(json_payloads, delays or itertools.repeat(0)):
+                submitter.add(json_payload, delay_seconds)
+    except Exception as error:
+        # Queue lookup failed, the payloads not added yet were not sent either.
+        logger.error(error)
+    submitter.results += [False] * (len(json_payloads) - len(submitter.results))
+    return submitter
+
+
+def submit_batch_to_sqs(json_payloads, queue_name=None, delays=None, spill_unsent=True) -> list:
+    '''
+    Submit many messages into the SQS queue with SendMessageBatch.
+    delays optionally gives the DelaySeconds of each payload.
+    spill_unsent=False reports unsent messages as failed instead of journaling them (outbox relay, spill replay).
+    Returns a list of booleans, one per payload, in the same order as json_payloads.
+    '''
+    logger.debug("[SQS-push-batch, {}] apps/tasks/sqs.py: submit_batch_to_sqs()".format(datetime.datetime.now()))
+    return submit_batch(json_payloads, queue_name, delays, spill_unsent).results
@@ -1,20 +1,38 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
+
 from apps.tasks import QueueableTask
 from apps.tasks.celery import app as celery_app
 
+if settings.TASK_LOADTEST_ENABLED:
+    # Registers LoadTestNotification, see loadtest/readme.md
+    from apps.tasks import loadtest  # noqa: F401
+
 
 # -----------------------------------------------------------------------------
 # Constants
 # -----------------------------------------------------------------------------
 USER_UPDATE = 'user_update'
+FCM_RESEND = 'fcm_resend'
+FCM_TOPIC_SYNC = 'fcm_topic_sync'
 
 
 # -----------------------------------------------------------------------------
 # Celery Tasks
 # -----------------------------------------------------------------------------
-@celery_app.task(name=USER_UPDATE)
-def run_user_update(*args, **kwargs):
-    UserUpdate().run(*args, **kwargs)
+@celery_app.task(name=USER_UPDATE, bind=True)
+def run_user_update(self, *args, **kwargs):
+    UserUpdate.run_celery_task(self, *args, **kwargs)
+
+
+@celery_app.task(name=FCM_RESEND, bind=True)
+def run_fcm_resend(self, *args, **kwargs):
+    FCMResend.run_celery_task(self, *args, **kwargs)
+
+
+@celery_app.task(name=FCM_TOPIC_SYNC, bind=True)
+def run_fcm_topic_sync(self, *args, **kwargs):
+    FCMTopicSync.run_celery_task(self, *args, **kwargs)
 
 
 # -----------------------------------------------------------------------------
@@ -24,7 +42,47 @@ class UserUpdate(QueueableTask):
 
     celery_task_function = run_user_update
     ACTION_NAME = USER_UPDATE
+    # Profile touches come in bursts, sync each distinct update with Unionware once.
+    COALESCE_WINDOW = 60
+    # Don't let a draining backlog hammer the Unionware API.
+    RATE_LIMIT = 10
+    RATE_LIMIT_BURST = 20
 
     def run(self, *args, **kwargs):
         from .events import update_user_unionware_data
         update_user_unionware_data(*args, **kwargs)
+
+
+class FCMResend(QueueableTask):
+    '''
+        Sends a failed FCM notification again to the tokens it did not reach,
+        queued by apps.notifications.fcm_resend.
+    '''
+
+    celery_task_function = run_fcm_resend
+    ACTION_NAME = FCM_RESEND
+    # Campaign resends must not delay interactive tasks.
+    QUEUE = 'bulk'
+
+    def run(self, registration_ids, notification, attempt):
+        from apps.notifications.fcm import FCMNotifier
+        FCMNotifier().resend(attempt, registration_ids, notification)
+
+
+class FCMTopicSync(QueueableTask):
+    '''
+        Subscribes or unsubscribes devices to an FCM topic,
+        queued by FCMNotifier.sync_device_topics as devices register.
+    '''
+
+    celery_task_function = run_fcm_topic_sync
+    ACTION_NAME = FCM_TOPIC_SYNC
+
+    def run(self, action, topic_name, registration_ids):
+        from apps.notifications.fcm import FCMNotifier
+        notifier = FCMNotifier()
+        manage = notifier.subscribe if action == 'subscribe' else notifier.unsubscribe
+        summary = manage(topic_name, registration_ids)
+        if summary['failed']:
+            # Left for redelivery.
+            raise RuntimeError("FCM {} of {} tokens to {} failed".format(action, summary['failed'], topic_name))
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
 from django.urls import path
 
 from apps.tasks import eb_worker
@@ -7,4 +8,10 @@ app_name = 'tasks'
 
 urlpatterns = [
     path('', eb_worker.eb_index, name='eb_index'),
+    path('batch/', eb_worker.eb_batch, name='eb_batch'),
+    path('metrics/', eb_worker.task_metrics, name='task_metrics'),
 ]
+
+if settings.TASK_LOADTEST_ENABLED:
+    from apps.tasks import loadtest
+    urlpatterns.append(path('loadtest/', loadtest.loadtest_enqueue, name='loadtest_enqueue'))